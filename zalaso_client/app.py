@@ -1,14 +1,20 @@
-from flask import Flask, render_template, request, redirect, url_for, Response, session
+from flask import Flask, render_template, request, redirect, url_for, Response, session, send_file
 from imap_tools import MailBox, A
-import smtplib, ssl, hashlib, json, os, sys, base64, time, re, html, webbrowser, urllib.parse, socket
+from imap_tools.utils import encode_folder
+import smtplib, ssl, hashlib, json, os, sys, base64, time, re, html, webbrowser, urllib.parse, socket, quopri
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email import encoders
 from datetime import date, timedelta, datetime, timezone
 from email.utils import formatdate
-import sqlite3, uuid
-import threading
+import email.header
+import sqlite3, uuid, io
+import threading, imaplib, heapq, itertools
+from contextlib import contextmanager
+from concurrent.futures import Future
+from collections import deque
+from bs4 import BeautifulSoup
 
 try:
     from pyngrok import ngrok, conf
@@ -65,6 +71,19 @@ def get_clean_email(text):
         return text.split('<')[1].strip('>').strip().lower()
     return text.strip().lower()
 
+# emails.ts: mailets datum som UTC-epoch i sekunder (NULL = saknas). Listningar sorterar och bläddrar på ts i stället för
+# date_iso, där text med olika tidszoner (och utan) inte sorteras i tidsordning.
+UTC_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def date_ts(value):
+    """ emails.ts för ett datetime eller en date_iso-sträng. Datum utan tidszon räknas som UTC, som i list_date. """
+    if not value: return None
+    try:
+        d = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+        if d.tzinfo is None: d = d.replace(tzinfo=timezone.utc)
+        return int((d - UTC_EPOCH).total_seconds())
+    except (TypeError, ValueError, OverflowError): return None
+
 def log_event(message):
     try:
         with log_lock:
@@ -263,85 +282,610 @@ TRANSLATIONS = {
     }
 }
 
-# Hjälpfunktioner för att hantera lokal läst-status
-def update_local_status(folder, uids, is_read):
-    data = {}
-    if os.path.exists(READ_STATUS_FILE):
-        try:
-            with open(READ_STATUS_FILE, 'r') as f: data = json.load(f)
-        except: pass
-    
-    if folder not in data: data[folder] = {}
+# Hjälpfunktioner för att hantera lokal läst-/stjärnstatus (kolumnerna seen/flagged i emails)
+def _status_rows(folder, uids, value):
+    rows = []
     for uid in uids:
-        data[folder][str(uid)] = is_read
-        
-    with open(READ_STATUS_FILE, 'w') as f:
-        json.dump(data, f)
-
-def update_local_status_batch(folder, updates):
-    data = {}
-    if os.path.exists(READ_STATUS_FILE):
-        try:
-            with open(READ_STATUS_FILE, 'r') as f: data = json.load(f)
-        except: pass
-    
-    if folder not in data: data[folder] = {}
-    
-    changed = False
-    for uid, is_read in updates.items():
-        if data[folder].get(str(uid)) != is_read:
-            data[folder][str(uid)] = is_read
-            changed = True
-            
-    if changed:
-        with open(READ_STATUS_FILE, 'w') as f:
-            json.dump(data, f)
+        try: rows.append((1 if value else 0, folder, int(uid)))
+        except (TypeError, ValueError): pass
+    return rows
 
-def get_local_status(folder):
-    if not os.path.exists(READ_STATUS_FILE): return {}
-    try:
-        with open(READ_STATUS_FILE, 'r') as f:
-            return json.load(f).get(folder, {})
-    except: return {}
+def update_local_status(folder, uids, is_read):
+    rows = _status_rows(folder, uids, is_read)
+    db_write(lambda conn: conn.executemany("UPDATE emails SET seen=? WHERE folder=? AND uid=?", rows), priority=PRIORITY_USER)
 
 def update_star_status(folder, uid, is_starred):
-    data = {}
-    if os.path.exists(STAR_STATUS_FILE):
+    rows = _status_rows(folder, [uid], is_starred)
+    db_write(lambda conn: conn.executemany("UPDATE emails SET flagged=? WHERE folder=? AND uid=?", rows), priority=PRIORITY_USER)
+
+def update_flag_status_batch(folder, updates):
+    """ updates: {uid: (is_read, is_starred)}. Skrivs i en transaktion och bara för rader som faktiskt ändrats. """
+    rows = []
+    for uid, (is_read, is_starred) in updates.items():
+        try: uid = int(uid)
+        except (TypeError, ValueError): continue
+        seen, flagged = (1 if is_read else 0), (1 if is_starred else 0)
+        rows.append((seen, flagged, folder, uid, seen, flagged))
+    if not rows: return
+    db_write(lambda conn: conn.executemany("UPDATE emails SET seen=?, flagged=? WHERE folder=? AND uid=? AND (seen IS NOT ? OR flagged IS NOT ?)", rows))
+
+def migrate_status_files(conn):
+    """ Engångsflytt av read_status.json/star_status.json till emails.seen/flagged. Filerna döps om efteråt. """
+    for path, column in ((READ_STATUS_FILE, 'seen'), (STAR_STATUS_FILE, 'flagged')):
+        if not os.path.exists(path): continue
         try:
-            with open(STAR_STATUS_FILE, 'r') as f: data = json.load(f)
-        except: pass
-    
-    if folder not in data: data[folder] = {}
-    data[folder][str(uid)] = is_starred
-        
-    with open(STAR_STATUS_FILE, 'w') as f:
-        json.dump(data, f)
-
-def get_star_status(folder):
-    if not os.path.exists(STAR_STATUS_FILE): return {}
-    try:
-        with open(STAR_STATUS_FILE, 'r') as f:
-            return json.load(f).get(folder, {})
-    except: return {}
-
-def update_star_status_batch(folder, updates):
-    data = {}
-    if os.path.exists(STAR_STATUS_FILE):
-        try:
-            with open(STAR_STATUS_FILE, 'r') as f: data = json.load(f)
-        except: pass
-    
-    if folder not in data: data[folder] = {}
-    
-    changed = False
-    for uid, is_starred in updates.items():
-        if data[folder].get(uid) != is_starred:
-            data[folder][uid] = is_starred
-            changed = True
-            
-    if changed:
-        with open(STAR_STATUS_FILE, 'w') as f:
-            json.dump(data, f)
+            with open(path, 'r') as f: data = json.load(f)
+        except: data = {}
+        rows = []
+        for folder, uids in (data or {}).items():
+            if not isinstance(uids, dict): continue
+            for uid, value in uids.items():
+                try: rows.append((1 if value else 0, folder, int(uid)))
+                except (TypeError, ValueError): pass
+        conn.executemany(f"UPDATE emails SET {column}=? WHERE folder=? AND uid=?", rows)
+        try: os.replace(path, path + '.migrated')
+        except OSError as e: log_event(f"Kunde inte döpa om {path}: {e}")
+        log_event(f"Migrerade {len(rows)} statusrader från {os.path.basename(path)}")
+
+# Etiketter lagras i email_labels (email_rowid, label_id). Listningar hämtar id:na med i samma fråga.
+LABEL_IDS_COLUMN = "(SELECT group_concat(label_id) FROM email_labels WHERE email_rowid = emails.rowid) AS label_ids"
+# Listningar läser bara kuvertdata; body/html/html_safe hämtas via /api/get_message när tråden öppnas
+ENVELOPE_COLUMNS = ("emails.uid, emails.folder, emails.subject, emails.sender, emails.recipients, emails.date_iso, emails.ts, emails.date_str, "
+                    "emails.seen, emails.flagged, emails.is_draft, emails.snippet, emails.thread_id")
+LISTING_COLUMNS = f"emails.rowid AS rowid, {ENVELOPE_COLUMNS}, {LABEL_IDS_COLUMN}"
+# Utkast väljs efter om de har innehåll; uttrycket läser kropparna men bara för de få utkastraderna
+HAS_CONTENT_COLUMN = "(COALESCE(emails.body, '') != '' OR COALESCE(emails.html, '') != '') AS has_content"
+
+def migrate_label_column(conn):
+    """ Flytta gamla JSON-etiketter (emails.labels) till email_labels. Migrerade rader nollställs, så det körs bara en gång. """
+    rows = conn.execute("SELECT rowid, labels FROM emails WHERE labels IS NOT NULL AND labels NOT IN ('', '[]')").fetchall()
+    if not rows: return
+    memberships = []
+    for rowid, lbls_json in rows:
+        try: lbls = json.loads(lbls_json)
+        except: lbls = []
+        for l_id in lbls if isinstance(lbls, list) else []:
+            try: memberships.append((rowid, int(l_id)))
+            except (TypeError, ValueError): pass
+    conn.executemany("INSERT OR IGNORE INTO email_labels (email_rowid, label_id) SELECT ?, id FROM labels WHERE id=?", memberships)
+    conn.executemany("UPDATE emails SET labels=NULL WHERE rowid=?", [(r[0],) for r in rows])
+    log_event(f"Migrerade {len(memberships)} etikett-kopplingar till email_labels")
+
+def set_email_labels(conn, label_id, uids, folder=None, assigned=True):
+    """ Sätt eller ta bort en etikett för UIDs (i en mapp om den anges, annars i alla mappar) """
+    rows = []
+    for uid in uids:
+        try: rows.append((label_id, int(uid)) if not folder else (label_id, int(uid), folder))
+        except (TypeError, ValueError): pass
+    where = "uid=?" if not folder else "uid=? AND folder=?"
+    if assigned:
+        conn.executemany(f"INSERT OR IGNORE INTO email_labels (email_rowid, label_id) SELECT rowid, ? FROM emails WHERE {where}", rows)
+    else:
+        conn.executemany(f"DELETE FROM email_labels WHERE label_id=? AND email_rowid IN (SELECT rowid FROM emails WHERE {where})", rows)
+
+def get_label_counts(conn):
+    return dict(conn.execute("SELECT label_id, total FROM label_counts").fetchall())
+
+# Räknare: folder_counts och label_counts underhålls av triggrar (init_db), så sidofältet kostar en fråga oavsett antal mappar
+def rebuild_counts(conn, folders=None):
+    """ Räkna om räknarna från emails/email_labels (första start, eller mappar vars räknare avviker från servern) """
+    if folders is not None and not folders: return
+    where, params = "WHERE true", []
+    if folders is not None:
+        where, params = f"WHERE folder IN ({','.join('?' * len(folders))})", list(folders)
+    conn.execute(f"UPDATE folder_counts SET total = 0, unread = 0, flagged = 0 {where}", params)
+    conn.execute(f"""INSERT INTO folder_counts(folder, total, unread, flagged)
+        SELECT folder, COUNT(*), SUM(COALESCE(seen, 0) = 0), SUM(COALESCE(flagged, 0) != 0) FROM emails
+        {where} AND folder IS NOT NULL GROUP BY folder
+        ON CONFLICT(folder) DO UPDATE SET total = excluded.total, unread = excluded.unread, flagged = excluded.flagged""", params)
+    if folders is None:
+        conn.execute("DELETE FROM label_counts")
+        conn.execute("""INSERT INTO label_counts(label_id, total, unread)
+            SELECT email_labels.label_id, COUNT(*), SUM(COALESCE(emails.seen, 0) = 0) FROM email_labels
+            JOIN emails ON emails.rowid = email_labels.email_rowid GROUP BY email_labels.label_id""")
+
+def folder_total(conn, folder):
+    row = conn.execute("SELECT total FROM folder_counts WHERE folder=?", (folder,)).fetchone()
+    return row[0] if row else 0
+
+def get_counts(conn):
+    """ Olästa/totalt per mapp och etikett för sidofältet och /api/counts """
+    folders = {}
+    for folder, total, unread, flagged, server_total, server_unread in conn.execute(
+            "SELECT folder, total, unread, flagged, server_total, server_unread FROM folder_counts"):
+        # Mappar som inte synkats lokalt än visar serverns siffror från senaste STATUS
+        if not total and server_total:
+            total, unread = server_total, server_unread or 0
+        folders[folder] = {'total': total, 'unread': unread, 'flagged': flagged}
+    labels = {label_id: {'total': total, 'unread': unread}
+              for label_id, total, unread in conn.execute("SELECT label_id, total, unread FROM label_counts")}
+    # Stjärnmärkta visar olästa som övriga märken; få rader, så räkningen går via det partiella indexet
+    starred = conn.execute("SELECT COUNT(*) FROM emails WHERE flagged=1 AND seen=0 AND +uid IS NOT NULL AND +uid != 0").fetchone()[0]
+    return {'folders': folders, 'labels': labels, 'starred': starred}
+
+# Bilagor: metadata per MIME-del i tabellen attachments (email_rowid, part_id), fylls av synkens Fas 2
+def imap_part_ids(message):
+    """ IMAP-sektionsnummer (RFC 3501, t.ex. '2' eller '1.2') för varje MIME-del i ett email.message-objekt, nycklat på id(del) """
+    ids = {}
+    def walk(part, prefix):
+        if part.get_content_type() == 'message/rfc822':
+            ids[id(part)] = prefix or '1'
+            inner = part.get_payload()
+            inner = inner[0] if isinstance(inner, list) and inner else None
+            if inner is None: return
+            if inner.is_multipart():
+                for i, sub in enumerate(inner.get_payload(), 1): walk(sub, f"{prefix}.{i}")
+            else:
+                ids[id(inner)] = f"{prefix}.1"
+        elif part.is_multipart():
+            for i, sub in enumerate(part.get_payload(), 1):
+                walk(sub, f"{prefix}.{i}" if prefix else str(i))
+        else:
+            ids[id(part)] = prefix or '1'
+    walk(message, '')
+    return ids
+
+def attachment_records(msg, with_payload=False):
+    """ Metadata för alla bilagor och inline-delar i ett imap_tools-meddelande (with_payload: ta med avkodat innehåll) """
+    part_ids = imap_part_ids(msg.obj)
+    records = []
+    for i, att in enumerate(msg.attachments):
+        try: payload = att.payload or b''
+        except: payload = b''
+        filename = att.filename or "noname"
+        is_inline = 1 if (att.content_id or (att.content_disposition or '').lower() == 'inline') else 0
+        records.append({
+            'part_id': part_ids.get(id(att.part), f"?{i}"),
+            'filename': filename,
+            'ext': os.path.splitext(filename)[1][1:].lower() or None,
+            'content_type': (att.content_type or '').lower(),
+            'size': len(payload),
+            'is_inline': is_inline,
+            'content_hash': hashlib.sha256(payload).hexdigest(),
+            'content_id': att.content_id or None,
+            'encoding': (att.part.get('Content-Transfer-Encoding') or '').strip().lower() or None,
+        })
+        if with_payload: records[-1]['payload'] = payload
+    return records
+
+def store_attachments(conn, uid, folder, records):
+    row = conn.execute("SELECT rowid FROM emails WHERE uid=? AND folder=?", (uid, folder)).fetchone()
+    if not row: return
+    conn.execute("DELETE FROM attachments WHERE email_rowid=?", (row[0],))
+    conn.executemany("""INSERT OR REPLACE INTO attachments (email_rowid, part_id, filename, ext, content_type, size, is_inline, content_hash, content_id, encoding)
+                        VALUES (?,?,?,?,?,?,?,?,?,?)""",
+                     [(row[0], r['part_id'], r['filename'], r['ext'], r['content_type'], r['size'], r['is_inline'],
+                       r['content_hash'], r['content_id'], r['encoding']) for r in records])
+
+def migrate_attachment_json(conn):
+    """ Engångsflytt av JSON-listan i emails.attachments. Sektionsnumret är okänt för dessa ('?n') tills mailet synkas om. """
+    rows = conn.execute("SELECT rowid, attachments FROM emails WHERE attachments IS NOT NULL AND attachments NOT IN ('', '[]')").fetchall()
+    records = []
+    for rowid, atts_json in rows:
+        try: atts = json.loads(atts_json)
+        except: continue
+        for i, a in enumerate(atts if isinstance(atts, list) else []):
+            filename = a.get('filename') or "noname"
+            records.append((rowid, f"?{i}", filename, os.path.splitext(filename)[1][1:].lower() or None,
+                            (a.get('content_type') or '').lower(), a.get('size') or 0))
+    conn.executemany("INSERT OR IGNORE INTO attachments (email_rowid, part_id, filename, ext, content_type, size, is_inline) VALUES (?,?,?,?,?,?,0)", records)
+    if records: log_event(f"Migrerade {len(records)} bilagor till tabellen attachments")
+
+def load_attachment_chips(conn, msgs):
+    """ Sätt attachments_data (bilagor som visas i listan: ej inline, ej bilder) för en sida MockMsg med en fråga per 500 mail """
+    by_rowid = {m.rowid: m for m in msgs if getattr(m, 'rowid', None)}
+    rowids = list(by_rowid)
+    for i in range(0, len(rowids), 500):
+        chunk = rowids[i:i+500]
+        placeholders = ','.join('?' * len(chunk))
+        for r in conn.execute(f"""SELECT email_rowid, part_id, filename, size, content_type FROM attachments
+                                  WHERE email_rowid IN ({placeholders}) AND is_inline = 0 AND content_type NOT LIKE 'image/%'
+                                  ORDER BY email_rowid, part_id""", chunk):
+            by_rowid[r[0]].attachments_data.append({'filename': r[2], 'size': r[3] or 0, 'content_type': r[4], 'part_id': r[1]})
+
+# Lokalt bilagelager: filer adresseras med sha256 av innehållet (samma fil i flera mail lagras en gång)
+# och rensas i LRU-ordning (attachment_blobs.last_access) när totalen passerar ATTACHMENT_STORE_MAX_BYTES
+ATTACHMENT_STORE_DIR = get_data_path('attachment_store')
+ATTACHMENT_STORE_MAX_BYTES = 1024 * 1024 * 1024
+ATTACHMENT_STORE_MAX_FILE = 200 * 1024 * 1024      # Större delar skickas direkt utan att cachas
+ATTACHMENT_STORE_PREFETCH_MAX = 10 * 1024 * 1024   # Fas 2 lagrar bara bilagor upp till denna storlek, större vid första nedladdning
+ATTACHMENT_STORE_TOUCH_INTERVAL = 300              # Sekunder mellan uppdateringar av last_access för samma fil
+ATTACHMENT_STORE_EVICT_TO = 0.9                    # Rensa ner till 90 % av taket
+blob_store_lock = threading.Lock()
+# total: storlek i byte (läses från DB vid första behov). pending: hashar vars fil väntar på att gruppen committas.
+# touched/touches: senaste registrerade användning per hash och användningar som inte skrivits än (flush_blob_touches)
+blob_store_state = {'total': None, 'pending': set(), 'touched': {}, 'touches': {}, 'flush_queued': False}
+
+def blob_path(content_hash):
+    return os.path.join(ATTACHMENT_STORE_DIR, content_hash[:2], content_hash)
+
+def blob_store_put(conn, payload, content_hash=None, content_type=None, pinned=False):
+    """ Lägg innehåll i lagret och returnera dess hash (None om det är för stort). Körs i skrivaren: filen får sitt
+        namn och räknas in i totalen först när gruppen committats; rullas den tillbaka tas den temporära filen bort. """
+    if payload is None or len(payload) > ATTACHMENT_STORE_MAX_FILE: return None
+    content_hash = content_hash or hashlib.sha256(payload).hexdigest()
+    path = blob_path(content_hash)
+    now = time.time()
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Skriv till temporär fil och byt namn, så att en läsare aldrig ser en halvskriven fil
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, 'wb') as f: f.write(payload)
+        with blob_store_lock: blob_store_state['pending'].add(content_hash)
+        def publish():
+            try: os.replace(tmp, path)
+            finally:
+                with blob_store_lock: blob_store_state['pending'].discard(content_hash)
+        def discard():
+            try: os.remove(tmp)
+            except OSError: pass
+            with blob_store_lock: blob_store_state['pending'].discard(content_hash)
+        db_on_commit(publish, discard)
+    added = conn.execute("INSERT OR IGNORE INTO attachment_blobs (content_hash, size, last_access, content_type, pinned) VALUES (?, ?, ?, ?, ?)",
+                         (content_hash, len(payload), now, content_type, 1 if pinned else 0)).rowcount
+    if added:
+        db_on_commit(lambda: blob_store_added(len(payload)))
+    else:
+        conn.execute("UPDATE attachment_blobs SET last_access=?, pinned=MAX(pinned, ?) WHERE content_hash=?", (now, 1 if pinned else 0, content_hash))
+    return content_hash
+
+def blob_store_added(size):
+    # Efter commit: räkna in filen och rensa i bakgrunden om lagret passerat taket
+    with blob_store_lock:
+        if blob_store_state['total'] is None:
+            # Totalen är inte läst än; evict_blob_store läser den (med den här filen) ur databasen
+            over = size > 0
+        else:
+            blob_store_state['total'] += size
+            over = blob_store_state['total'] > ATTACHMENT_STORE_MAX_BYTES
+    if over: schedule_job('blob-evict', evict_blob_store)
+
+def blob_store_get(conn, content_hash):
+    """ Sökväg till lagrat innehåll, eller None. Läser bara; användningen (LRU) och glömda filer skrivs av skrivaren. """
+    if not content_hash: return None
+    path = blob_path(content_hash)
+    if not os.path.exists(path):
+        with blob_store_lock:
+            if content_hash in blob_store_state['pending']: return None
+        # Filen har försvunnit utanför lagret (t.ex. raderad manuellt); glöm den
+        if conn.execute("SELECT 1 FROM attachment_blobs WHERE content_hash=?", (content_hash,)).fetchone():
+            db_write(forget_blob, content_hash, priority=PRIORITY_BACKGROUND, wait=False)
+        return None
+    now = time.time()
+    with blob_store_lock:
+        if now - blob_store_state['touched'].get(content_hash, 0) < ATTACHMENT_STORE_TOUCH_INTERVAL: return path
+        if len(blob_store_state['touched']) > 10000: blob_store_state['touched'].clear()
+        blob_store_state['touched'][content_hash] = now
+        blob_store_state['touches'][content_hash] = now
+        queue = not blob_store_state['flush_queued']
+        blob_store_state['flush_queued'] = True
+    if queue: db_write(flush_blob_touches, priority=PRIORITY_BACKGROUND, wait=False)
+    return path
+
+def flush_blob_touches(conn):
+    """ Skrivjobb: last_access för alla användningar sedan förra gången, i en sats """
+    with blob_store_lock:
+        touches, blob_store_state['touches'] = blob_store_state['touches'], {}
+        blob_store_state['flush_queued'] = False
+    conn.executemany("UPDATE attachment_blobs SET last_access=? WHERE content_hash=? AND last_access < ?",
+                     [(t, h, t - ATTACHMENT_STORE_TOUCH_INTERVAL) for h, t in touches.items()])
+
+def forget_blob(conn, content_hash):
+    """ Skrivjobb: ta bort raden för en fil som saknas på disk """
+    with blob_store_lock:
+        if content_hash in blob_store_state['pending']: return
+    if os.path.exists(blob_path(content_hash)): return
+    row = conn.execute("SELECT size FROM attachment_blobs WHERE content_hash=?", (content_hash,)).fetchone()
+    if not row: return
+    conn.execute("DELETE FROM attachment_blobs WHERE content_hash=?", (content_hash,))
+    db_on_commit(lambda: blob_store_added(-row[0]))
+
+def evict_blob_store():
+    """ Bakgrundsjobb: ta bort minst nyligen använda filer (ej fastnålade) tills lagret är under ATTACHMENT_STORE_EVICT_TO
+        av taket. Filerna flyttas undan i skrivjobbet och raderas först när borttagningen av raderna är committad. """
+    def evict(conn):
+        with blob_store_lock:
+            if blob_store_state['total'] is None:
+                blob_store_state['total'] = conn.execute("SELECT COALESCE(SUM(size), 0) FROM attachment_blobs").fetchone()[0]
+            total = blob_store_state['total']
+        if total <= ATTACHMENT_STORE_MAX_BYTES: return 0
+        target = ATTACHMENT_STORE_MAX_BYTES * ATTACHMENT_STORE_EVICT_TO
+        removed = []
+        for content_hash, size in conn.execute("SELECT content_hash, size FROM attachment_blobs WHERE pinned = 0 ORDER BY last_access").fetchall():
+            if total <= target: break
+            path = blob_path(content_hash)
+            try: os.replace(path, path + '.evict')
+            except FileNotFoundError: pass
+            except OSError: continue # Låst, t.ex. under pågående nedladdning på Windows; ta nästa
+            conn.execute("DELETE FROM attachment_blobs WHERE content_hash=?", (content_hash,))
+            removed.append((path, size))
+            total -= size
+        def delete_files():
+            for path, _ in removed:
+                try: os.remove(path + '.evict')
+                except OSError: pass
+            with blob_store_lock:
+                blob_store_state['total'] -= sum(size for _, size in removed)
+        def restore_files():
+            for path, _ in removed:
+                try: os.replace(path + '.evict', path)
+                except OSError: pass
+        db_on_commit(delete_files, restore_files)
+        return len(removed)
+
+    removed = db_write(evict, priority=PRIORITY_BACKGROUND)
+    if removed: log_event(f"Bilagelagret rensat: {removed} filer borttagna")
+    return removed
+
+def inline_url(content_hash):
+    return f"/api/inline/{content_hash}"
+
+def inline_part_url(uid, folder, part_id):
+    # Tillfällig adress för inline-delar vars innehåll inte hämtats än (fetch_bodies_structured)
+    return f"/api/attachment/{uid}?folder={urllib.parse.quote(folder)}&part={part_id}&disposition=inline"
+
+def rewrite_inline_part(conn, email_rowid, uid, folder, part_id, content_hash):
+    """ Peka om mailets html från inline_part_url till inline_url när delen väl finns i bilagelagret """
+    row = conn.execute("SELECT html, body FROM emails WHERE rowid=?", (email_rowid,)).fetchone()
+    url = inline_part_url(uid, folder, part_id)
+    if not row or not row[0] or url not in row[0]: return
+    body_html = row[0].replace(url, inline_url(content_hash))
+    conn.execute("UPDATE emails SET html=?, html_safe=?, snippet=?, sanitizer_version=? WHERE rowid=?",
+                 (body_html,) + sanitize_message(row[1], body_html) + (SANITIZER_VERSION, email_rowid))
+
+def get_app_state(conn, key, default=None):
+    row = conn.execute("SELECT value FROM app_state WHERE key=?", (key,)).fetchone()
+    return row[0] if row else default
+
+def set_app_state(conn, key, value):
+    conn.execute("INSERT INTO app_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, str(value)))
+
+# Återupptagbara bakgrundssteg efter schemamigreringarna: fyllnad av kolumner och liknande som skulle låsa
+# en stor databas om de kördes i init_db. Varje steg går igenom emails i rowid-ordning, en sats per skrivjobb
+# med låg prioritet, och sparar markören i app_state (<namn>_rowid, -1 = klart) så att det fortsätter efter omstart.
+BACKGROUND_STEP_BATCH = 500
+
+def run_background_step(name, batch):
+    """ Kör ett steg till slut. batch(conn, last_rowid) behandlar nästa sats och returnerar (sista rowid, antal ändrade),
+        eller (None, 0) när det inte finns fler rader. Returnerar totalt antal ändrade. """
+    key = f'{name}_rowid'
+    def run_batch(conn):
+        last_rowid = int(get_app_state(conn, key, 0))
+        if last_rowid < 0: return None, 0 # Klart sedan tidigare
+        upper, n = batch(conn, last_rowid)
+        set_app_state(conn, key, -1 if upper is None else upper)
+        return upper, n
+
+    changed = 0
+    while True:
+        upper, n = db_write(run_batch, priority=PRIORITY_BACKGROUND)
+        changed += n
+        if upper is None: return changed
+
+def backfill_ts(conn, last_rowid):
+    """ emails.ts ur date_iso för rader sparade innan kolumnen fanns """
+    rows = conn.execute("SELECT rowid, date_iso FROM emails WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                        (last_rowid, BACKGROUND_STEP_BATCH)).fetchall()
+    if not rows: return None, 0
+    updates = [(date_ts(date_iso), rowid) for rowid, date_iso in rows if date_iso]
+    conn.executemany("UPDATE emails SET ts=? WHERE rowid=? AND ts IS NULL", updates)
+    return rows[-1][0], len(updates)
+
+def backfill_sender_email(conn, last_rowid):
+    """ emails.sender_email för rader sparade innan kolumnen fanns (ersätter UPDATE över hela tabellen i init_db) """
+    rows = conn.execute("SELECT rowid, sender, sender_email FROM emails WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                        (last_rowid, BACKGROUND_STEP_BATCH)).fetchall()
+    if not rows: return None, 0
+    updates = [(get_clean_email(sender), rowid) for rowid, sender, sender_email in rows if sender_email is None and sender is not None]
+    conn.executemany("UPDATE emails SET sender_email=? WHERE rowid=?", updates)
+    return rows[-1][0], len(updates)
+
+# Inline-bilder som data:-URI i html (från äldre synkar) flyttas till lagret och ersätts med /api/inline/<hash>
+INLINE_MIGRATION_BATCH = 200
+DATA_URI_RE = re.compile(r'data:(image/[\w.+-]+);base64,([A-Za-z0-9+/=\s]+)')
+
+def extract_data_uris(conn, body_html):
+    """ Ersätt data:image/...;base64-URI:er med länkar till lagret (fastnålade, då originalet inte kan hämtas om) """
+    def replace(m):
+        try: payload = base64.b64decode(re.sub(r'\s+', '', m.group(2)))
+        except Exception: return m.group(0)
+        content_hash = blob_store_put(conn, payload, content_type=m.group(1), pinned=True)
+        return inline_url(content_hash) if content_hash else m.group(0)
+    return DATA_URI_RE.sub(replace, body_html)
+
+def migrate_inline_images(conn, last_rowid):
+    """ Bakgrundssteget inline_migration: en sats om INLINE_MIGRATION_BATCH rader """
+    rows = conn.execute("""SELECT rowid, html, body FROM emails WHERE rowid > ? ORDER BY rowid LIMIT ?""",
+                        (last_rowid, INLINE_MIGRATION_BATCH)).fetchall()
+    if not rows: return None, 0
+    n = 0
+    for rowid, body_html, text in rows:
+        if body_html and 'data:image/' in body_html:
+            body_html = extract_data_uris(conn, body_html)
+            conn.execute("UPDATE emails SET html=?, html_safe=?, snippet=?, sanitizer_version=? WHERE rowid=?",
+                         (body_html,) + sanitize_message(text, body_html) + (SANITIZER_VERSION, rowid))
+            n += 1
+    return rows[-1][0], n
+
+# Körs i tur och ordning av run_background_steps; namnet är markörens nyckel i app_state och får inte bytas
+BACKGROUND_STEPS = [('ts', backfill_ts), ('sender_email', backfill_sender_email), ('inline_migration', migrate_inline_images)]
+
+def run_background_steps():
+    """ Bakgrundsjobb vid start: kör klart alla steg i BACKGROUND_STEPS """
+    for name, batch in BACKGROUND_STEPS:
+        changed = run_background_step(name, batch)
+        if changed: log_event(f"Bakgrundssteget {name} klart: {changed} mail uppdaterade")
+
+def background_step_progress(conn):
+    """ Framsteg per bakgrundssteg för /api/migration_status """
+    max_rowid = conn.execute("SELECT MAX(rowid) FROM emails").fetchone()[0] or 0
+    steps = {}
+    for name, _ in BACKGROUND_STEPS:
+        last_rowid = int(get_app_state(conn, f'{name}_rowid', 0))
+        done = last_rowid < 0
+        steps[name] = {'done': done, 'last_rowid': None if done else last_rowid, 'max_rowid': max_rowid,
+                       'progress': 1.0 if done else round(min(last_rowid / max_rowid, 1.0), 3) if max_rowid else 0.0}
+    return steps
+
+# IMAP-svar: tolkning av FETCH-data från imaplib (listor, citerade strängar och literaler) för BODYSTRUCTURE och BODY[n]
+def _imap_scan(buf, literal):
+    i, n = 0, len(buf)
+    while i < n:
+        c = buf[i:i+1]
+        if c in (b' ', b'\r', b'\n'): i += 1
+        elif c == b'(': yield '('; i += 1
+        elif c == b')': yield ')'; i += 1
+        elif c == b'"':
+            j, out = i + 1, bytearray()
+            while j < n and buf[j:j+1] != b'"':
+                if buf[j:j+1] == b'\\': j += 1
+                out += buf[j:j+1]
+                j += 1
+            yield bytes(out)
+            i = j + 1
+        elif c == b'{' and buf.rstrip().endswith(b'}'):
+            # imaplib lägger literalens innehåll i tupelns andra element
+            yield literal if literal is not None else b''
+            i = n
+        else:
+            j, depth = i, 0
+            while j < n:
+                ch = buf[j:j+1]
+                if ch == b'[': depth += 1
+                elif ch == b']': depth -= 1
+                elif depth == 0 and ch in (b' ', b'(', b')', b'"'): break
+                j += 1
+            atom = buf[i:j]
+            yield None if atom.upper() == b'NIL' else atom
+            i = j
+
+def imap_parse(data):
+    """ Gör om imaplib-data (bytes och (huvud, literal)-tupler) till nästlade listor; NIL blir None """
+    stack = [[]]
+    for item in data:
+        head, literal = (item[0], item[1]) if isinstance(item, tuple) else (item, None)
+        if not isinstance(head, bytes): continue
+        for token in _imap_scan(head, literal):
+            if token == '(':
+                stack.append([])
+            elif token == ')':
+                if len(stack) > 1:
+                    done = stack.pop()
+                    stack[-1].append(done)
+            else:
+                stack[-1].append(token)
+    while len(stack) > 1:
+        done = stack.pop()
+        stack[-1].append(done)
+    return stack[0]
+
+def imap_fetch_items(data):
+    """ FETCH-svar som {uid: {'BODYSTRUCTURE': ..., 'BODY[1]<0>': ...}} """
+    result = {}
+    for node in imap_parse(data):
+        if not isinstance(node, list): continue
+        items = {}
+        for k in range(0, len(node) - 1, 2):
+            if isinstance(node[k], bytes): items[node[k].decode('ascii', 'replace').upper()] = node[k+1]
+        try: result[int(items['UID'])] = items
+        except (KeyError, TypeError, ValueError): pass
+    return result
+
+def _bs_str(value):
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else (value or '')
+
+def _bs_params(node):
+    """ Parameterlista ("charset" "utf-8" "name" ...) som dict, med RFC 2231 (name*=, name*0*=) och RFC 2047 avkodat """
+    raw = {}
+    if isinstance(node, list):
+        for k in range(0, len(node) - 1, 2):
+            raw[_bs_str(node[k]).lower()] = _bs_str(node[k+1])
+    params, continued = {}, {}
+    for key, value in raw.items():
+        if '*' not in key:
+            params[key] = value
+            continue
+        base, _, rest = key.partition('*')
+        index = rest.rstrip('*')
+        # name*=charset''%XX (kodad) eller name*0*=, name*1= ... (fortsättningar, kodade om de slutar på *)
+        continued.setdefault(base, []).append((int(index) if index.isdigit() else 0, rest == '' or rest.endswith('*'), value))
+    for base, pieces in continued.items():
+        pieces.sort()
+        charset, data = 'utf-8', b''
+        for n, (_, encoded, value) in enumerate(pieces):
+            if encoded:
+                if n == 0 and value.count("'") >= 2:
+                    charset, _, value = value.split("'", 2)
+                data += urllib.parse.unquote_to_bytes(value)
+            else:
+                data += value.encode('utf-8')
+        params[base] = _decode_text(data, charset or 'utf-8')
+    for key, value in params.items():
+        if '=?' in value:
+            try: params[key] = str(email.header.make_header(email.header.decode_header(value)))
+            except: pass
+    return params
+
+def parse_bodystructure(node):
+    """ Lövdelarna i en BODYSTRUCTURE som dictar med IMAP-sektionsnummer (samma numrering som imap_part_ids) """
+    parts = []
+    def walk(node, prefix, inside):
+        if not isinstance(node, list) or not node: return
+        if isinstance(node[0], list):
+            i = 0
+            for child in node:
+                if not isinstance(child, list): break
+                i += 1
+                walk(child, f"{prefix}.{i}" if prefix else str(i), inside)
+            return
+        part_id = prefix or '1'
+        maintype, subtype = _bs_str(node[0]).lower(), _bs_str(node[1]).lower()
+        is_message = maintype == 'message' and subtype in ('rfc822', 'global')
+        # Fälten efter size: text har 'lines', message/rfc822 har envelope, body och lines före md5/disposition
+        ext = 8 if maintype == 'text' else 10 if is_message else 7
+        disposition = node[ext+1] if len(node) > ext + 1 else None
+        disp_type, disp_params = '', {}
+        if isinstance(disposition, list) and disposition:
+            disp_type, disp_params = _bs_str(disposition[0]).lower(), _bs_params(disposition[1] if len(disposition) > 1 else None)
+        params = _bs_params(node[2])
+        try: size = int(node[6] or 0)
+        except (TypeError, ValueError, IndexError): size = 0
+        parts.append({
+            'part_id': part_id,
+            'content_type': f"{maintype}/{subtype}",
+            'charset': params.get('charset'),
+            'content_id': _bs_str(node[3]).strip('<>') or None,
+            'encoding': _bs_str(node[5]).lower() or None,
+            'size': size,
+            'disposition': disp_type,
+            'filename': disp_params.get('filename') or params.get('name'),
+            'inside_message': inside, # Del av ett bifogat mail (message/rfc822)
+        })
+        if is_message and len(node) > 8 and isinstance(node[8], list):
+            inner = node[8]
+            walk(inner, part_id if inner and isinstance(inner[0], list) else f"{part_id}.1", True)
+    walk(node, '', False)
+    return parts
+
+def _decode_transfer(raw, encoding):
+    encoding = (encoding or '').lower()
+    if encoding == 'base64':
+        raw = re.sub(rb'\s+', b'', raw)
+        return base64.b64decode(raw[:len(raw) - len(raw) % 4]) # Kan vara avkortad av storleksgränsen
+    if encoding == 'quoted-printable': return quopri.decodestring(raw)
+    return raw
+
+def _decode_text(raw, charset):
+    try: return raw.decode(charset or 'utf-8', 'replace')
+    except LookupError: return raw.decode('utf-8', 'replace')
+
+def imap_fetch_part(mb, uid, part_id, encoding=None):
+    """ Hämta en enda MIME-del (BODY.PEEK[n], sätter inte \\Seen) och avkoda dess transfer-encoding """
+    typ, data = mb.client.uid('FETCH', str(uid), f'(BODY.PEEK[{part_id}])')
+    if typ != 'OK': return None
+    raw = next((item[1] for item in data if isinstance(item, tuple) and b'BODY[' in item[0]), None)
+    if raw is None: return None
+    return _decode_transfer(raw, encoding)
 
 def get_folder_icons_map():
     if not os.path.exists(FOLDER_ICONS_FILE): return {}
@@ -400,45 +944,165 @@ def add_whitelist_sender(sender):
         with open(SPAM_FILTERS_FILE, 'w') as f:
             json.dump(filters, f)
 
-def is_spam_email(msg, filters):
-    sender = (msg.from_ or "").lower()
-    subject = (msg.subject or "").lower()
-    
-    for w in filters.get('whitelist', []):
-        if w.lower() in sender: return False
-
-    for s in filters.get('senders', []):
-        if s.lower() in sender: return True
-    for s in filters.get('subjects', []):
-        if s.lower() in subject: return True
-    return False
-
-def is_ad_email(msg, filters):
-    sender = (msg.from_ or "").lower()
-    subject = (msg.subject or "").lower()
-    
-    for w in filters.get('whitelist', []):
-        if w.lower() in sender: return False
+class KeywordMatcher:
+    """ Aho-Corasick-automat: hittar alla nyckelord (delsträngar) i en text i ett enda svep.
+        patterns är (nyckelord, tagg); search() returnerar mängden taggar vars nyckelord finns i texten. """
+    def __init__(self, patterns):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        self._always = set()    # Tomma nyckelord matchar allt (samma som '' in text)
+        for word, tag in patterns:
+            if not word:
+                self._always.add(tag)
+                continue
+            node = 0
+            for ch in word:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                    self._goto[node][ch] = nxt
+                node = nxt
+            if tag not in self._out[node]:
+                self._out[node] += (tag,)
+
+        # Bredden först: fail-länk till längsta äkta suffix som också är ett prefix i trädet
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                target = self._goto[f].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                extra = tuple(t for t in self._out[self._fail[child]] if t not in self._out[child])
+                if extra: self._out[child] += extra
+
+    def search(self, text):
+        found = set(self._always)
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]: found.update(out[node])
+        return found
+
+class MessageClassifier:
+    """ Regler, etiketter och spam-/reklamfilter kompilerade till en automat per fält (ämne/avsändare) """
+    def __init__(self, rules, labels, filters):
+        subject_patterns, sender_patterns = [], []
+
+        def add(field, word, tag):
+            field = (field or 'subject').lower()
+            if field in ('sender', 'both'): sender_patterns.append((word, tag))
+            if field != 'sender': subject_patterns.append((word, tag))
+
+        # Regler: hela nyckelordet, första regeln (lägst id) vinner
+        self.rule_targets = []
+        for r_key, r_folder, r_field in rules:
+            add(r_field, (r_key or "").lower(), ('rule', len(self.rule_targets)))
+            self.rule_targets.append(r_folder)
+
+        # Etiketter: kommaseparerade nyckelord
+        for l_id, l_key, l_field in labels:
+            for k in (l_key or "").split(','):
+                k = k.strip().lower()
+                if k: add(l_field, k, ('label', l_id))
+
+        for w in filters.get('whitelist', []): add('sender', w.lower(), ('whitelist',))
+        for w in filters.get('senders', []): add('sender', w.lower(), ('spam',))
+        for w in filters.get('subjects', []): add('subject', w.lower(), ('spam',))
+        for w in filters.get('ads_senders', []): add('sender', w.lower(), ('ad',))
+        for w in filters.get('ads_subjects', []): add('subject', w.lower(), ('ad',))
+
+        self.subject_matcher = KeywordMatcher(subject_patterns)
+        self.sender_matcher = KeywordMatcher(sender_patterns)
+
+    def classify(self, subject, sender):
+        hits = self.subject_matcher.search((subject or "").lower()) | self.sender_matcher.search((sender or "").lower())
+        rules = [t[1] for t in hits if t[0] == 'rule']
+        whitelisted = ('whitelist',) in hits
+        return {
+            'labels': sorted(t[1] for t in hits if t[0] == 'label'),
+            'rule_target': self.rule_targets[min(rules)] if rules else None,
+            'is_spam': not whitelisted and ('spam',) in hits,
+            'is_ad': not whitelisted and ('ad',) in hits,
+        }
 
-    for s in filters.get('ads_senders', []):
-        if s.lower() in sender: return True
+    def classify_batch(self, headers):
+        """ headers: lista av (ämne, avsändare) """
+        return [self.classify(subject, sender) for subject, sender in headers]
 
-    for s in filters.get('ads_subjects', []):
-        if s.lower() in subject: return True
-    return False
+# Klassificeraren byggs om när regler/etiketter ändras (invalidate_classifier) eller spam_filters.json får ny mtime
+classifier_lock = threading.Lock()
+classifier_cache = {'key': None, 'classifier': None}
+classifier_generation = 0
 
-def load_settings():
-    if not os.path.exists(SETTINGS_FILE): return {}
+def invalidate_classifier():
+    global classifier_generation
+    with classifier_lock:
+        classifier_generation += 1
+
+def get_classifier():
     try:
-        with open(SETTINGS_FILE, 'r') as f:
-            content = f.read().strip()
-            if not content: return {}
-            return json.loads(content)
-    except: return {}
+        st = os.stat(SPAM_FILTERS_FILE)
+        filters_key = (st.st_mtime_ns, st.st_size)
+    except OSError: filters_key = None
+    with classifier_lock:
+        key = (classifier_generation, filters_key)
+        if classifier_cache['key'] == key:
+            return classifier_cache['classifier']
+        with db_session(readonly=True) as conn:
+            db_rules = conn.execute("SELECT keyword, target_folder, check_field FROM rules ORDER BY id").fetchall()
+            db_labels = conn.execute("SELECT id, keyword, check_field FROM labels ORDER BY id").fetchall()
+        classifier = MessageClassifier(db_rules, db_labels, get_spam_filters())
+        classifier_cache['key'] = key
+        classifier_cache['classifier'] = classifier
+        return classifier
+
+# settings.json läses om bara när filen får ny mtime/storlek (t.ex. redigerad för hand) eller skrivs via write_settings
+settings_lock = threading.Lock()
+settings_cache = {'key': None, 'settings': {}}
+
+def _settings_key():
+    try:
+        st = os.stat(SETTINGS_FILE)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    except OSError: return None
 
-def is_configured():
+def load_settings():
+    key = _settings_key()
+    with settings_lock:
+        if settings_cache['key'] != key:
+            settings = {}
+            if key is not None:
+                try:
+                    with open(SETTINGS_FILE, 'r') as f:
+                        content = f.read().strip()
+                        if content: settings = json.loads(content)
+                except: pass
+            settings_cache['key'] = key
+            settings_cache['settings'] = settings
+        # Kopia: anroparna ändrar ibland i dicten innan de sparar
+        return dict(settings_cache['settings'])
+
+def write_settings(settings):
+    with settings_lock:
+        with open(SETTINGS_FILE, 'w') as f:
+            json.dump(settings, f, indent=4)
+        settings_cache['key'] = _settings_key()
+        settings_cache['settings'] = dict(settings)
+
+def is_configured(s=None):
     """ Kontrollera om nödvändiga inställningar finns """
-    s = load_settings()
+    if s is None: s = load_settings()
     return bool(s.get('email') and s.get('password') and s.get('imap_server') and s.get('smtp_server'))
 
 def get_mailbox():
@@ -446,7 +1110,333 @@ def get_mailbox():
     ctx = ssl.create_default_context()
     if 'zalaso' in cfg.get('imap_server',''):
         ctx.check_hostname, ctx.verify_mode = False, ssl.CERT_NONE
-    return MailBox(cfg['imap_server'], port=int(cfg['imap_port']), ssl_context=ctx).login(cfg['email'], cfg['password'])
+    # Ingen initial mapp: ENABLE är bara tillåtet innan någon mapp valts
+    mb = MailBox(cfg['imap_server'], port=int(cfg['imap_port']), ssl_context=ctx).login(cfg['email'], cfg['password'], initial_folder=None)
+    mb.zalaso_extensions = set()
+    caps = mb.client.capabilities
+    # Slå på QRESYNC om servern stöder det (behövs för inkrementell synk med VANISHED)
+    if 'QRESYNC' in caps and 'ENABLE' in caps:
+        try:
+            typ, _ = mb.client.enable('QRESYNC')
+            if typ == 'OK': mb.zalaso_extensions.update(('QRESYNC', 'CONDSTORE'))
+        except Exception: pass
+    if 'CONDSTORE' in caps: mb.zalaso_extensions.add('CONDSTORE')
+    return mb
+
+# IMAP-anslutningspool: Återanvänd inloggade sessioner istället för TCP+TLS+LOGIN vid varje anrop
+IMAP_POOL_MAX_PER_SERVER = 4     # Max samtidiga anslutningar per server (många servrar begränsar detta)
+IMAP_POOL_WAIT_TIMEOUT = 60      # Sekunder att vänta på en ledig anslutning innan vi ger upp
+IMAP_POOL_KEEPALIVE = 60         # Intervall för NOOP på vilande anslutningar
+IMAP_POOL_MAX_IDLE = 600         # Stäng anslutningar som vilat längre än så
+IMAP_POOL_HEALTHCHECK_AFTER = 30 # Gör NOOP vid utlåning om anslutningen vilat längre än så
+
+class PooledConnection:
+    def __init__(self, key, mb):
+        self.key = key
+        self.mb = mb
+        self.created = time.time()
+        self.last_used = self.created
+        self.suspect = False # Sätts om senaste användningen slutade med ett fel
+
+    def selected_folder(self):
+        # imaplib sätter state till AUTH om en SELECT misslyckas, så lita bara på mappen i SELECTED-läge
+        if self.mb.client.state != 'SELECTED': return None
+        return self.mb.folder.get()
+
+    def is_alive(self):
+        try:
+            typ, _ = self.mb.client.noop()
+            return typ == 'OK'
+        except Exception:
+            return False
+
+    def close(self):
+        try: self.mb.logout()
+        except Exception:
+            try: self.mb.client.shutdown()
+            except Exception: pass
+
+class ImapPool:
+    """ Pool med långlivade IMAP-sessioner, begränsad per server och hållen vid liv med NOOP """
+
+    def __init__(self, max_per_server=IMAP_POOL_MAX_PER_SERVER):
+        self.max_per_server = max_per_server
+        self._lock = threading.Lock()
+        self._idle = {}   # inloggningsnyckel -> lista med vilande PooledConnection
+        self._slots = {}  # (server, port) -> semafor som begränsar antalet samtidiga anslutningar
+        self._in_use = 0
+        self._keepalive_thread = None
+        self.stats = {'hits': 0, 'selected_hits': 0, 'misses': 0, 'health_failures': 0,
+                      'discarded': 0, 'expired': 0, 'waits': 0, 'wait_timeouts': 0}
+
+    def _keys(self, cfg):
+        server = (cfg.get('imap_server', ''), str(cfg.get('imap_port', '')))
+        # Lösenordet ingår (hashat) så att ändrade inställningar ger nya sessioner
+        secret = hashlib.sha256(f"{cfg.get('email', '')}:{cfg.get('password', '')}".encode()).hexdigest()
+        return server, server + (secret,)
+
+    def _count(self, name):
+        # Räknarna ändras från förfrågningar, synkarbetare och keepalive-tråden samtidigt
+        with self._lock: self.stats[name] += 1
+
+    def _slot(self, server):
+        with self._lock:
+            if server not in self._slots:
+                self._slots[server] = threading.BoundedSemaphore(self.max_per_server)
+            return self._slots[server]
+
+    def _take_idle(self, key, folder):
+        """ Plocka en vilande anslutning, helst en som redan har rätt mapp vald """
+        with self._lock:
+            conns = self._idle.get(key, [])
+            if not conns: return None, False
+            if folder:
+                for i, pc in enumerate(conns):
+                    if pc.selected_folder() == folder:
+                        return conns.pop(i), True
+            # Senast använda först (varmast anslutning)
+            return conns.pop(), False
+
+    def _start_keepalive(self):
+        with self._lock:
+            if self._keepalive_thread and self._keepalive_thread.is_alive(): return
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, daemon=True)
+            self._keepalive_thread.start()
+
+    def _keepalive_loop(self):
+        while True:
+            time.sleep(IMAP_POOL_KEEPALIVE)
+            now = time.time()
+            with self._lock:
+                candidates = []
+                for key, conns in self._idle.items():
+                    keep = []
+                    for pc in conns:
+                        if now - pc.last_used >= IMAP_POOL_KEEPALIVE: candidates.append(pc)
+                        else: keep.append(pc)
+                    self._idle[key] = keep
+
+            # NOOP/stängning utanför låset så att utlåning inte blockeras av nätverket
+            survivors = []
+            for pc in candidates:
+                if now - pc.last_used > IMAP_POOL_MAX_IDLE:
+                    pc.close()
+                    self._count('expired')
+                elif pc.is_alive():
+                    survivors.append(pc)
+                else:
+                    pc.close()
+                    self._count('health_failures')
+
+            with self._lock:
+                for pc in survivors:
+                    self._idle.setdefault(pc.key, []).append(pc)
+
+    def acquire(self, folder=None):
+        cfg = load_settings()
+        server, key = self._keys(cfg)
+        slot = self._slot(server)
+        if not slot.acquire(blocking=False):
+            self._count('waits')
+            if not slot.acquire(timeout=IMAP_POOL_WAIT_TIMEOUT):
+                self._count('wait_timeouts')
+                raise TimeoutError(f"Ingen ledig IMAP-anslutning till {server[0]} inom {IMAP_POOL_WAIT_TIMEOUT}s")
+
+        try:
+            pc = None
+            while True:
+                pc, selected = self._take_idle(key, folder)
+                if not pc: break
+                # Hälsokontroll om anslutningen vilat länge eller senaste användningen gick fel
+                if pc.suspect or time.time() - pc.last_used > IMAP_POOL_HEALTHCHECK_AFTER:
+                    if not pc.is_alive():
+                        self._count('health_failures')
+                        pc.close()
+                        continue
+                    pc.suspect = False
+                self._count('hits')
+                if selected: self._count('selected_hits')
+                break
+
+            if not pc:
+                # Automatisk (om)inloggning när poolen är tom eller alla sessioner var döda
+                self._count('misses')
+                pc = PooledConnection(key, get_mailbox())
+
+            if folder and pc.selected_folder() != folder:
+                pc.mb.folder.set(folder)
+        except Exception:
+            if pc: pc.close()
+            slot.release()
+            raise
+
+        with self._lock: self._in_use += 1
+        self._start_keepalive()
+        return pc
+
+    def release(self, pc, error=None):
+        server = pc.key[:2]
+        try:
+            if isinstance(error, (imaplib.IMAP4.abort, OSError)):
+                # Trasig anslutning (EOF, timeout, socket-fel) - släng den
+                pc.close()
+                self._count('discarded')
+            else:
+                pc.suspect = error is not None
+                pc.last_used = time.time()
+                pc.mb.client.untagged_responses.clear()
+                with self._lock:
+                    self._idle.setdefault(pc.key, []).append(pc)
+        finally:
+            with self._lock: self._in_use -= 1
+            self._slot(server).release()
+
+    def close_all(self):
+        with self._lock:
+            conns = [pc for lst in self._idle.values() for pc in lst]
+            self._idle = {}
+        for pc in conns: pc.close()
+
+    def get_stats(self):
+        with self._lock:
+            idle = sum(len(lst) for lst in self._idle.values())
+            data = dict(self.stats, idle=idle, in_use=self._in_use, max_per_server=self.max_per_server)
+        lookups = data['hits'] + data['misses']
+        data['hit_rate'] = round(data['hits'] / lookups, 3) if lookups else 0.0
+        return data
+
+imap_pool = ImapPool()
+
+@contextmanager
+def imap_session(folder=None):
+    """ Låna en inloggad IMAP-session från poolen (med mappen redan vald om folder anges) """
+    pc = imap_pool.acquire(folder)
+    try:
+        yield pc.mb
+    except BaseException as e:
+        imap_pool.release(pc, e)
+        raise
+    else:
+        imap_pool.release(pc)
+
+def parse_uid_set(text):
+    """ Expandera en IMAP sekvensmängd (t.ex. '1:3,7') till en mängd UIDs """
+    uids = set()
+    for part in (text or '').split(','):
+        part = part.strip()
+        if not part: continue
+        if ':' in part:
+            a, b = part.split(':', 1)
+            if not a.isdigit() or not b.isdigit(): continue
+            lo, hi = sorted((int(a), int(b)))
+            uids.update(range(lo, hi + 1))
+        elif part.isdigit():
+            uids.add(int(part))
+    return uids
+
+def expand_uid_set(text):
+    """ Som parse_uid_set men behåller ordningen (behövs för att para ihop COPYUID-mängder) """
+    uids = []
+    for part in (text or '').split(','):
+        part = part.strip()
+        if ':' in part:
+            a, b = part.split(':', 1)
+            if not a.isdigit() or not b.isdigit(): continue
+            a, b = int(a), int(b)
+            uids.extend(range(a, b + 1) if a <= b else range(a, b - 1, -1))
+        elif part.isdigit():
+            uids.append(int(part))
+    return uids
+
+def _untagged_int(client, name):
+    data = client.untagged_responses.get(name)
+    if not data: return None
+    try: return int(data[-1].split()[0])
+    except (ValueError, IndexError, AttributeError): return None
+
+def _parse_flag_fetches(items):
+    """ Tolka FETCH-svar med UID och FLAGS till {uid: [flaggor]} """
+    result = {}
+    for item in items or []:
+        if isinstance(item, tuple): item = item[0]
+        if not isinstance(item, bytes): continue
+        text = item.decode('utf-8', 'ignore')
+        m_uid = re.search(r'UID (\d+)', text)
+        m_flags = re.search(r'FLAGS \(([^)]*)\)', text)
+        if m_uid and m_flags:
+            result[int(m_uid.group(1))] = m_flags.group(1).split()
+    return result
+
+def get_folder_sync_state(folder):
+    with db_session(readonly=True) as conn:
+        row = conn.execute("SELECT uidvalidity, uidnext, highestmodseq FROM folder_sync_state WHERE folder=?", (folder,)).fetchone()
+    if not row: return None
+    return {'uidvalidity': row[0], 'uidnext': row[1], 'highestmodseq': row[2]}
+
+def save_folder_sync_state(folder, uidvalidity, uidnext, highestmodseq):
+    row = (folder, uidvalidity, uidnext, highestmodseq, time.time())
+    db_write(lambda conn: conn.execute("INSERT OR REPLACE INTO folder_sync_state (folder, uidvalidity, uidnext, highestmodseq, updated_at) VALUES (?,?,?,?,?)", row))
+
+def imap_folder_changes(mb, folder, state):
+    """
+    Välj mappen och ta reda på vad som ändrats sedan förra synken.
+    Med CONDSTORE/QRESYNC räcker några få kommandon oavsett mappens storlek:
+    nya UIDs (UID SEARCH från UIDNEXT), ändrade flaggor (CHANGEDSINCE) och raderade UIDs (VANISHED).
+    Returnerar mode='full' när servern saknar stöd eller UIDVALIDITY har ändrats.
+    """
+    client = mb.client
+    ext = getattr(mb, 'zalaso_extensions', set())
+    can_resync = bool(state and state.get('uidvalidity') and state.get('highestmodseq'))
+
+    args = []
+    if 'QRESYNC' in ext and can_resync:
+        args = [f"(QRESYNC ({state['uidvalidity']} {state['highestmodseq']}))"]
+    elif 'CONDSTORE' in ext and 'QRESYNC' not in ext:
+        args = ['(CONDSTORE)']
+
+    client.untagged_responses.clear()
+    typ, data = client._simple_command('SELECT', encode_folder(folder), *args)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"SELECT {folder} misslyckades: {data}")
+    # Håll imaplib/imap_tools (och poolen) informerade om att mappen nu är vald
+    client.state = 'SELECTED'
+    mb.folder._current_folder = folder
+
+    info = {
+        'uidvalidity': _untagged_int(client, 'UIDVALIDITY'),
+        'uidnext': _untagged_int(client, 'UIDNEXT'),
+        'highestmodseq': None if 'NOMODSEQ' in client.untagged_responses else _untagged_int(client, 'HIGHESTMODSEQ'),
+        'exists': _untagged_int(client, 'EXISTS') or 0,
+        'mode': 'full', 'new_uids': set(), 'vanished': set(), 'flags': {}, 'vanished_known': False
+    }
+
+    if not state or state.get('uidvalidity') != info['uidvalidity'] or not info['uidvalidity']:
+        info['uidvalidity_changed'] = bool(state and state.get('uidvalidity') and state.get('uidvalidity') != info['uidvalidity'])
+        return info
+    if not info['highestmodseq'] or not state.get('highestmodseq'):
+        return info
+
+    info['mode'] = 'incremental'
+    qresync = 'QRESYNC' in ext and can_resync
+
+    if qresync:
+        # QRESYNC levererar raderade UIDs och ändrade flaggor direkt i SELECT-svaret
+        for item in client.untagged_responses.get('VANISHED', []):
+            text = item.decode('utf-8', 'ignore') if isinstance(item, bytes) else ''
+            info['vanished'].update(parse_uid_set(text.replace('(EARLIER)', '').strip()))
+        info['flags'] = _parse_flag_fetches(client.untagged_responses.get('FETCH', []))
+        info['vanished_known'] = True
+    elif info['highestmodseq'] > state['highestmodseq']:
+        typ, items = client.uid('FETCH', '1:*', '(UID FLAGS)', f"(CHANGEDSINCE {state['highestmodseq']})")
+        if typ == 'OK': info['flags'] = _parse_flag_fetches(items)
+
+    # Nya mail: allt från förra UIDNEXT (n:* returnerar alltid minst det sista mailet, filtrera därför)
+    last_next = state.get('uidnext') or 1
+    if info['uidnext'] is None or info['uidnext'] > last_next:
+        typ, items = client.uid('SEARCH', f'UID {last_next}:*')
+        if typ == 'OK' and items and items[0]:
+            info['new_uids'] = {int(u) for u in items[0].split() if int(u) >= last_next}
+    return info
 
 def parse_folder(name, t):
     n = name.lower()
@@ -460,65 +1450,738 @@ def parse_folder(name, t):
 
 DB_FILE = get_data_path('zalaso.db')
 
-def init_db():
-    with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-        conn.execute('PRAGMA journal_mode=WAL')
-        conn.execute('''CREATE TABLE IF NOT EXISTS emails (
-            uid INTEGER, folder TEXT, subject TEXT, sender TEXT, 
-            body TEXT, html TEXT, date_iso TEXT, date_str TEXT, attachments TEXT,
-            PRIMARY KEY(uid, folder)
-        )''')
-        conn.execute('''CREATE TABLE IF NOT EXISTS local_folders (name TEXT PRIMARY KEY)''')
-        conn.execute('''CREATE TABLE IF NOT EXISTS contacts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT,
-            email TEXT UNIQUE
-        )''')
-        conn.execute('''CREATE TABLE IF NOT EXISTS rules (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            keyword TEXT,
-            target_folder TEXT
-        )''')
-        conn.execute('''CREATE TABLE IF NOT EXISTS labels (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT,
-            color TEXT,
-            keyword TEXT,
-            check_field TEXT DEFAULT "subject"
-        )''')
+# SQLite-anslutningspool: pragman sätts och förberedda satser cachas en gång per anslutning i stället för
+# connect/stäng vid varje anrop. Flask kör varje anrop i en ny tråd, så poolen delas av hela processen;
+# varje utlåning får en egen anslutning och nästlade db_session() beter sig som tidigare separata connect().
+DB_POOL_MAX_IDLE = 8            # Vilande anslutningar som sparas per läge (skriv/läs)
+DB_BUSY_TIMEOUT_MS = 30000
+DB_CACHED_STATEMENTS = 256
+DB_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",    # Säkert med WAL: en krasch kan tappa senaste commit men inte korrumpera databasen
+    "PRAGMA cache_size=-16000",     # 16 MB sidcache per anslutning
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+)
+
+class DbPool:
+    """ Pool med SQLite-anslutningar per databasfil; läsanslutningar (readonly) har query_only påslaget """
+
+    def __init__(self, max_idle=DB_POOL_MAX_IDLE):
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = {}   # (databasfil, readonly) -> lista med vilande anslutningar
+        self._in_use = 0
+        self.stats = {'hits': 0, 'misses': 0, 'discarded': 0}
+
+    def _connect(self, path, readonly):
+        conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        if readonly: conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def acquire(self, readonly=False):
+        # DB_FILE läses vid utlåning (mätningar och tester byter fil under körning)
+        key = (DB_FILE, bool(readonly))
+        with self._lock:
+            conns = self._idle.get(key)
+            conn = conns.pop() if conns else None
+            self.stats['hits' if conn else 'misses'] += 1
+            self._in_use += 1
+        if conn is None:
+            try: conn = self._connect(*key)
+            except BaseException:
+                with self._lock: self._in_use -= 1
+                raise
+        return key, conn
+
+    def release(self, key, conn):
+        # En anslutning lämnas aldrig tillbaka med öppen transaktion eller ändrad row_factory
+        keep = True
         try:
-            conn.execute('ALTER TABLE emails ADD COLUMN recipients TEXT')
+            if conn.in_transaction: conn.rollback()
+            conn.row_factory = None
+        except Exception: keep = False
+        with self._lock:
+            self._in_use -= 1
+            conns = self._idle.setdefault(key, [])
+            if keep and key[0] == DB_FILE and len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+            self.stats['discarded'] += 1
+        conn.close()
+
+    def close_all(self):
+        """ Stäng vilande anslutningar (databasfilen har bytts ut eller återskapats) """
+        with self._lock:
+            conns = [c for idle in self._idle.values() for c in idle]
+            self._idle.clear()
+        for conn in conns:
+            try: conn.close()
+            except Exception: pass
+
+    def get_stats(self):
+        with self._lock:
+            data = dict(self.stats, idle=sum(len(c) for c in self._idle.values()), in_use=self._in_use, max_idle=self.max_idle)
+        lookups = data['hits'] + data['misses']
+        data['hit_rate'] = round(data['hits'] / lookups, 3) if lookups else 0.0
+        return data
+
+db_pool = DbPool()
+
+@contextmanager
+def db_session(readonly=False):
+    """ Låna en anslutning ur poolen. Som with sqlite3.connect(...): commit vid lyckat slut, rollback vid fel. """
+    key, conn = db_pool.acquire(readonly)
+    try:
+        yield conn
+        if conn.in_transaction: conn.commit()
+    finally:
+        db_pool.release(key, conn)
+
+# Schemamigreringar: numrerade i ordning, versionen sparas i PRAGMA user_version. Varje migrering körs i
+# en egen transaktion tillsammans med sin version, så en avbruten uppgradering börjar om på samma steg.
+# Databaser från före versionsnumreringen har user_version 0 och delvis befintligt schema, därför är
+# varje steg idempotent (IF NOT EXISTS, ALTER TABLE i try). Nya ändringar läggs till sist i SCHEMA_MIGRATIONS.
+def migrate_base(conn):
+    """ 1: grundtabellerna, kolumner som tillkommit över tid och fulltextindexet """
+    conn.execute('''CREATE TABLE IF NOT EXISTS emails (
+        uid INTEGER, folder TEXT, subject TEXT, sender TEXT, 
+        body TEXT, html TEXT, date_iso TEXT, date_str TEXT, attachments TEXT,
+        PRIMARY KEY(uid, folder)
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS local_folders (name TEXT PRIMARY KEY)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS contacts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        email TEXT UNIQUE
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS rules (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        keyword TEXT,
+        target_folder TEXT
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS labels (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        color TEXT,
+        keyword TEXT,
+        check_field TEXT DEFAULT "subject"
+    )''')
+    try:
+        conn.execute('ALTER TABLE emails ADD COLUMN recipients TEXT')
+    except: pass
+    try:
+        conn.execute('ALTER TABLE rules ADD COLUMN check_field TEXT DEFAULT "subject"')
+    except: pass
+    try:
+        conn.execute('ALTER TABLE emails ADD COLUMN labels TEXT')
+    except: pass
+    try:
+        conn.execute('ALTER TABLE emails ADD COLUMN is_draft INTEGER DEFAULT 0')
+    except: pass
+    try:
+        conn.execute('ALTER TABLE emails ADD COLUMN seen INTEGER DEFAULT 0')
+    except: pass
+    try:
+        conn.execute('ALTER TABLE emails ADD COLUMN flagged INTEGER DEFAULT 0')
+    except: pass
+    try:
+        conn.execute('ALTER TABLE emails ADD COLUMN sender_email TEXT')
+    except: pass
+    conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(subject, sender, body, content='emails', content_rowid='rowid')''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_ai AFTER INSERT ON emails BEGIN
+        INSERT INTO emails_fts(rowid, subject, sender, body) VALUES (new.rowid, new.subject, new.sender, new.body);
+    END;''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_ad AFTER DELETE ON emails BEGIN
+        INSERT INTO emails_fts(emails_fts, rowid, subject, sender, body) VALUES('delete', old.rowid, old.subject, old.sender, old.body);
+    END;''')
+    # FTS-raden behöver bara skrivas om när indexerade kolumner ändras (inte vid läst/stjärna/flytt)
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name='emails_au'").fetchone()
+    if row and 'UPDATE OF' not in row[0]:
+        conn.execute('DROP TRIGGER emails_au')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_au AFTER UPDATE OF subject, sender, body ON emails BEGIN
+        INSERT INTO emails_fts(emails_fts, rowid, subject, sender, body) VALUES('delete', old.rowid, old.subject, old.sender, old.body);
+        INSERT INTO emails_fts(rowid, subject, sender, body) VALUES (new.rowid, new.subject, new.sender, new.body);
+    END;''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS folder_sync_state (
+        folder TEXT PRIMARY KEY,
+        uidvalidity INTEGER,
+        uidnext INTEGER,
+        highestmodseq INTEGER,
+        updated_at REAL
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS app_state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )''')
+    migrate_status_files(conn)
+
+def migrate_listing_indexes(conn):
+    """ 2: index för listningar, Fas 2 i synken och avsändaråtgärder samt kolumnerna för sanerad html """
+    # Listningens ordning (date_iso DESC, uid DESC) i sin helhet, så att markören i /api/threads blir en indexsökning.
+    # Ersätter idx_emails_folder_date (folder, date_iso DESC) som är ett prefix av detta
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_folder_listing ON emails(folder, date_iso DESC, uid DESC)''')
+    conn.execute('''DROP INDEX IF EXISTS idx_emails_folder_date''')
+    # Partiellt index över mail som saknar kropp (Fas 2 i synken), så att synken slipper läsa html för hela mappen
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_folder_nobody ON emails(folder, uid) WHERE html IS NULL OR html = ''")
+    # Sanerad html och förhandsvisning beräknas vid inläsning (sanitize_message); versionen styr omsanering
+    for col in ("html_safe TEXT", "snippet TEXT", "sanitizer_version INTEGER DEFAULT 0"):
+        try: conn.execute(f"ALTER TABLE emails ADD COLUMN {col}")
         except: pass
-        try:
-            conn.execute('ALTER TABLE rules ADD COLUMN check_field TEXT DEFAULT "subject"')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_sanitizer ON emails(sanitizer_version) WHERE html IS NOT NULL AND html != ''")
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_folder_seen ON emails(folder, seen)''')
+    # Normaliserad avsändaradress (gemener, utan namn) för avsändaråtgärder; äldre rader fylls av bakgrundssteget sender_email
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_sender_email ON emails(sender_email, folder)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_flagged ON emails(folder, uid) WHERE flagged = 1''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_starred ON emails(date_iso DESC, uid DESC) WHERE flagged = 1''')
+
+def migrate_labels(conn):
+    """ 3: etikett-medlemskap som egen tabell (ersätter JSON-listan i emails.labels) """
+    conn.execute('''CREATE TABLE IF NOT EXISTS email_labels (
+        email_rowid INTEGER NOT NULL,
+        label_id INTEGER NOT NULL,
+        PRIMARY KEY(email_rowid, label_id)
+    ) WITHOUT ROWID''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_email_labels_label ON email_labels(label_id, email_rowid)''')
+    conn.execute('''DROP INDEX IF EXISTS idx_emails_labels''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS label_backfill (
+        label_id INTEGER PRIMARY KEY,
+        last_rowid INTEGER DEFAULT 0,
+        max_rowid INTEGER DEFAULT 0,
+        matched INTEGER DEFAULT 0,
+        status TEXT,
+        started_at REAL,
+        updated_at REAL
+    )''')
+    migrate_label_column(conn)
+
+def migrate_attachments(conn):
+    """ 4: bilagemetadata per MIME-del och det innehållsadresserade bilagelagret """
+    attachments_existed = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='attachments'").fetchone()
+    conn.execute('''CREATE TABLE IF NOT EXISTS attachments (
+        email_rowid INTEGER NOT NULL,
+        part_id TEXT NOT NULL,
+        filename TEXT COLLATE NOCASE,
+        ext TEXT,
+        content_type TEXT,
+        size INTEGER,
+        is_inline INTEGER DEFAULT 0,
+        content_hash TEXT,
+        content_id TEXT,
+        encoding TEXT,
+        PRIMARY KEY(email_rowid, part_id)
+    ) WITHOUT ROWID''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_attachments_ext ON attachments(ext, size)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_attachments_filename ON attachments(filename)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_attachments_size ON attachments(size)''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_attachments_ad AFTER DELETE ON emails BEGIN
+        DELETE FROM attachments WHERE email_rowid = old.rowid;
+    END;''')
+    if not attachments_existed:
+        migrate_attachment_json(conn)
+    conn.execute('''CREATE TABLE IF NOT EXISTS attachment_blobs (
+        content_hash TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        last_access REAL NOT NULL
+    ) WITHOUT ROWID''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_attachment_blobs_access ON attachment_blobs(last_access)''')
+    try: conn.execute("ALTER TABLE attachment_blobs ADD COLUMN content_type TEXT")
+    except: pass
+    # pinned: inline-bilder flyttade ur html-kolumnen kan inte hämtas om från servern och rensas därför aldrig
+    try: conn.execute("ALTER TABLE attachment_blobs ADD COLUMN pinned INTEGER DEFAULT 0")
+    except: pass
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_attachments_hash ON attachments(content_hash) WHERE content_hash IS NOT NULL")
+
+def migrate_threads(conn):
+    """ 5: trådning (se thread_messages). message_id NULL = rubrikerna inte hämtade än, '' = saknas i mailet """
+    for col in ("message_id TEXT", "in_reply_to TEXT", "refs TEXT", "thread_id INTEGER"):
+        try: conn.execute(f"ALTER TABLE emails ADD COLUMN {col}")
         except: pass
+    conn.execute('''CREATE TABLE IF NOT EXISTS threads (
+        id INTEGER PRIMARY KEY,
+        subject TEXT,
+        subject_key TEXT,
+        last_date TEXT,
+        message_count INTEGER DEFAULT 0,
+        unread_count INTEGER DEFAULT 0,
+        participants TEXT
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS thread_message_ids (
+        message_id TEXT PRIMARY KEY,
+        thread_id INTEGER
+    ) WITHOUT ROWID''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_thread_message_ids_thread ON thread_message_ids(thread_id)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_threads_subject ON threads(subject_key, last_date)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_thread ON emails(thread_id, date_iso)''')
+    # Mappvyn grupperar på tråd direkt ur indexet
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_folder_thread ON emails(folder, thread_id, date_iso, uid)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_unthreaded ON emails(date_iso) WHERE thread_id IS NULL''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_no_message_id ON emails(folder, uid) WHERE message_id IS NULL''')
+    # Trådräknare: varje ändring av thread_id, seen, date_iso eller radering av en trådad rad
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_threads_ai AFTER INSERT ON emails WHEN new.thread_id IS NOT NULL BEGIN
+        UPDATE threads SET message_count = message_count + 1, unread_count = unread_count + (COALESCE(new.seen, 0) = 0),
+            last_date = CASE WHEN last_date IS NULL OR new.date_iso > last_date THEN new.date_iso ELSE last_date END
+        WHERE id = new.thread_id;
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_threads_ad AFTER DELETE ON emails WHEN old.thread_id IS NOT NULL BEGIN
+        UPDATE threads SET message_count = message_count - 1, unread_count = unread_count - (COALESCE(old.seen, 0) = 0),
+            last_date = (SELECT MAX(date_iso) FROM emails WHERE thread_id = old.thread_id)
+        WHERE id = old.thread_id;
+        DELETE FROM threads WHERE id = old.thread_id AND message_count <= 0;
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_threads_au_thread AFTER UPDATE OF thread_id ON emails WHEN old.thread_id IS NOT new.thread_id BEGIN
+        UPDATE threads SET message_count = message_count - 1, unread_count = unread_count - (COALESCE(old.seen, 0) = 0),
+            last_date = (SELECT MAX(date_iso) FROM emails WHERE thread_id = old.thread_id)
+        WHERE id = old.thread_id;
+        DELETE FROM threads WHERE id = old.thread_id AND message_count <= 0;
+        UPDATE threads SET message_count = message_count + 1, unread_count = unread_count + (COALESCE(new.seen, 0) = 0),
+            last_date = CASE WHEN last_date IS NULL OR new.date_iso > last_date THEN new.date_iso ELSE last_date END
+        WHERE id = new.thread_id;
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_threads_au_seen AFTER UPDATE OF seen ON emails
+        WHEN new.thread_id IS NOT NULL AND old.thread_id IS new.thread_id AND COALESCE(old.seen, 0) != COALESCE(new.seen, 0) BEGIN
+        UPDATE threads SET unread_count = unread_count + (COALESCE(new.seen, 0) = 0) - (COALESCE(old.seen, 0) = 0) WHERE id = new.thread_id;
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_threads_au_date AFTER UPDATE OF date_iso ON emails
+        WHEN new.thread_id IS NOT NULL AND old.thread_id IS new.thread_id AND old.date_iso IS NOT new.date_iso BEGIN
+        UPDATE threads SET last_date = (SELECT MAX(date_iso) FROM emails WHERE thread_id = new.thread_id) WHERE id = new.thread_id;
+    END''')
+
+def migrate_counters(conn):
+    """ 6: räknare per mapp och etikett (se get_counts). Hålls aktuella av triggrar i samma transaktion som ändringen:
+        synk, läst/stjärna, flytt och radering. server_*: senaste STATUS från servern (reconcile_folder_counts) """
+    counters_existed = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='folder_counts'").fetchone()
+    conn.execute('''CREATE TABLE IF NOT EXISTS folder_counts (
+        folder TEXT PRIMARY KEY,
+        total INTEGER NOT NULL DEFAULT 0,
+        unread INTEGER NOT NULL DEFAULT 0,
+        flagged INTEGER NOT NULL DEFAULT 0,
+        server_total INTEGER,
+        server_unread INTEGER,
+        status_at REAL
+    ) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS label_counts (
+        label_id INTEGER PRIMARY KEY,
+        total INTEGER NOT NULL DEFAULT 0,
+        unread INTEGER NOT NULL DEFAULT 0
+    )''')
+    # Etikettens räknare läser mailets seen; dra av det olästa innan kopplingarna tas bort
+    for name in ('emails_labels_ad', 'labels_ad'):
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name=?", (name,)).fetchone()
+        if row and 'label_counts' not in row[0]:
+            conn.execute(f'DROP TRIGGER {name}')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_labels_ad AFTER DELETE ON emails BEGIN
+        UPDATE label_counts SET unread = unread - 1
+        WHERE COALESCE(old.seen, 0) = 0 AND label_id IN (SELECT label_id FROM email_labels WHERE email_rowid = old.rowid);
+        DELETE FROM email_labels WHERE email_rowid = old.rowid;
+    END;''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS labels_ad AFTER DELETE ON labels BEGIN
+        DELETE FROM email_labels WHERE label_id = old.id;
+        DELETE FROM label_counts WHERE label_id = old.id;
+    END;''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_counts_ai AFTER INSERT ON emails WHEN new.folder IS NOT NULL BEGIN
+        INSERT INTO folder_counts(folder, total, unread, flagged) VALUES (new.folder, 1, COALESCE(new.seen, 0) = 0, COALESCE(new.flagged, 0) != 0)
+        ON CONFLICT(folder) DO UPDATE SET total = total + 1, unread = unread + excluded.unread, flagged = flagged + excluded.flagged;
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_counts_ad AFTER DELETE ON emails WHEN old.folder IS NOT NULL BEGIN
+        UPDATE folder_counts SET total = total - 1, unread = unread - (COALESCE(old.seen, 0) = 0), flagged = flagged - (COALESCE(old.flagged, 0) != 0)
+        WHERE folder = old.folder;
+    END''')
+    # Flytt, läst och stjärna: ta bort den gamla radens bidrag och lägg till den nyas
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_counts_au AFTER UPDATE OF folder, seen, flagged ON emails
+        WHEN old.folder IS NOT new.folder OR (COALESCE(old.seen, 0) = 0) != (COALESCE(new.seen, 0) = 0)
+            OR (COALESCE(old.flagged, 0) != 0) != (COALESCE(new.flagged, 0) != 0) BEGIN
+        UPDATE folder_counts SET total = total - 1, unread = unread - (COALESCE(old.seen, 0) = 0), flagged = flagged - (COALESCE(old.flagged, 0) != 0)
+        WHERE folder = old.folder;
+        INSERT INTO folder_counts(folder, total, unread, flagged) SELECT new.folder, 1, COALESCE(new.seen, 0) = 0, COALESCE(new.flagged, 0) != 0
+        WHERE new.folder IS NOT NULL
+        ON CONFLICT(folder) DO UPDATE SET total = total + 1, unread = unread + excluded.unread, flagged = flagged + excluded.flagged;
+        UPDATE label_counts SET unread = unread + (COALESCE(new.seen, 0) = 0) - (COALESCE(old.seen, 0) = 0)
+        WHERE (COALESCE(old.seen, 0) = 0) != (COALESCE(new.seen, 0) = 0)
+            AND label_id IN (SELECT label_id FROM email_labels WHERE email_rowid = new.rowid);
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS email_labels_counts_ai AFTER INSERT ON email_labels BEGIN
+        INSERT INTO label_counts(label_id, total, unread)
+        SELECT new.label_id, 1, COALESCE((SELECT COALESCE(seen, 0) = 0 FROM emails WHERE rowid = new.email_rowid), 0) WHERE true
+        ON CONFLICT(label_id) DO UPDATE SET total = total + 1, unread = unread + excluded.unread;
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS email_labels_counts_ad AFTER DELETE ON email_labels BEGIN
+        UPDATE label_counts SET total = total - 1,
+            unread = unread - COALESCE((SELECT COALESCE(seen, 0) = 0 FROM emails WHERE rowid = old.email_rowid), 0)
+        WHERE label_id = old.label_id;
+    END''')
+    if not counters_existed:
+        rebuild_counts(conn)
+
+def migrate_timestamps(conn):
+    """ 7: emails.ts (UTC-epoch, se date_ts) och listningsindexen på ts. Befintliga rader fylls av bakgrundssteget ts. """
+    try: conn.execute("ALTER TABLE emails ADD COLUMN ts INTEGER")
+    except: pass
+    # Ersätter indexen på date_iso för listning, stjärnmärkta och mappvyns trådgruppering
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_folder_ts ON emails(folder, ts DESC, uid DESC)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_thread_ts ON emails(thread_id, ts)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_folder_thread_ts ON emails(folder, thread_id, ts, uid)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_starred_ts ON emails(ts DESC, uid DESC) WHERE flagged = 1''')
+    for name in ('idx_emails_folder_listing', 'idx_emails_folder_thread', 'idx_emails_starred'):
+        conn.execute(f'DROP INDEX IF EXISTS {name}')
+
+SCHEMA_MIGRATIONS = [migrate_base, migrate_listing_indexes, migrate_labels, migrate_attachments, migrate_threads, migrate_counters,
+                     migrate_timestamps]
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+schema_lock = threading.Lock()
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def init_db():
+    """ Skapa databasen eller uppgradera den till SCHEMA_VERSION. Körs vid start (och av ensure_db om filen
+        raderats); låset hindrar att två anrop kör samma migrering samtidigt. """
+    with schema_lock:
+        conn = sqlite3.connect(DB_FILE, timeout=30.0, isolation_level=None)
         try:
-            conn.execute('ALTER TABLE emails ADD COLUMN labels TEXT')
-        except: pass
+            conn.execute('PRAGMA journal_mode=WAL')
+            version = schema_version(conn)
+            fresh = not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='emails'").fetchone()
+            for number, migration in enumerate(SCHEMA_MIGRATIONS[version:], version + 1):
+                started = time.time()
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    migration(conn)
+                    conn.execute(f'PRAGMA user_version = {number}')
+                    conn.execute('COMMIT')
+                except:
+                    conn.execute('ROLLBACK')
+                    raise
+                if not fresh: log_event(f"Databasen migrerad till version {number} ({migration.__name__}, {time.time() - started:.1f} s)")
+        finally:
+            conn.close()
+        # Schemat är på plats; require_login behöver inte fråga databasen igen för den här filen
+        db_checked['key'] = _db_key()
+
+# Synk-schemaläggare: ett fast antal arbetstrådar i stället för en ny tråd per sidladdning/åtgärd.
+# Jobb nycklas (t.ex. per mapp) så att dubbletter slås ihop, och ett jobb som begärs medan det
+# redan körs körs en gång till efteråt så att ändringar som kom under synken inte missas.
+SYNC_WORKERS = 3            # Färre än IMAP_POOL_MAX_PER_SERVER så att UI-anrop alltid får en anslutning
+SYNC_MIN_INTERVAL = 20      # Sekunder: en mapp som nyss synkats räknas som färsk vid sidladdning
+FIRST_SYNC_WAIT = 5         # Sekunder som sidladdningen väntar på första synken av en mapp som aldrig synkats
+FOLDER_SYNC_MIN_INTERVAL = 300
+PRIORITY_USER = 0           # Mappen användaren tittar på just nu
+PRIORITY_CHANGE = 1         # Servern (IDLE) eller en egen åtgärd har ändrat mappen
+PRIORITY_NORMAL = 5
+PRIORITY_BACKGROUND = 10
+
+class SyncScheduler:
+    def __init__(self, workers=SYNC_WORKERS):
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._heap = []             # (prioritet, löpnummer, nyckel)
+        self._seq = itertools.count()
+        self._queued = {}           # nyckel -> jobb som väntar
+        self._running = {}          # nyckel -> jobb som körs
+        self._rerun = {}            # nyckel -> jobb att köra igen när det pågående är klart
+        self._last_done = {}        # nyckel -> tidpunkt då jobbet senast blev klart
+        self._threads = []
+        self.stats = {'submitted': 0, 'coalesced': 0, 'skipped_fresh': 0,
+                      'reruns': 0, 'completed': 0, 'failed': 0}
+
+    def _ensure_workers(self):
+        # Körs med self._cond låst; trådarna startas först när det finns något att göra
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker_loop, name=f"sync-worker-{len(self._threads) + 1}", daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    def _push(self, key, job):
+        self._queued[key] = job
+        heapq.heappush(self._heap, (job['priority'], next(self._seq), key))
+        self._cond.notify()
+
+    def submit(self, key, fn, args=(), priority=PRIORITY_NORMAL, min_interval=0, force=False):
+        """ Köa ett jobb. Returnerar False om det hoppades över för att resultatet fortfarande är färskt. """
+        now = time.time()
+        with self._cond:
+            self._ensure_workers()
+            self.stats['submitted'] += 1
+            job = {'key': key, 'fn': fn, 'args': tuple(args), 'priority': priority, 'queued_at': now}
+
+            if key in self._running:
+                # Pågår redan: kör en gång till efteråt (flera begäranden slås ihop till en omkörning)
+                prev = self._rerun.get(key)
+                if prev: job['priority'] = min(prev['priority'], priority)
+                self._rerun[key] = job
+                self.stats['coalesced'] += 1
+                return True
+
+            queued = self._queued.get(key)
+            if queued:
+                # Redan i kön: höj bara prioriteten om den nya begäran är viktigare
+                if priority < queued['priority']:
+                    queued['priority'] = priority
+                    heapq.heappush(self._heap, (priority, next(self._seq), key))
+                self.stats['coalesced'] += 1
+                return True
+
+            if not force and min_interval and now - self._last_done.get(key, 0) < min_interval:
+                self.stats['skipped_fresh'] += 1
+                return False
+
+            self._push(key, job)
+            return True
+
+    def _next_job(self):
+        # Körs med self._cond låst. Heap-poster för jobb som fått ny prioritet ligger kvar och hoppas över här.
+        while True:
+            while self._heap:
+                priority, _, key = heapq.heappop(self._heap)
+                job = self._queued.get(key)
+                if job and job['priority'] == priority:
+                    del self._queued[key]
+                    return job
+            self._cond.wait()
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                job['started_at'] = time.time()
+                self._running[job['key']] = job
+            try:
+                job['fn'](*job['args'])
+                failed = False
+            except Exception as e:
+                failed = True
+                log_event(f"Schemalagt jobb {job['key']} misslyckades: {e}")
+            with self._cond:
+                key = job['key']
+                del self._running[key]
+                self._last_done[key] = time.time()
+                self.stats['failed' if failed else 'completed'] += 1
+                rerun = self._rerun.pop(key, None)
+                if rerun:
+                    self.stats['reruns'] += 1
+                    self._push(key, rerun)
+                self._cond.notify_all() # Väcker wait_idle (lediga arbetare somnar om i _next_job)
+
+    def is_busy(self, key):
+        with self._cond:
+            return key in self._running or key in self._queued
+
+    def wait_idle(self, key, timeout):
+        """ Vänta tills jobbet varken är köat eller körs. Returnerar False om timeout gick ut först. """
+        deadline = time.time() + timeout
+        with self._cond:
+            while key in self._running or key in self._queued:
+                remaining = deadline - time.time()
+                if remaining <= 0: return False
+                self._cond.wait(remaining)
+        return True
+
+    def get_status(self):
+        now = time.time()
+        with self._cond:
+            queued = sorted(self._queued.values(), key=lambda j: (j['priority'], j['queued_at']))
+            return {
+                'workers': self.workers,
+                'running': [{'key': j['key'], 'priority': j['priority'], 'seconds': round(now - j['started_at'], 1),
+                             'rerun_pending': j['key'] in self._rerun} for j in self._running.values()],
+                'queued': [{'key': j['key'], 'priority': j['priority'], 'waiting': round(now - j['queued_at'], 1)}
+                           for j in queued],
+                'last_done': {k: round(now - t, 1) for k, t in self._last_done.items()},
+                'stats': dict(self.stats),
+            }
+
+sync_scheduler = SyncScheduler()
+
+def schedule_sync(folder, priority=PRIORITY_NORMAL, force=False):
+    """ Köa synk av en mapp. Utan force hoppas mappen över om den synkats de senaste SYNC_MIN_INTERVAL sekunderna. """
+    if not folder: return False
+    return sync_scheduler.submit(f"sync:{folder}", sync_worker, (folder,), priority, SYNC_MIN_INTERVAL, force)
+
+def schedule_folder_structure_sync(force=False):
+    return sync_scheduler.submit("folders", sync_folder_structure, (), PRIORITY_BACKGROUND, FOLDER_SYNC_MIN_INTERVAL, force)
+
+def schedule_job(key, fn, args=(), priority=PRIORITY_BACKGROUND):
+    """ Köa ett övrigt bakgrundsjobb (prenumeration, flytt av befintliga mail, etiketter ...) """
+    return sync_scheduler.submit(key, fn, args, priority, force=True)
+
+# En enda skrivare: skrivningar köas som jobb fn(conn, *args) och körs av en tråd med egen anslutning, så att
+# synkar, etikett-backfill och användarens åtgärder inte står och väntar på varandras skrivlås (busy_timeout).
+# Jobben i kön slås ihop till en grupp som committas tillsammans (en fsync per grupp); varje jobb körs i en egen
+# SAVEPOINT så att ett fel bara rullar tillbaka det jobbet. Användarens skrivningar (PRIORITY_USER) går först
+# och får aldrig vänta på full kö; övriga väntar (mottryck) när kön har DB_WRITE_QUEUE_MAX jobb.
+DB_WRITE_QUEUE_MAX = 200
+DB_WRITE_BATCH = 64             # Max jobb per commit
+DB_WRITE_BATCH_SECONDS = 0.2    # Max tid en grupp håller skrivlåset innan den committas
+DB_WRITE_WAIT_TIMEOUT = 120     # Sekunder som db_write väntar på kö eller commit
+
+class DbWriter:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []             # (prioritet, löpnummer, jobb)
+        self._seq = itertools.count()
+        self._thread = None
+        self._conn = None
+        self._conn_key = None
+        self._hooks = []            # (efter commit, efter rollback) för jobbet som körs just nu
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'commits': 0, 'commit_failures': 0,
+                      'backpressure_waits': 0, 'max_depth': 0, 'max_batch': 0,
+                      'commit_ms_total': 0.0, 'commit_ms_max': 0.0, 'latency_ms_total': 0.0, 'latency_ms_max': 0.0}
+
+    def _ensure_thread(self):
+        # Körs med self._cond låst
+        if self._thread and self._thread.is_alive(): return
+        self._thread = threading.Thread(target=self._loop, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, args=(), priority=PRIORITY_NORMAL):
+        future = Future()
+        if threading.current_thread() is self._thread:
+            # Ett jobb som själv köar en skrivning: kör den direkt i den pågående gruppen
+            try: future.set_result(fn(self._conn, *args))
+            except Exception as e: future.set_exception(e)
+            return future
+        job = {'fn': fn, 'args': tuple(args), 'future': future, 'queued_at': time.perf_counter()}
+        with self._cond:
+            self._ensure_thread()
+            if priority > PRIORITY_USER and len(self._heap) >= DB_WRITE_QUEUE_MAX:
+                self.stats['backpressure_waits'] += 1
+                if not self._cond.wait_for(lambda: len(self._heap) < DB_WRITE_QUEUE_MAX, timeout=DB_WRITE_WAIT_TIMEOUT):
+                    raise TimeoutError(f"Skrivkön är full ({len(self._heap)} jobb)")
+            heapq.heappush(self._heap, (priority, next(self._seq), job))
+            self.stats['submitted'] += 1
+            self.stats['max_depth'] = max(self.stats['max_depth'], len(self._heap))
+            self._cond.notify_all()
+        return future
+
+    def on_commit(self, fn, rollback=None):
+        """ Kör fn när den pågående gruppen är committad, eller rollback om jobbet eller gruppen rullas tillbaka.
+            För sidoeffekter utanför databasen (filer, räknare i minnet). Utanför skrivartråden körs fn direkt. """
+        if threading.current_thread() is not self._thread:
+            fn()
+            return
+        self._hooks.append((fn, rollback))
+
+    def _take(self, block):
+        with self._cond:
+            while not self._heap:
+                if not block: return None
+                self._cond.wait()
+            job = heapq.heappop(self._heap)[2]
+            self._cond.notify_all()     # Plats i kön för den som väntar på mottryck
+            return job
+
+    def _connection(self):
+        # Ny anslutning om databasfilen bytts ut (ensure_db) eller DB_FILE ändrats
+        key = (DB_FILE, db_checked['key'])
+        if self._conn is None or self._conn_key != key:
+            if self._conn is not None:
+                try: self._conn.close()
+                except Exception: pass
+            # isolation_level=None: transaktionen styrs här (BEGIN IMMEDIATE/SAVEPOINT/COMMIT), inte av sqlite3-modulen
+            self._conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None, cached_statements=DB_CACHED_STATEMENTS)
+            for pragma in DB_PRAGMAS:
+                self._conn.execute(pragma)
+            self._conn_key = key
+        return self._conn
+
+    def _run(self, conn, job):
+        self._hooks = []
         try:
-            conn.execute('ALTER TABLE emails ADD COLUMN is_draft INTEGER DEFAULT 0')
-        except: pass
-        conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(subject, sender, body, content='emails', content_rowid='rowid')''')
-        conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_ai AFTER INSERT ON emails BEGIN
-            INSERT INTO emails_fts(rowid, subject, sender, body) VALUES (new.rowid, new.subject, new.sender, new.body);
-        END;''')
-        conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_ad AFTER DELETE ON emails BEGIN
-            INSERT INTO emails_fts(emails_fts, rowid, subject, sender, body) VALUES('delete', old.rowid, old.subject, old.sender, old.body);
-        END;''')
-        conn.execute('''CREATE TRIGGER IF NOT EXISTS emails_au AFTER UPDATE ON emails BEGIN
-            INSERT INTO emails_fts(emails_fts, rowid, subject, sender, body) VALUES('delete', old.rowid, old.subject, old.sender, old.body);
-            INSERT INTO emails_fts(rowid, subject, sender, body) VALUES (new.rowid, new.subject, new.sender, new.body);
-        END;''')
-        conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_folder_date ON emails(folder, date_iso DESC)''')
-        conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_labels ON emails(labels)''')
-
-sync_lock = threading.Lock()
-syncing_folders = set()
+            conn.execute("SAVEPOINT job")
+            try:
+                result = job['fn'](conn, *job['args'])
+            except Exception:
+                conn.execute("ROLLBACK TO job")
+                raise
+            finally:
+                conn.execute("RELEASE job")
+                conn.row_factory = None
+            return job, result, None, self._hooks
+        except Exception as e:
+            self._run_hooks(self._hooks, committed=False)
+            return job, None, e, []
+
+    def _run_hooks(self, hooks, committed):
+        for on_commit, on_rollback in hooks:
+            fn = on_commit if committed else on_rollback
+            if fn is None: continue
+            try: fn()
+            except Exception as e: log_event(f"Skrivarens efterjobb misslyckades: {e}")
+
+    def _loop(self):
+        while True:
+            job = self._take(block=True)
+            started = time.perf_counter()
+            try:
+                conn = self._connection()
+                conn.execute("BEGIN IMMEDIATE")
+            except Exception as e:
+                self._finish([(job, None, e, [])], started, e)
+                continue
+            done = []
+            while job:
+                done.append(self._run(conn, job))
+                if len(done) >= DB_WRITE_BATCH or time.perf_counter() - started >= DB_WRITE_BATCH_SECONDS: break
+                job = self._take(block=False)
+            commit_error = None
+            commit_started = time.perf_counter()
+            try: conn.execute("COMMIT")
+            except Exception as e:
+                commit_error = e
+                try: conn.execute("ROLLBACK")
+                except Exception: pass
+            self._finish(done, commit_started, commit_error)
+
+    def _finish(self, done, commit_started, commit_error):
+        now = time.perf_counter()
+        with self._cond:
+            self.stats['commits' if commit_error is None else 'commit_failures'] += 1
+            self.stats['max_batch'] = max(self.stats['max_batch'], len(done))
+            commit_ms = (now - commit_started) * 1000
+            self.stats['commit_ms_total'] += commit_ms
+            self.stats['commit_ms_max'] = max(self.stats['commit_ms_max'], commit_ms)
+            for job, _, error, _ in done:
+                latency_ms = (now - job['queued_at']) * 1000
+                self.stats['latency_ms_total'] += latency_ms
+                self.stats['latency_ms_max'] = max(self.stats['latency_ms_max'], latency_ms)
+                self.stats['failed' if error or commit_error else 'completed'] += 1
+        # Filer och räknare i minnet följer databasen: efterjobben körs när utfallet av gruppen är känt
+        for _, _, _, hooks in done:
+            self._run_hooks(hooks, committed=commit_error is None)
+        # Framtiderna avgörs först efter commit: den som väntar ser sina skrivningar i nästa läsning
+        for job, result, error, _ in done:
+            error = error or commit_error
+            if error: job['future'].set_exception(error)
+            else: job['future'].set_result(result)
+
+    def get_stats(self):
+        with self._cond:
+            data = dict(self.stats, depth=len(self._heap), queue_max=DB_WRITE_QUEUE_MAX)
+        jobs = data['completed'] + data['failed']
+        batches = data['commits'] + data['commit_failures']
+        data['latency_ms_avg'] = round(data['latency_ms_total'] / jobs, 2) if jobs else 0.0
+        data['commit_ms_avg'] = round(data['commit_ms_total'] / batches, 2) if batches else 0.0
+        data['jobs_per_commit'] = round(jobs / batches, 2) if batches else 0.0
+        return data
+
+db_writer = DbWriter()
+
+def db_write(fn, *args, priority=PRIORITY_NORMAL, wait=True):
+    """ Kör fn(conn, *args) i skrivartråden. Med wait väntar anroparen tills gruppen är committad (läser sedan sina
+        egna skrivningar) och får fn:s returvärde eller undantag; annars returneras en Future. fn får inte committa. """
+    future = db_writer.submit(fn, args, priority)
+    return future.result(timeout=DB_WRITE_WAIT_TIMEOUT) if wait else future
+
+def db_on_commit(fn, rollback=None):
+    """ Sidoeffekt i ett skrivjobb som bara ska ske om jobbet committas (se DbWriter.on_commit) """
+    db_writer.on_commit(fn, rollback)
 
 def sync_folder_structure():
     """ Hämta mappstruktur från servern och spara lokalt (för snabbare laddning) """
     try:
-        with get_mailbox() as mb:
+        with imap_session() as mb:
             # Loopia-fix: Subscribe
             try:
                 for f in mb.folder.list():
@@ -535,15 +2198,19 @@ def sync_folder_structure():
                 except: pass
             
             folder_names = [f.name for f in folders]
-            with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+            def save(conn):
                 conn.execute("DELETE FROM local_folders")
                 conn.executemany("INSERT INTO local_folders (name) VALUES (?)", [(n,) for n in folder_names])
+            db_write(save)
+        # Nya utkast-mappar kan ha dykt upp; se till att de bevakas
+        refresh_idle_watchers()
+        schedule_job('counts', reconcile_folder_counts)
     except Exception as e: log_event(f"Folder sync error: {e}")
 
 def subscribe_worker(folder_names=None):
     """ Bakgrundsjobb för att säkerställa att alla mappar är prenumererade (Loopia-fix) """
     try:
-        with get_mailbox() as mb:
+        with imap_session() as mb:
             if folder_names is None:
                 folder_names = [f.name for f in mb.folder.list()]
             
@@ -552,21 +2219,390 @@ def subscribe_worker(folder_names=None):
                 except: pass
     except Exception as e: log_event(f"Subscribe worker error: {e}")
 
+STATUS_PIPELINE = 50        # STATUS-kommandon som skickas innan svaren läses
+
+def imap_status_all(mb, folders):
+    """
+    STATUS (MESSAGES UNSEEN) för alla mappar i en omgång. Kommandona pipelinas (RFC 3501 5.5) i block om
+    STATUS_PIPELINE, så att 200 mappar kostar några rundresor i stället för 200. Returnerar {mapp: (messages, unseen)}.
+    """
+    client = mb.client
+    result = {}
+    for i in range(0, len(folders), STATUS_PIPELINE):
+        client.untagged_responses.pop('STATUS', None)
+        tags = [(f, client._command('STATUS', encode_folder(f), '(MESSAGES UNSEEN)')) for f in folders[i:i+STATUS_PIPELINE]]
+        for f, tag in tags:
+            # Servern svarar i tur och ordning: mappens STATUS-rad kommer före dess taggade OK
+            typ, _ = client._command_complete('STATUS', tag)
+            items = client.untagged_responses.pop('STATUS', [])
+            if typ != 'OK' or not items: continue
+            last = items[-1]
+            text = b' '.join(last) if isinstance(last, tuple) else last
+            m_total, m_unseen = re.search(rb'MESSAGES (\d+)', text), re.search(rb'UNSEEN (\d+)', text)
+            if m_total and m_unseen:
+                result[f] = (int(m_total.group(1)), int(m_unseen.group(1)))
+    return result
+
+def reconcile_folder_counts():
+    """
+    Stäm av räknarna mot serverns STATUS för alla mappar. En avvikande mapp räknas först om lokalt (ifall räknarna
+    drivit); kvarstår skillnaden är den lokala kopian inaktuell och mappen köas för synk. Mappar som aldrig
+    synkats hämtas inte, sidofältet visar serverns siffror för dem.
+    """
+    try:
+        with db_session(readonly=True) as conn:
+            folders = [r[0] for r in conn.execute("SELECT name FROM local_folders").fetchall()]
+        if not folders: return
+        with imap_session() as mb:
+            status = imap_status_all(mb, folders)
+        now = time.time()
+
+        def stale_folders(conn):
+            rows = conn.execute("""SELECT folder_counts.folder FROM folder_counts JOIN folder_sync_state ON folder_sync_state.folder = folder_counts.folder
+                WHERE status_at = ? AND (total != server_total OR unread != server_unread)""", (now,)).fetchall()
+            return [r[0] for r in rows]
+
+        def save(conn):
+            conn.executemany("""INSERT INTO folder_counts(folder, server_total, server_unread, status_at) VALUES (?,?,?,?)
+                ON CONFLICT(folder) DO UPDATE SET server_total = excluded.server_total, server_unread = excluded.server_unread, status_at = excluded.status_at""",
+                [(f, total, unseen, now) for f, (total, unseen) in status.items()])
+            # Mappar som inte längre finns på servern
+            conn.execute("DELETE FROM folder_counts WHERE total <= 0 AND folder NOT IN (SELECT name FROM local_folders)")
+            stale = stale_folders(conn)
+            if stale:
+                rebuild_counts(conn, stale)
+                stale = stale_folders(conn)
+            return stale
+        stale = db_write(save, priority=PRIORITY_BACKGROUND)
+        for f in stale:
+            schedule_sync(f, PRIORITY_BACKGROUND)
+        if stale: log_event(f"Räknare avviker från servern, synkar: {', '.join(stale)}")
+    except Exception as e: log_event(f"Count reconcile error: {e}")
+
+# HTML-sanering vid inläsning: html_safe (visning och Svara/Vidarebefordra) och snippet (förhandsvisning i listan).
+# Höj SANITIZER_VERSION när reglerna ändras, så sanerar resanitize_emails om befintliga mail i bakgrunden.
+SANITIZER_VERSION = 3
+SNIPPET_LENGTH = 200
+SANITIZE_BATCH = 200
+# style behålls: visningen är en sandlådad iframe. Svarsredigeraren tar bort den själv (openReply i index.html).
+# SVG-animeringar kan skriva om href till javascript: via values/to/from.
+SANITIZE_DROP_TAGS = ('script', 'iframe', 'frame', 'frameset', 'object', 'embed', 'applet', 'base', 'link', 'meta',
+                      'animate', 'set', 'animatemotion', 'animatetransform')
+SANITIZE_URL_ATTRS = ('href', 'src', 'action', 'formaction', 'background', 'xlink:href', 'poster')
+UNSAFE_URL_RE = re.compile(r'^(javascript|vbscript|data:text/html)', re.IGNORECASE)
+
+def sanitize_html(body_html):
+    """ Ta bort skript, SVG-animeringar, inbäddade ramar/objekt, on*-attribut och javascript:-länkar """
+    soup = BeautifulSoup(body_html, 'html.parser')
+    for tag in soup.find_all(SANITIZE_DROP_TAGS):
+        tag.decompose()
+    for tag in soup.find_all(True):
+        for attr in list(tag.attrs):
+            value = tag.attrs[attr]
+            value = ' '.join(value) if isinstance(value, list) else (value or '')
+            name = attr.lower()
+            if name.startswith('on'):
+                del tag.attrs[attr]
+            elif name in SANITIZE_URL_ATTRS and UNSAFE_URL_RE.match(re.sub(r'[\s\x00-\x1f]+', '', value)):
+                del tag.attrs[attr]
+            elif name == 'style' and re.search(r'expression\s*\(|javascript:', value, re.IGNORECASE):
+                del tag.attrs[attr]
+    return str(soup)
+
+def make_snippet(text, body_html=None):
+    if not (text or '').strip() and body_html:
+        soup = BeautifulSoup(body_html, 'html.parser')
+        for tag in soup.find_all(('style', 'script', 'head', 'title')): tag.decompose()
+        text = soup.get_text(' ')
+    return re.sub(r'\s+', ' ', text or '').strip()[:SNIPPET_LENGTH]
+
+def sanitize_message(text, body_html):
+    """ (html_safe, snippet) för ett mail; utan html blir texten html med radbrytningar """
+    if body_html:
+        try: html_safe = sanitize_html(body_html)
+        except Exception: html_safe = re.sub(r'<script[^>]*>.*?</script>', '', body_html, flags=re.DOTALL|re.IGNORECASE)
+    else:
+        html_safe = html.escape(text or "").replace('\n', '<br>')
+    return html_safe, make_snippet(text, body_html)
+
+def resanitize_emails():
+    """ Bakgrundsjobb: sanera mail med äldre sanitizer_version (eller inga sparade värden), SANITIZE_BATCH åt gången """
+    done = 0
+    last_rowid = 0
+    while True:
+        with db_session(readonly=True) as conn:
+            rows = conn.execute("""SELECT rowid, body, html FROM emails WHERE sanitizer_version < ? AND html IS NOT NULL AND html != ''
+                                   AND rowid > ? ORDER BY rowid LIMIT ?""", (SANITIZER_VERSION, last_rowid, SANITIZE_BATCH)).fetchall()
+        if not rows:
+            if done: log_event(f"Sanerade html för {done} mail (version {SANITIZER_VERSION})")
+            return done
+        # Saneringen görs utanför skrivaren; html-villkoret hoppar över rader som fått ny kropp under tiden
+        updates = [sanitize_message(text, body_html) + (SANITIZER_VERSION, rowid, body_html) for rowid, text, body_html in rows]
+        db_write(lambda conn: conn.executemany("UPDATE emails SET html_safe=?, snippet=?, sanitizer_version=? WHERE rowid=? AND html=?", updates),
+                 priority=PRIORITY_BACKGROUND)
+        done += len(rows)
+        last_rowid = rows[-1][0]
+
+# Fas 2: hämtning av mailkroppar. 'structure' läser BODYSTRUCTURE och hämtar bara text/plain och text/html
+# (högst BODY_PART_MAX_BYTES per del); bilagor och inline-bilder registreras som metadata och hämtas vid behov.
+# 'full' hämtar hela mail (RFC822) som tidigare. Kan sättas med inställningen body_fetch_mode.
+BODY_FETCH_MODE = 'structure'
+BODY_PART_MAX_BYTES = 1024 * 1024
+BODY_TRUNCATED_NOTE = '<p style="color:#888"><em>Meddelandet är förkortat.</em></p>'
+
+def attachment_summary(records):
+    # Listan som fortfarande skrivs till emails.attachments (JSON): bilagor som visas, ej inline och ej bilder
+    return [{'filename': r['filename'], 'size': r['size'], 'content_type': r['content_type']} for r in records
+            if not r['is_inline'] and not (r['content_type'] or '').startswith('image/')]
+
+def full_body_result(msg):
+    """ (uid, text, html, bilageposter med innehåll) för ett helt hämtat mail """
+    body_html = msg.html or f"<pre>{msg.text}</pre>"
+    records = attachment_records(msg, with_payload=True)
+    # Inline-bilder läggs i bilagelagret (save_fetched_bodies) och html pekar på /api/inline/<hash>
+    for r in records:
+        if r['content_id']:
+            body_html = body_html.replace(f"cid:{r['content_id'].strip('<>')}", inline_url(r['content_hash']))
+    return (msg.uid, msg.text or "", body_html, records)
+
+def fetch_bodies_full(mb, uids):
+    """ Hämta hela mail och returnera [(uid, text, html, bilageposter med innehåll)] """
+    return [full_body_result(msg) for msg in mb.fetch(A(uid=[str(u) for u in uids]), mark_seen=False, bulk=True)]
+
+def fetch_bodies_structured(mb, folder, uids):
+    """ Som fetch_bodies_full, men hämtar BODYSTRUCTURE och sedan bara textdelarna. Mail vars struktur
+        inte kan tolkas hämtas hela. Bilageposterna saknar innehåll och hash (fylls vid första nedladdning). """
+    typ, data = mb.client.uid('FETCH', ','.join(str(u) for u in uids), '(UID BODYSTRUCTURE)')
+    if typ != 'OK': raise imaplib.IMAP4.error(f"FETCH BODYSTRUCTURE misslyckades: {data}")
+    plans, fallback = {}, []
+    for uid, items in imap_fetch_items(data).items():
+        try: parts = parse_bodystructure(items['BODYSTRUCTURE'])
+        except Exception:
+            fallback.append(uid)
+            continue
+        text_part = html_part = None
+        records = []
+        for part in parts:
+            is_body = (not part['inside_message'] and part['disposition'] != 'attachment' and not part['filename']
+                       and part['content_type'] in ('text/plain', 'text/html'))
+            if is_body and part['content_type'] == 'text/plain' and not text_part: text_part = part
+            elif is_body and part['content_type'] == 'text/html' and not html_part: html_part = part
+            elif is_body or (part['content_type'].startswith('text/') and not part['filename'] and not part['content_id']):
+                continue
+            else:
+                filename = part['filename'] or "noname"
+                size = part['size']
+                if part['encoding'] == 'base64': size = size * 57 // 78 # Ungefärlig avkodad storlek (76 tecken + CRLF per rad)
+                records.append({
+                    'part_id': part['part_id'], 'filename': filename,
+                    'ext': os.path.splitext(filename)[1][1:].lower() or None,
+                    'content_type': part['content_type'], 'size': size,
+                    'is_inline': 1 if (part['content_id'] or part['disposition'] == 'inline') else 0,
+                    'content_hash': None, 'content_id': part['content_id'], 'encoding': part['encoding'],
+                })
+        plans[uid] = (text_part, html_part, records)
+
+    # Mail med samma sektioner (t.ex. 1.1 och 1.2) hämtas i samma FETCH
+    groups = {}
+    for uid, (text_part, html_part, _) in plans.items():
+        sections = tuple(p['part_id'] for p in (text_part, html_part) if p)
+        if sections: groups.setdefault(sections, []).append(uid)
+    fetched = {}
+    for sections, group_uids in groups.items():
+        items = ' '.join(f"BODY.PEEK[{sec}]<0.{BODY_PART_MAX_BYTES}>" for sec in sections)
+        typ, data = mb.client.uid('FETCH', ','.join(str(u) for u in group_uids), f"(UID {items})")
+        if typ == 'OK': fetched.update(imap_fetch_items(data))
+
+    results = []
+    for uid, (text_part, html_part, records) in plans.items():
+        texts = {}
+        for part in (text_part, html_part):
+            if not part: continue
+            raw = fetched.get(uid, {}).get(f"BODY[{part['part_id']}]<0>")
+            if not isinstance(raw, bytes): raw = b''
+            value = _decode_text(_decode_transfer(raw, part['encoding']), part['charset'])
+            if part['size'] > BODY_PART_MAX_BYTES and part['content_type'] == 'text/html': value += BODY_TRUNCATED_NOTE
+            texts[part['content_type']] = value
+        text = texts.get('text/plain', '')
+        body_html = texts.get('text/html') or f"<pre>{text}</pre>"
+        # Inline-bilder pekar på bilagevägen och hämtas först när mailet visas; download_attachment byter
+        # sedan adressen mot /api/inline/<hash> (rewrite_inline_part)
+        for r in records:
+            if r['content_id']:
+                body_html = body_html.replace(f"cid:{r['content_id']}", inline_part_url(uid, folder, r['part_id']))
+        results.append((uid, text, body_html, records))
+
+    if fallback:
+        results.extend(fetch_bodies_full(mb, fallback))
+    return results
+
+def save_fetched_bodies(conn, folder, fetched):
+    """ Spara resultatet från fetch_bodies_full/fetch_bodies_structured: kroppar, bilageposter och innehåll som redan hämtats """
+    conn.executemany("UPDATE emails SET body=?, html=?, attachments=?, html_safe=?, snippet=?, sanitizer_version=? WHERE uid=? AND folder=?",
+                     [(text, body_html, json.dumps(attachment_summary(records))) + sanitize_message(text, body_html) + (SANITIZER_VERSION, uid, folder)
+                      for uid, text, body_html, records in fetched])
+    for uid, _, _, records in fetched:
+        store_attachments(conn, uid, folder, records)
+        for r in records:
+            # Inline-bilder måste finnas i lagret eftersom html länkar till dem; vanliga bilagor upp till PREFETCH_MAX
+            if r.get('payload') is not None and (r['content_id'] or (not r['is_inline'] and r['size'] <= ATTACHMENT_STORE_PREFETCH_MAX)):
+                try: blob_store_put(conn, r['payload'], r['content_hash'], content_type=r['content_type'])
+                except: pass
+
+# Trådning (JWZ-liknande, inkrementell): synken sparar Message-ID, In-Reply-To och References och thread_messages()
+# ger varje ny rad ett thread_id. thread_message_ids håller alla id:n som setts (egna och refererade) -> tråd,
+# så att ett svar som kommer före sitt original ändå hamnar rätt. Länkar ett mail två trådar slås de ihop.
+# Ämnet används bara för svar (Re:/Sv: ...) utan kända referenser och för mail utan Message-ID.
+# threads.message_count/unread_count/last_date hålls aktuella av triggers på emails.
+THREAD_BATCH = 500
+THREAD_SUBJECT_WINDOW_DAYS = 60
+THREAD_MAX_REFERENCES = 20
+THREAD_MAX_PARTICIPANTS = 10
+THREAD_HEADER_BACKFILL = 1000    # Rader per synk som får sina trådrubriker hämtade i efterhand
+MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+
+def parse_message_ids(value):
+    """ '<a@x> <b@y>' -> ['<a@x>', '<b@y>'] (även id:n utan vinkelparenteser godtas) """
+    if not value: return []
+    ids = MESSAGE_ID_RE.findall(value)
+    if not ids and value.strip() and ' ' not in value.strip():
+        ids = [f"<{value.strip().strip('<>')}>"]
+    return ids
+
+def message_thread_headers(headers):
+    """ (message_id, in_reply_to, refs) ur imap_tools-rubriker. Saknade rubriker blir '' (= kontrollerad). """
+    def first(name):
+        values = (headers or {}).get(name) or ('',)
+        return ' '.join(str(values[0]).split())
+    message_id = (parse_message_ids(first('message-id')) or [''])[0]
+    in_reply_to = (parse_message_ids(first('in-reply-to')) or [''])[0]
+    refs = ' '.join(parse_message_ids(first('references'))[-THREAD_MAX_REFERENCES:])
+    return message_id, in_reply_to, refs
+
+def _subject_key(subject):
+    return clean_subject(subject).lower()
+
+def _participant(sender):
+    sender = (sender or '').strip()
+    name = sender.split('<')[0].strip().strip('"') if '<' in sender else sender
+    return name or get_clean_email(sender)
+
+def _merge_threads(conn, source, target):
+    """ Flytta allt från tråden source till target (triggers flyttar räknarna) och ta bort source """
+    if source == target: return
+    # Läses först: triggern tar bort source-raden när dess sista mail flyttats
+    row = conn.execute("SELECT participants FROM threads WHERE id=?", (source,)).fetchone()
+    conn.execute("UPDATE emails SET thread_id=? WHERE thread_id=?", (target, source))
+    conn.execute("UPDATE thread_message_ids SET thread_id=? WHERE thread_id=?", (target, source))
+    if row and row[0]:
+        _add_participants(conn, target, json.loads(row[0]))
+    conn.execute("DELETE FROM threads WHERE id=?", (source,))
+
+def _add_participants(conn, thread_id, names):
+    row = conn.execute("SELECT participants FROM threads WHERE id=?", (thread_id,)).fetchone()
+    if not row: return
+    current = json.loads(row[0]) if row[0] else []
+    added = [n for n in names if n and n not in current]
+    if added and len(current) < THREAD_MAX_PARTICIPANTS:
+        current = (current + added)[:THREAD_MAX_PARTICIPANTS]
+        conn.execute("UPDATE threads SET participants=? WHERE id=?", (json.dumps(current, ensure_ascii=False), thread_id))
+
+def thread_messages(conn, limit=THREAD_BATCH):
+    """ Ge högst limit otrådade rader (äldst först) ett thread_id. Returnerar antalet behandlade rader. """
+    rows = conn.execute("""SELECT rowid, message_id, in_reply_to, refs, subject, sender, date_iso FROM emails
+                           WHERE thread_id IS NULL ORDER BY date_iso LIMIT ?""", (limit,)).fetchall()
+    for rowid, message_id, in_reply_to, refs, subject, sender, date_iso in rows:
+        linked = parse_message_ids(refs) + parse_message_ids(in_reply_to)
+        if message_id: linked.append(message_id)
+        linked = list(dict.fromkeys(linked))
+
+        found = []
+        for i in range(0, len(linked), 500):
+            chunk = linked[i:i+500]
+            found += [r[0] for r in conn.execute(f"SELECT DISTINCT thread_id FROM thread_message_ids WHERE message_id IN ({','.join('?' * len(chunk))})", chunk)]
+        found = sorted(set(found))
+
+        subject_key = _subject_key(subject)
+        if not found:
+            is_reply = ' '.join((subject or '').split()).lower() != subject_key
+            if subject_key and (is_reply or not message_id):
+                since = None
+                try: since = (datetime.fromisoformat(date_iso) - timedelta(days=THREAD_SUBJECT_WINDOW_DAYS)).isoformat()
+                except (TypeError, ValueError): pass
+                row = conn.execute("SELECT id FROM threads WHERE subject_key=? AND (? IS NULL OR last_date >= ?) ORDER BY last_date DESC LIMIT 1",
+                                   (subject_key, since, since)).fetchone()
+                if row: found = [row[0]]
+
+        if found:
+            target = found[0]
+            # Tråden kan ha tömts (och tagits bort) medan id:na fanns kvar
+            conn.execute("INSERT OR IGNORE INTO threads (id, subject, subject_key) VALUES (?, ?, ?)", (target, clean_subject(subject), subject_key))
+            for other in found[1:]:
+                _merge_threads(conn, other, target)
+        else:
+            target = conn.execute("INSERT INTO threads (subject, subject_key) VALUES (?, ?)", (clean_subject(subject), subject_key)).lastrowid
+
+        conn.executemany("INSERT OR REPLACE INTO thread_message_ids (message_id, thread_id) VALUES (?, ?)", [(m, target) for m in linked])
+        conn.execute("UPDATE emails SET thread_id=? WHERE rowid=?", (target, rowid))
+        _add_participants(conn, target, [_participant(sender)])
+    return len(rows)
+
+def thread_pending():
+    """ Bakgrundsjobb och efter synk: tråda alla rader som saknar thread_id, THREAD_BATCH åt gången """
+    done = 0
+    while True:
+        n = db_write(thread_messages, priority=PRIORITY_BACKGROUND)
+        done += n
+        if n < THREAD_BATCH:
+            if done > THREAD_BATCH: log_event(f"Trådade {done} mail")
+            return done
+
+def backfill_thread_headers(mb, folder, limit=THREAD_HEADER_BACKFILL):
+    """ Hämta Message-ID/In-Reply-To/References för rader som sparades innan de lagrades. Svar trådas om av
+        thread_messages(); övriga behåller sin tråd och registrerar sitt Message-ID där så att senare svar hittar den. """
+    with db_session(readonly=True) as conn:
+        uids = [r[0] for r in conn.execute("SELECT uid FROM emails WHERE folder=? AND message_id IS NULL AND uid IS NOT NULL AND uid != 0 ORDER BY uid DESC LIMIT ?",
+                                           (folder, limit))]
+    updates = []
+    for i in range(0, len(uids), 100):
+        chunk = uids[i:i+100]
+        seen = set()
+        for msg in mb.fetch(A(uid=[str(u) for u in chunk]), headers_only=True, mark_seen=False, bulk=True):
+            if not msg.uid: continue
+            seen.add(int(msg.uid))
+            updates.append(message_thread_headers(msg.headers) + (folder, int(msg.uid)))
+        # Finns inte på servern längre (tas bort av nästa synk); markera som kontrollerade
+        updates += [('', '', '', folder, u) for u in chunk if u not in seen]
+    def save(conn):
+        conn.executemany("""UPDATE emails SET message_id=?, in_reply_to=?, refs=?,
+                                thread_id = CASE WHEN ? THEN NULL ELSE thread_id END
+                            WHERE folder=? AND uid=?""", [(m, irt, refs, bool(irt or refs), f, u) for m, irt, refs, f, u in updates])
+        conn.executemany("""INSERT OR IGNORE INTO thread_message_ids (message_id, thread_id)
+                            SELECT message_id, thread_id FROM emails WHERE folder=? AND uid=? AND thread_id IS NOT NULL AND message_id != ''""",
+                         [(f, u) for _, _, _, f, u in updates])
+    if updates: db_write(save)
+    return len(updates)
+
+def save_headers(conn, new_rows, label_rows):
+    """ Synkens Fas 1: kuvertrader (utan kropp) och etikettkopplingar från klassificeraren """
+    # UPSERT i stället för INSERT OR REPLACE så att rowid (och därmed FTS-rad och etiketter) behålls
+    conn.executemany("""INSERT INTO emails (uid, folder, subject, sender, sender_email, body, html, date_iso, ts, date_str, attachments, recipients, is_draft, seen, flagged,
+            message_id, in_reply_to, refs)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        ON CONFLICT(uid, folder) DO UPDATE SET subject=excluded.subject, sender=excluded.sender, sender_email=excluded.sender_email, body=excluded.body, html=excluded.html,
+            date_iso=excluded.date_iso, ts=excluded.ts, date_str=excluded.date_str, attachments=excluded.attachments, recipients=excluded.recipients,
+            is_draft=excluded.is_draft, seen=excluded.seen, flagged=excluded.flagged,
+            message_id=excluded.message_id, in_reply_to=excluded.in_reply_to, refs=excluded.refs""", new_rows)
+    conn.executemany("INSERT OR IGNORE INTO email_labels (email_rowid, label_id) SELECT rowid, ? FROM emails WHERE uid=? AND folder=?", label_rows)
+
 def sync_worker(folder):
-    with sync_lock:
-        if folder in syncing_folders: return
-        syncing_folders.add(folder)
-    
+    # Körs via sync_scheduler (schedule_sync), som ser till att samma mapp aldrig synkas parallellt
     settings = load_settings()
     user_email = get_clean_email(settings.get('email', ''))
 
     try:
         log_event(f"Synkroniserar mapp: {folder}")
-        with get_mailbox() as mb:
-            mb.folder.set(folder)
-            try: mb.check()
-            except: pass
-            
+        with imap_session() as mb:
             # Hitta spam-mapp för filtrering
             spam_folder = None
             ad_folder = None
@@ -577,109 +2613,105 @@ def sync_worker(folder):
                     if 'reklam' in f.name.lower():
                         ad_folder = f.name
 
-            server_uids = {int(u) for u in mb.uids()}
-            with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-                # Hämta lokala UIDs och kolla om de har innehåll (html)
-                rows = conn.execute("SELECT uid, length(html) FROM emails WHERE folder=?", (folder,)).fetchall()
-                local_uids = {r[0] for r in rows if r[0] is not None}
-                incomplete_uids = {r[0] for r in rows if (not r[1] or r[1] == 0) and r[0] is not None} # UIDs som saknar kropp
-                
+            state = get_folder_sync_state(folder)
+            changes = imap_folder_changes(mb, folder, state)
+
+            def cleanup(conn):
+                if changes.get('uidvalidity_changed'):
+                    # UIDVALIDITY har ändrats: alla lokala UIDs för mappen är ogiltiga
+                    log_event(f"UIDVALIDITY ändrad för {folder}, bygger om lokal cache")
+                    conn.execute("DELETE FROM emails WHERE folder=?", (folder,))
                 # Städa bort rader med NULL UID eller 0 som kan ha fastnat
-                if any(r[0] is None or r[0] == 0 for r in rows):
-                    conn.execute("DELETE FROM emails WHERE (uid IS NULL OR uid=0) AND folder=?", (folder,))
-            
-            # Hämta kända utkast UIDs lokalt för att inte skriva över is_draft=1 om servern missar flaggan
-            known_drafts = set()
-            with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+                conn.execute("DELETE FROM emails WHERE (uid IS NULL OR uid=0) AND folder=?", (folder,))
+            db_write(cleanup)
+
+            with db_session(readonly=True) as conn:
+                # UIDs som saknar kropp (partiellt index, läser inte html-kolumnen för hela mappen)
+                rows = conn.execute("SELECT uid FROM emails WHERE folder=? AND (html IS NULL OR html = '')", (folder,)).fetchall()
+                incomplete_uids = {r[0] for r in rows}
+
+                # Hämta kända utkast UIDs lokalt för att inte skriva över is_draft=1 om servern missar flaggan
                 rows = conn.execute("SELECT uid FROM emails WHERE folder=? AND is_draft=1", (folder,)).fetchall()
                 known_drafts = {r[0] for r in rows if r[0] is not None}
 
-            to_delete = list(local_uids - server_uids)
+                if changes['mode'] == 'incremental':
+                    # Slå bara upp de UIDs som berörs av ändringarna
+                    touched = list(changes['new_uids'] | changes['vanished'])
+                    local_uids = set()
+                    for i in range(0, len(touched), 500):
+                        chunk = touched[i:i+500]
+                        placeholders = ','.join('?' * len(chunk))
+                        rows = conn.execute(f"SELECT uid FROM emails WHERE folder=? AND uid IN ({placeholders})", [folder] + chunk).fetchall()
+                        local_uids.update(r[0] for r in rows)
+                    local_count = folder_total(conn, folder)
+                else:
+                    rows = conn.execute("SELECT uid FROM emails WHERE folder=?", (folder,)).fetchall()
+                    local_uids = {r[0] for r in rows if r[0] is not None}
+
+            if changes['mode'] == 'incremental':
+                to_fetch_headers = list(changes['new_uids'] - local_uids)
+                to_delete = changes['vanished'] & local_uids
+                # Utan QRESYNC syns inte raderingar; jämför antal och fall tillbaka till full UID-lista vid avvikelse
+                expected = local_count - len(to_delete) + len(to_fetch_headers)
+                if not changes['vanished_known'] and expected != changes['exists']:
+                    server_uids = {int(u) for u in mb.uids()}
+                    with db_session(readonly=True) as conn:
+                        rows = conn.execute("SELECT uid FROM emails WHERE folder=?", (folder,)).fetchall()
+                    to_delete = {r[0] for r in rows} - server_uids
+                to_delete = list(to_delete)
+            else:
+                server_uids = {int(u) for u in mb.uids()}
+                to_delete = list(local_uids - server_uids)
+                to_fetch_headers = list(server_uids - local_uids)
+
             # FIX: Skydda lokala utkast från att raderas av synken innan de dykt upp på servern (Race condition fix)
             to_delete = [u for u in to_delete if u not in known_drafts]
             
             if to_delete:
-                with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-                    conn.executemany("DELETE FROM emails WHERE uid=? AND folder=?", [(u, folder) for u in to_delete])
+                db_write(lambda conn: conn.executemany("DELETE FROM emails WHERE uid=? AND folder=?", [(u, folder) for u in to_delete]))
 
             # FAS 1: Hämta rubriker för ALLA nya mail (Blixtsnabbt)
-            to_fetch_headers = list(server_uids - local_uids)
             to_fetch_headers.sort(reverse=True)
+            sync_complete = True
             
-            # Hämta regler
-            with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-                db_rules = conn.execute("SELECT keyword, target_folder, check_field FROM rules").fetchall()
-                db_labels = conn.execute("SELECT id, keyword, check_field FROM labels").fetchall()
-            
-            filters = get_spam_filters()
+            # Regler, etiketter och spamfilter (kompilerade och cachade)
+            classifier = get_classifier()
             
             if to_fetch_headers:
                 for i in range(0, len(to_fetch_headers), 50):
                     chunk = [str(u) for u in to_fetch_headers[i:i+50]]
                     new_rows = []
+                    label_rows = []
                     spam_uids = []
                     ad_uids = []
                     try:
                         for msg in mb.fetch(A(uid=chunk), headers_only=True, bulk=True):
                             if not msg.uid or msg.uid == 0: continue
                             
-                            subj_lower = (msg.subject or "").lower()
-                            sender_lower = (msg.from_ or "").lower()
-
-                            # Etiketter
-                            applied_labels = []
-                            for l_id, l_key, l_field in db_labels:
-                                l_field = (l_field or 'subject').lower()
-                                keywords = [k.strip().lower() for k in (l_key or "").split(',') if k.strip()]
-                                is_match = False
-                                
-                                for k in keywords:
-                                    if l_field == 'sender':
-                                        if k in sender_lower: is_match = True
-                                    elif l_field == 'both':
-                                        if k in subj_lower or k in sender_lower: is_match = True
-                                    else: # subject
-                                        if k in subj_lower: is_match = True
-                                    if is_match: break
-                                
-                                if is_match: applied_labels.append(l_id)
+                            # Etiketter, regler och spam/reklam i ett svep
+                            result = classifier.classify(msg.subject, msg.from_)
+                            applied_labels = result['labels']
 
                             # Spam-check för INBOX
                             if folder.lower() == 'inbox':
                                 # 1. Kolla regler (Regler går före spam)
-                                rule_target = None
-                                subj_lower = (msg.subject or "").lower()
-                                sender_lower = (msg.from_ or "").lower()
-                                
-                                for r_key, r_folder, r_field in db_rules:
-                                    r_field = (r_field or 'subject').lower()
-                                    is_match = False
-                                    if r_field == 'sender':
-                                        if r_key.lower() in sender_lower: is_match = True
-                                    elif r_field == 'both':
-                                        if r_key.lower() in subj_lower or r_key.lower() in sender_lower: is_match = True
-                                    else: # subject
-                                        if r_key.lower() in subj_lower: is_match = True
-                                    
-                                    if is_match:
-                                        rule_target = r_folder
-                                        break
+                                rule_target = result['rule_target']
                                 if rule_target:
                                     try:
                                         mb.move([msg.uid], rule_target)
-                                        threading.Thread(target=sync_worker, args=(rule_target,), daemon=True).start()
+                                        schedule_sync(rule_target, PRIORITY_CHANGE, force=True)
                                         continue # Hoppa över att spara i INBOX lokalt
                                     except: pass
 
-                                if is_spam_email(msg, filters):
+                                if result['is_spam']:
                                     if spam_folder:
                                         spam_uids.append(msg.uid)
                                         continue
-                                elif is_ad_email(msg, filters):
+                                elif result['is_ad']:
                                     ad_uids.append(msg.uid)
                                     continue
 
-                            d_iso = msg.date.isoformat() if msg.date else datetime.now().isoformat()
+                            d_iso = msg.date.isoformat() if msg.date else datetime.now(timezone.utc).isoformat()
                             d_str = msg.date.strftime('%Y-%m-%d %H:%M') if msg.date else datetime.now().strftime('%Y-%m-%d %H:%M')
                             # Spara med tomt innehåll först så de blir sökbara direkt
                             sender_name = msg.from_ or ""
@@ -705,13 +2737,17 @@ def sync_worker(folder):
                             if folder.upper() == 'INBOX' and user_email and user_email == msg_from_clean:
                                 is_draft = 1
 
-                            new_rows.append((msg.uid, folder, msg.subject or "", sender_name, "", "", d_iso, d_str, "[]", recipients_str, json.dumps(applied_labels), is_draft))
+                            is_seen = 1 if '\\Seen' in msg.flags else 0
+                            is_flagged = 1 if '\\Flagged' in msg.flags else 0
+                            new_rows.append((msg.uid, folder, msg.subject or "", sender_name, msg_from_clean, "", "", d_iso, date_ts(d_iso), d_str, "[]", recipients_str, is_draft, is_seen, is_flagged)
+                                            + message_thread_headers(msg.headers))
+                            label_rows.extend((l_id, msg.uid, folder) for l_id in applied_labels)
                     except Exception as e:
+                        sync_complete = False
                         log_event(f"Fel vid hämtning av mail (chunk {i}): {e}")
                     
                     if new_rows:
-                        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-                            conn.executemany("INSERT OR REPLACE INTO emails (uid, folder, subject, sender, body, html, date_iso, date_str, attachments, recipients, labels, is_draft) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", new_rows)
+                        db_write(save_headers, new_rows, label_rows)
                     
                     # Flytta spam
                     if spam_uids and spam_folder:
@@ -739,70 +2775,196 @@ def sync_worker(folder):
                                     mb.delete(ad_uids)
                             except: pass
 
+            # Trådrubriker för äldre rader, sedan trådning av allt nytt (innan listan läses)
+            try: backfill_thread_headers(mb, folder)
+            except Exception as e: log_event(f"Kunde inte hämta trådrubriker i {folder}: {e}")
+            thread_pending()
+
             # FAS 2: Hämta innehåll för mail som saknar det (Bakgrund)
             to_fetch_bodies = list(incomplete_uids.union(set(to_fetch_headers)))
             to_fetch_bodies.sort(reverse=True)
             
             if to_fetch_bodies:
+                structured = settings.get('body_fetch_mode', BODY_FETCH_MODE) == 'structure'
+                # Skrivningen av en sats överlappar hämtningen av nästa; kön bromsar om skrivaren inte hinner med
+                pending_writes = []
                 for i in range(0, len(to_fetch_bodies), 100):
-                    chunk = [str(u) for u in to_fetch_bodies[i:i+100]]
-                    update_rows = []
+                    chunk = to_fetch_bodies[i:i+100]
                     try:
-                        for msg in mb.fetch(A(uid=chunk), bulk=True):
-                            body_html = msg.html or f"<pre>{msg.text}</pre>"
-                            for att in msg.attachments:
-                                if att.content_id:
-                                    try:
-                                        b64 = base64.b64encode(att.payload).decode('utf-8')
-                                        body_html = body_html.replace(f"cid:{att.content_id.strip('<>')}", f"data:{att.content_type};base64,{b64}")
-                                    except: pass
-                            
-                            atts = []
-                            for a in msg.attachments:
-                                # Filtrera bort inline-bilder (som har Content-ID eller disposition inline)
-                                is_inline = False
-                                if a.content_id: is_inline = True
-                                if a.content_disposition and a.content_disposition.lower() == 'inline': is_inline = True
-                                
-                                # Filtrera bort alla bilder (användaren vill bara se dokument)
-                                is_image = a.content_type and a.content_type.lower().startswith('image/')
-                                
-                                if not is_inline and not is_image:
-                                    atts.append({'filename': a.filename or "noname", 'size': a.size, 'content_type': a.content_type})
-                            
-                            update_rows.append((msg.text or "", body_html, json.dumps(atts), msg.uid, folder))
-                    except: pass
+                        fetched = fetch_bodies_structured(mb, folder, chunk) if structured else fetch_bodies_full(mb, chunk)
+                    except Exception as e:
+                        log_event(f"Fel vid hämtning av innehåll i {folder}: {e}")
+                        fetched = []
                     
-                    if update_rows:
-                        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-                            conn.executemany("UPDATE emails SET body=?, html=?, attachments=? WHERE uid=? AND folder=?", update_rows)
+                    if fetched:
+                        pending_writes.append(db_write(save_fetched_bodies, folder, fetched, wait=False))
+                for future in pending_writes:
+                    try: future.result(timeout=DB_WRITE_WAIT_TIMEOUT)
+                    except Exception as e:
+                        sync_complete = False
+                        log_event(f"Kunde inte spara innehåll i {folder}: {e}")
             
-            # FAS 3: Synka flaggor (Läst/Stjärnmärkt) för synliga mail i bakgrunden
+            # FAS 3: Synka flaggor (Läst/Stjärnmärkt)
             try:
-                recent_uids = sorted(list(local_uids), reverse=True)[:100]
-                if recent_uids:
+                if changes['mode'] == 'incremental':
+                    # Endast mail vars flaggor ändrats sedan förra synken (CHANGEDSINCE/QRESYNC)
+                    flags_map = {str(uid): flags for uid, flags in changes['flags'].items()}
+                    uid_str = list(flags_map.keys())
+                else:
+                    # Full synk: flaggor för de senaste mailen i bakgrunden
+                    recent_uids = sorted(list(local_uids), reverse=True)[:100]
                     uid_str = [str(u) for u in recent_uids]
                     flags_map = {}
-                    # Hämta bara flaggor (snabbt)
-                    for msg in mb.fetch(A(uid=uid_str), headers_only=True):
-                        flags_map[str(msg.uid)] = msg.flags
-                    
-                    read_updates = {}
-                    star_updates = {}
+                    if uid_str:
+                        # Hämta bara flaggor (snabbt)
+                        for msg in mb.fetch(A(uid=uid_str), headers_only=True):
+                            flags_map[str(msg.uid)] = msg.flags
+
+                if uid_str:
+                    flag_updates = {}
                     for uid in uid_str:
                         flags = flags_map.get(uid, [])
-                        is_read = '\\Seen' in flags
-                        is_starred = '\\Flagged' in flags
-                        read_updates[uid] = is_read
-                        star_updates[uid] = is_starred
+                        flag_updates[uid] = ('\\Seen' in flags, '\\Flagged' in flags)
                     
-                    update_local_status_batch(folder, read_updates)
-                    update_star_status_batch(folder, star_updates)
-            except Exception as e: log_event(f"Flag sync error: {e}")
+                    update_flag_status_batch(folder, flag_updates)
+            except Exception as e:
+                sync_complete = False
+                log_event(f"Flag sync error: {e}")
+
+            # Spara synk-läget så att nästa synk bara hämtar ändringar
+            if sync_complete and changes['uidvalidity']:
+                save_folder_sync_state(folder, changes['uidvalidity'], changes['uidnext'], changes['highestmodseq'])
     except Exception as e:
         log_event(f"Synkroniseringsfel för {folder}: {e}")
-    finally:
-        with sync_lock: syncing_folders.remove(folder)
+
+# IMAP IDLE: Bevaka mappar i bakgrunden så att sidladdningar bara behöver läsa lokalt
+IDLE_REISSUE = 29 * 60      # RFC 2177: avsluta och starta om IDLE minst var 29:e minut
+IDLE_POLL_STEP = 30         # Hur ofta IDLE-loopen vaknar för att kunna stoppas
+IDLE_POLL_FALLBACK = 120    # Intervall för NOOP-polling när servern saknar IDLE
+IDLE_RECONNECT_MAX = 300    # Längsta väntan mellan återanslutningsförsök
+IDLE_CHANGE_TYPES = ('EXISTS', 'EXPUNGE', 'FETCH', 'VANISHED')
+
+def is_change_response(line):
+    """ '* 12 EXISTS', '* 3 EXPUNGE', '* 5 FETCH (...)' eller '* VANISHED 4:7' """
+    parts = line.upper().split() if isinstance(line, bytes) else []
+    if len(parts) >= 2 and parts[1] == b'VANISHED': return True
+    return len(parts) >= 3 and parts[2].decode('ascii', 'ignore') in IDLE_CHANGE_TYPES
+
+class FolderWatcher(threading.Thread):
+    """ Egen (opoolad) IMAP-anslutning per bevakad mapp som väntar på EXISTS/EXPUNGE/FETCH och startar synk """
+
+    def __init__(self, folder):
+        super().__init__(daemon=True)
+        self.folder = folder
+        self.mode = None        # 'idle' eller 'poll'
+        self.connected = False
+        self.last_event = None
+        self.reconnects = 0
+        self._stop_event = threading.Event()
+        self._mb = None
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _trigger_sync(self):
+        self.last_event = time.time()
+        schedule_sync(self.folder, PRIORITY_CHANGE, force=True)
+
+    def _idle_round(self):
+        """ En IDLE-period (max 29 min). Returnerar True om servern rapporterade ändringar """
+        mb = self._mb
+        started = time.time()
+        mb.idle.start()
+        try:
+            while not self._stop_event.is_set() and time.time() - started < IDLE_REISSUE:
+                responses = mb.idle.poll(timeout=IDLE_POLL_STEP)
+                if any(is_change_response(r) for r in responses):
+                    return True
+        finally:
+            mb.idle.stop()
+        return False
+
+    def _poll_round(self):
+        """ Fallback för servrar utan IDLE: NOOP och titta efter oväntade svar """
+        if self._stop_event.wait(IDLE_POLL_FALLBACK): return False
+        client = self._mb.client
+        client.untagged_responses.clear()
+        typ, _ = client.noop()
+        if typ != 'OK': raise imaplib.IMAP4.abort('NOOP misslyckades')
+        return any(t in client.untagged_responses for t in IDLE_CHANGE_TYPES)
+
+    def run(self):
+        backoff = 5
+        while not self._stop_event.is_set():
+            try:
+                self._mb = get_mailbox()
+                self._mb.folder.set(self.folder)
+                self.mode = 'idle' if 'IDLE' in self._mb.client.capabilities else 'poll'
+                self.connected = True
+                backoff = 5
+                # Fånga upp allt som hänt medan vi var frånkopplade
+                self._trigger_sync()
+                if self.folder.upper() == 'INBOX':
+                    schedule_folder_structure_sync()
+                while not self._stop_event.is_set():
+                    changed = self._idle_round() if self.mode == 'idle' else self._poll_round()
+                    if changed: self._trigger_sync()
+            except Exception as e:
+                if not self._stop_event.is_set():
+                    log_event(f"IDLE-fel för {self.folder}: {e}")
+            finally:
+                self.connected = False
+                if self._mb:
+                    try: self._mb.logout()
+                    except Exception: pass
+                    self._mb = None
+            if self._stop_event.wait(backoff): break
+            self.reconnects += 1
+            backoff = min(backoff * 2, IDLE_RECONNECT_MAX)
+
+idle_watchers = {}
+idle_lock = threading.Lock()
+
+def get_watched_folders():
+    """ INBOX, utkast-mappar och eventuella extra mappar från inställningarna ('watch_folders') """
+    folders = ['INBOX']
+    try:
+        with db_session(readonly=True) as conn:
+            for r in conn.execute("SELECT name FROM local_folders").fetchall():
+                if ('draft' in r[0].lower() or 'utkast' in r[0].lower()) and r[0] not in folders:
+                    folders.append(r[0])
+    except: pass
+    for f in load_settings().get('watch_folders', []):
+        if f and f not in folders: folders.append(f)
+    return folders
+
+def refresh_idle_watchers():
+    """ Starta bevakare för nya mappar och stoppa dem som inte längre ska bevakas """
+    if not is_configured(): return
+    wanted = set(get_watched_folders())
+    with idle_lock:
+        for folder in list(idle_watchers):
+            watcher = idle_watchers[folder]
+            if folder not in wanted or not watcher.is_alive():
+                watcher.stop()
+                del idle_watchers[folder]
+        for folder in wanted:
+            if folder not in idle_watchers:
+                watcher = FolderWatcher(folder)
+                idle_watchers[folder] = watcher
+                watcher.start()
+
+def ensure_idle_watchers():
+    if not idle_watchers: refresh_idle_watchers()
+
+def stop_idle_watchers():
+    with idle_lock:
+        for watcher in idle_watchers.values(): watcher.stop()
+        idle_watchers.clear()
+
+def is_folder_watched(folder):
+    watcher = idle_watchers.get(folder)
+    return bool(watcher and watcher.is_alive() and watcher.connected)
 
 class MockMsg:
     def __init__(self, row):
@@ -814,148 +2976,298 @@ class MockMsg:
         self.date_str = ""
         self.original_folder = "INBOX"
         self.recipients = ""
-        self.date = datetime(1970, 1, 1)
+        self.ts = None
+        self.date_iso = None
         self.attachments_data = []
         self.flags = []
         self.attachments = []
         self.labels = []
         self.is_draft = False
+        self.rowid = None
+        self.seen = False
+        self.flagged = False
+        self.html_safe = None
+        self.snippet = ""
+        self.sanitizer_version = 0
+        self.thread_id = None
 
         try:
             if row:
+                keys = row.keys()
                 self.uid = row['uid'] if row['uid'] is not None else 0
                 self.from_ = row['sender'] or "Okänd"
                 self.subject = row['subject'] or "Inget ämne"
-                self.text = row['body'] or ""
-                self.html = row['html'] or ""
+                # Listningar (LISTING_COLUMNS) har inga kroppar
+                if 'body' in keys: self.text = row['body'] or ""
+                if 'html' in keys: self.html = row['html'] or ""
                 self.date_str = row['date_str'] or ""
                 self.original_folder = row['folder'] or 'INBOX'
-                try: self.recipients = row['recipients'] or ""
-                except: pass
+                if 'recipients' in keys: self.recipients = row['recipients'] or ""
                 
-                if row['date_iso']:
-                    try: self.date = datetime.fromisoformat(row['date_iso'])
-                    except: pass
-                    
-                if row['attachments']:
-                    try:
-                        data = json.loads(row['attachments'])
-                        if isinstance(data, list): self.attachments_data = data
-                    except: pass
-                
-                if 'labels' in row.keys() and row['labels']:
-                    try: self.labels = json.loads(row['labels'])
-                    except: pass
+                # Datumet tolkas först när det behövs (date); listningar har ts
+                if 'ts' in keys: self.ts = row['ts']
+                if self.ts is None: self.date_iso = row['date_iso']
+
+                # attachments_data fylls av load_attachment_chips (tabellen attachments)
+                if 'rowid' in keys: self.rowid = row['rowid']
+                if 'label_ids' in keys and row['label_ids']:
+                    self.labels = [int(l) for l in str(row['label_ids']).split(',')]
                 
-                if 'is_draft' in row.keys() and row['is_draft']:
+                if 'is_draft' in keys and row['is_draft']:
                     self.is_draft = True
+                if 'seen' in keys: self.seen = bool(row['seen'])
+                if 'flagged' in keys: self.flagged = bool(row['flagged'])
+                if 'snippet' in keys: self.snippet = row['snippet'] or ""
+                if 'thread_id' in keys: self.thread_id = row['thread_id']
+                if 'html_safe' in keys:
+                    self.html_safe = row['html_safe']
+                    self.sanitizer_version = row['sanitizer_version'] or 0
         except: pass
 
-def move_existing_spam(sender):
+    @property
+    def date(self):
+        """ Mailets datum (UTC) ur ts; rader som bakgrundssteget ts inte hunnit till tolkas från date_iso """
+        if self.ts is not None: return UTC_EPOCH + timedelta(seconds=self.ts)
+        if self.date_iso:
+            try: return datetime.fromisoformat(self.date_iso)
+            except ValueError: pass
+        return datetime(1970, 1, 1)
+
+    def sanitized(self):
+        """ Sparad html_safe om den är aktuell, annars beräknad här (resanitize_emails sparar den i bakgrunden) """
+        if self.html_safe is None or self.sanitizer_version != SANITIZER_VERSION:
+            self.html_safe, self.snippet = sanitize_message(self.text, self.html)
+        return self.html_safe
+
+# Avsändaråtgärder (blockera/reklam): sök på servern med UID SEARCH FROM och flytta i batchar
+BULK_MOVE_BATCH = 500
+bulk_jobs = {}
+bulk_jobs_lock = threading.Lock()
+
+def _update_bulk_job(key, **fields):
+    with bulk_jobs_lock:
+        job = bulk_jobs.setdefault(key, {'key': key})
+        job.update(fields, updated_at=time.time())
+        return job
+
+def imap_move_batch(mb, uids, dest):
+    """ Flytta en batch UIDs från vald mapp. Returnerar (uidvalidity, {käll-uid: mål-uid}) från COPYUID
+        (RFC 4315) om servern skickar det, annars (None, {}). """
+    client = mb.client
+    uid_set = ','.join(str(u) for u in uids)
+    client.untagged_responses.pop('COPYUID', None)
+    if 'MOVE' in client.capabilities:
+        # _simple_command i stället för client.uid(): uid() slänger den taggade svarsraden där COPYUID kan ligga
+        typ, data = client._simple_command('UID', 'MOVE', uid_set, encode_folder(dest))
+        if typ != 'OK': raise imaplib.IMAP4.error(f"UID MOVE misslyckades: {data}")
+    else:
+        typ, data = client._simple_command('UID', 'COPY', uid_set, encode_folder(dest))
+        if typ != 'OK': raise imaplib.IMAP4.error(f"UID COPY misslyckades: {data}")
+        mb.delete([str(u) for u in uids])
+
+    # RFC 6851: vid MOVE kommer COPYUID i ett otaggat OK; vid COPY i det taggade svaret
+    codes = [c.decode() if isinstance(c, bytes) else str(c) for c in client.untagged_responses.pop('COPYUID', [])]
+    for line in data or []:
+        line = line.decode(errors='replace') if isinstance(line, bytes) else str(line or '')
+        m = re.search(r'\[COPYUID ([^\]]+)\]', line)
+        if m: codes.append(m.group(1))
+
+    uidvalidity, mapping = None, {}
+    for code in codes:
+        parts = code.split()
+        if len(parts) != 3 or not parts[0].isdigit(): continue
+        src, dst = expand_uid_set(parts[1]), expand_uid_set(parts[2])
+        if len(src) != len(dst): continue
+        uidvalidity = int(parts[0])
+        mapping.update(zip(src, dst))
+    return uidvalidity, mapping
+
+def _apply_move_locally(src_folder, dest, uids, uidvalidity, mapping):
+    """ Uppdatera lokala cachen efter en flytt. Med COPYUID flyttas raderna (rowid, etiketter och status behålls),
+        annars tas de bort i källmappen och destinationen synkas. """
+    state = get_folder_sync_state(dest)
+    if mapping and state and state['uidvalidity'] and state['uidvalidity'] != uidvalidity:
+        mapping = {}    # Destinationens UIDVALIDITY har bytts; låt synken hämta om
+    def apply(conn):
+        if mapping:
+            conn.executemany("UPDATE OR IGNORE emails SET folder=?, uid=? WHERE folder=? AND uid=?",
+                             [(dest, new_uid, src_folder, old_uid) for old_uid, new_uid in mapping.items()])
+        conn.executemany("DELETE FROM emails WHERE folder=? AND uid=?", [(src_folder, u) for u in uids])
+    db_write(apply, priority=PRIORITY_USER)
+    return bool(mapping)
+
+def move_sender_messages(key, sender, dest, folders=None):
+    """ Flytta alla mail från avsändaren i de valda mapparna till dest. Förloppet syns i /api/jobs. """
+    sender_email = get_clean_email(sender)
+    _update_bulk_job(key, sender=sender, dest=dest, status='running', found=0, moved=0, folders={}, error=None, started_at=time.time())
+    try:
+        if not folders:
+            # INBOX samt mappar där avsändaren finns i lokala cachen (idx_emails_sender_email)
+            with db_session(readonly=True) as conn:
+                rows = conn.execute("SELECT DISTINCT folder FROM emails WHERE sender_email=?", (sender_email,)).fetchall()
+            skip = ('spam', 'junk', 'skräppost', 'reklam', 'trash', 'papperskorg', 'deleted', 'sent', 'skickat', 'draft', 'utkast')
+            folders = ['INBOX'] + [r[0] for r in rows if r[0] and r[0].upper() != 'INBOX' and not any(w in r[0].lower() for w in skip)]
+        folders = [f for f in folders if f != dest]
+
+        found = moved = 0
+        remapped = False
+        with imap_session() as mb:
+            for folder in folders:
+                try: mb.folder.set(folder)
+                except Exception as e:
+                    log_event(f"Kunde inte öppna {folder} för avsändarflytt: {e}")
+                    continue
+                charset = 'US-ASCII' if sender.isascii() else 'UTF-8'
+                uids = sorted(int(u) for u in mb.uids(A(from_=sender), charset=charset))
+                found += len(uids)
+                folder_moved = 0
+                _update_bulk_job(key, found=found)
+                for i in range(0, len(uids), BULK_MOVE_BATCH):
+                    batch = uids[i:i + BULK_MOVE_BATCH]
+                    uidvalidity, mapping = imap_move_batch(mb, batch, dest)
+                    remapped = _apply_move_locally(folder, dest, batch, uidvalidity, mapping) or remapped
+                    folder_moved += len(batch)
+                    moved += len(batch)
+                    with bulk_jobs_lock:
+                        bulk_jobs[key]['folders'][folder] = {'found': len(uids), 'moved': folder_moved}
+                    _update_bulk_job(key, moved=moved)
+        _update_bulk_job(key, status='done', finished_at=time.time())
+        if moved and not remapped:
+            schedule_sync(dest, PRIORITY_CHANGE, force=True)
+    except Exception as e:
+        _update_bulk_job(key, status='error', error=str(e))
+        log_event(f"Avsändarflytt {key} misslyckades: {e}")
+
+def move_existing_spam(sender, folders=None):
     # Flytta befintliga mail från denna avsändare till spam
+    key = f"spam:{sender}"
     try:
-        with get_mailbox() as mb:
-            # Hitta spam-mapp
+        with imap_session() as mb:
             spam_folder = None
-            folders = mb.folder.list()
-            for f in folders:
+            for f in mb.folder.list():
                 if 'spam' in f.name.lower() or 'junk' in f.name.lower() or 'skräppost' in f.name.lower():
                     spam_folder = f.name
                     break
-            
-            if not spam_folder: return
-
-            # Sök i INBOX
-            mb.folder.set('INBOX')
-            
-            # Hitta UIDs som matchar avsändaren
-            uids_to_move = []
-            # Vi söker i DB först för att få UIDs snabbt
-            with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-                rows = conn.execute("SELECT uid FROM emails WHERE folder='INBOX' AND sender LIKE ?", (f'%{sender}%',)).fetchall()
-                uids_to_move = [str(r[0]) for r in rows]
-            
-            if uids_to_move:
-                try:
-                    mb.move(uids_to_move, spam_folder)
-                except:
-                    mb.copy(uids_to_move, spam_folder)
-                    mb.delete(uids_to_move)
-                
-                # Ta bort från lokal DB (INBOX)
-                with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-                    placeholders = ','.join('?' * len(uids_to_move))
-                    conn.execute(f"DELETE FROM emails WHERE folder='INBOX' AND uid IN ({placeholders})", uids_to_move)
+        if not spam_folder:
+            _update_bulk_job(key, sender=sender, status='skipped', error='Ingen spam-mapp')
+            return
+        move_sender_messages(key, sender, spam_folder, folders)
     except Exception as e: log_event(f"Error moving existing spam: {e}")
 
-def move_existing_ads(sender):
+def move_existing_ads(sender, folders=None):
     # Flytta befintliga mail från denna avsändare till reklam
+    key = f"ads:{sender}"
     try:
-        with get_mailbox() as mb:
-            # Hitta reklam-mapp
+        with imap_session() as mb:
             ad_folder = None
-            folders = mb.folder.list()
-            for f in folders:
+            for f in mb.folder.list():
                 if 'reklam' in f.name.lower():
                     ad_folder = f.name
                     break
-            
-            if not ad_folder: 
+            if not ad_folder:
                 ad_folder = 'INBOX.Reklam'
                 try: mb.folder.create(ad_folder)
                 except: pass
-
-            # Sök i INBOX
-            mb.folder.set('INBOX')
-            
-            # Hitta UIDs som matchar avsändaren
-            uids_to_move = []
-            with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-                rows = conn.execute("SELECT uid FROM emails WHERE folder='INBOX' AND sender LIKE ?", (f'%{sender}%',)).fetchall()
-                uids_to_move = [str(r[0]) for r in rows]
-            
-            if uids_to_move:
-                try:
-                    mb.move(uids_to_move, ad_folder)
-                except:
-                    mb.copy(uids_to_move, ad_folder)
-                    mb.delete(uids_to_move)
-                
-                with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-                    placeholders = ','.join('?' * len(uids_to_move))
-                    conn.execute(f"DELETE FROM emails WHERE folder='INBOX' AND uid IN ({placeholders})", uids_to_move)
+        move_sender_messages(key, sender, ad_folder, folders)
     except Exception as e: log_event(f"Error moving existing ads: {e}")
 
-def apply_labels_to_all():
-    """ Applicera etiketter på alla befintliga mail """
+def get_bulk_jobs():
+    with bulk_jobs_lock:
+        return [dict(job, folders=dict(job.get('folders', {}))) for job in bulk_jobs.values()]
+
+# Etikett-backfill: en ny etikett appliceras på befintliga mail i rowid-ordning, en batch i taget.
+# Varje batch committas tillsammans med sin checkpoint (label_backfill), så jobbet kan återupptas efter omstart.
+LABEL_BACKFILL_BATCH = 2000
+
+def _label_prefilter(keyword, field):
+    """ SQL-villkor som plockar ut kandidater med instr(). FTS5 matchar hela ord/prefix och kan därför inte
+        ersätta delsträngsmatchningen som synken använder ('rea' ska träffa 'area'). SQLites lower() viker
+        bara ASCII, så för nyckelord med å/ä/ö m.m. returneras None och alla rader går till Python-matchningen. """
+    keywords = [k.strip().lower() for k in (keyword or "").split(',') if k.strip()]
+    if not keywords or not all(k.isascii() for k in keywords): return None, []
+    field = (field or 'subject').lower()
+    columns = ['sender'] if field == 'sender' else ['subject', 'sender'] if field == 'both' else ['subject']
+    terms, params = [], []
+    for k in keywords:
+        for col in columns:
+            terms.append(f"instr(lower({col}), ?) > 0")
+            params.append(k)
+    return ' OR '.join(terms), params
+
+def start_label_backfill(label_id):
+    now = time.time()
+    def start(conn):
+        # Mail som kommer in efter max_rowid etiketteras redan av synken
+        max_rowid = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM emails").fetchone()[0]
+        conn.execute("""INSERT OR REPLACE INTO label_backfill (label_id, last_rowid, max_rowid, matched, status, started_at, updated_at)
+                        VALUES (?, 0, ?, 0, 'running', ?, ?)""", (label_id, max_rowid, now, now))
+    db_write(start, priority=PRIORITY_USER)
+    schedule_job(f"label_backfill:{label_id}", backfill_label, (label_id,))
+
+def resume_label_backfills():
+    """ Återuppta backfill-jobb som avbröts av en omstart """
     try:
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-            db_labels = conn.execute("SELECT id, keyword, check_field FROM labels").fetchall()
-            emails = conn.execute("SELECT uid, folder, subject, sender FROM emails").fetchall()
-            
-            updates = []
-            for uid, folder, subj, sender in emails:
-                subj_lower = (subj or "").lower()
-                sender_lower = (sender or "").lower()
-                applied = []
-                for l_id, l_key, l_field in db_labels:
-                    l_field = (l_field or 'subject').lower()
-                    keywords = [k.strip().lower() for k in (l_key or "").split(',') if k.strip()]
-                    is_match = False
-                    
-                    for k in keywords:
-                        if l_field == 'sender':
-                            if k in sender_lower: is_match = True
-                        elif l_field == 'both':
-                            if k in subj_lower or k in sender_lower: is_match = True
-                        else:
-                            if k in subj_lower: is_match = True
-                        if is_match: break
-                        
-                    if is_match: applied.append(l_id)
-                updates.append((json.dumps(applied), uid, folder))
-            conn.executemany("UPDATE emails SET labels=? WHERE uid=? AND folder=?", updates)
-    except Exception as e: log_event(f"Error applying labels: {e}")
+        with db_session(readonly=True) as conn:
+            rows = conn.execute("SELECT label_id FROM label_backfill WHERE status='running'").fetchall()
+        for (label_id,) in rows:
+            schedule_job(f"label_backfill:{label_id}", backfill_label, (label_id,))
+    except Exception as e: log_event(f"Kunde inte återuppta etikett-backfill: {e}")
+
+def backfill_label(label_id):
+    try:
+        with db_session(readonly=True) as conn:
+            label = conn.execute("SELECT id, keyword, check_field FROM labels WHERE id=?", (label_id,)).fetchone()
+            job = conn.execute("SELECT last_rowid, max_rowid FROM label_backfill WHERE label_id=?", (label_id,)).fetchone()
+        if not label or not job: return
+
+        # Bara den här etiketten utvärderas, inte alla etiketter mot alla mail
+        classifier = MessageClassifier([], [label], {})
+        where, params = _label_prefilter(label[1], label[2])
+        last_rowid, max_rowid = job
+
+        def checkpoint(conn, upper, hits):
+            # Checkpoint först: finns inte jobbet längre (etiketten raderad) skrivs inga kopplingar
+            cur = conn.execute("UPDATE label_backfill SET last_rowid=?, matched=matched+?, updated_at=? WHERE label_id=?",
+                               (upper, len(hits), time.time(), label_id))
+            if cur.rowcount == 0: return False
+            conn.executemany("INSERT OR IGNORE INTO email_labels (email_rowid, label_id) VALUES (?, ?)", hits)
+            return True
+
+        while last_rowid < max_rowid:
+            # Läsning och matchning utanför skrivaren; bara kopplingarna och checkpointen köas
+            with db_session(readonly=True) as conn:
+                # Batchgräns efter antal rader (rowid kan ha stora luckor)
+                row = conn.execute("SELECT rowid FROM emails WHERE rowid > ? AND rowid <= ? ORDER BY rowid LIMIT 1 OFFSET ?",
+                                   (last_rowid, max_rowid, LABEL_BACKFILL_BATCH - 1)).fetchone()
+                upper = row[0] if row else max_rowid
+
+                sql = "SELECT rowid, subject, sender FROM emails WHERE rowid > ? AND rowid <= ?"
+                if where: sql += f" AND ({where})"
+                rows = conn.execute(sql, [last_rowid, upper] + params).fetchall()
+            hits = [(r[0], label_id) for r in rows if label_id in classifier.classify(r[1], r[2])['labels']]
+            if not db_write(checkpoint, upper, hits, priority=PRIORITY_BACKGROUND): return
+            last_rowid = upper
+
+        db_write(lambda conn: conn.execute("UPDATE label_backfill SET status='done', updated_at=? WHERE label_id=?", (time.time(), label_id)),
+                 priority=PRIORITY_BACKGROUND)
+    except Exception as e:
+        log_event(f"Etikett-backfill för {label_id} misslyckades: {e}")
+        try:
+            db_write(lambda conn: conn.execute("UPDATE label_backfill SET status='error', updated_at=? WHERE label_id=?", (time.time(), label_id)),
+                     priority=PRIORITY_BACKGROUND)
+        except: pass
+
+def get_label_backfill_status():
+    with db_session(readonly=True) as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute("""SELECT label_backfill.*, labels.name FROM label_backfill
+                               LEFT JOIN labels ON labels.id = label_backfill.label_id ORDER BY started_at DESC""").fetchall()
+    jobs = []
+    for r in rows:
+        job = dict(r)
+        job['progress'] = 100.0 if not r['max_rowid'] else round(100.0 * min(r['last_rowid'], r['max_rowid']) / r['max_rowid'], 1)
+        jobs.append(job)
+    return jobs
 
 def get_language():
     s = load_settings()
@@ -973,28 +3285,45 @@ def add_header(response):
         response.headers['Expires'] = '-1'
     return response
 
+# Databasfilen (enhet, inod) som senast kontrollerats/skapats av init_db; en raderad och återskapad fil får ny inod
+db_checked = {'key': None}
+
+def _db_key():
+    try:
+        st = os.stat(DB_FILE)
+        return (st.st_dev, st.st_ino)
+    except OSError: return None
+
+def ensure_db():
+    """ Säkerställ att databasen finns och har aktuellt schema (om den raderats eller bytts ut). Versionen läses
+        en gång per databasfil; migreringarna körs annars vid start av init_db. """
+    key = _db_key()
+    if key is not None and db_checked['key'] == key: return
+    # Vilande anslutningar pekar på den gamla filen
+    db_pool.close_all()
+    if key is None:
+        init_db()
+    else:
+        with db_session(readonly=True) as conn:
+            version = schema_version(conn)
+        if version < SCHEMA_VERSION: init_db()
+        else: db_checked['key'] = key
+
 @app.before_request
 def require_login():
-    # Säkerställ att databasen finns och har tabeller (om den raderats manuellt)
     if request.endpoint != 'static':
-        if not os.path.exists(DB_FILE):
-            init_db()
-        else:
-            try:
-                with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-                    conn.execute("SELECT 1 FROM emails LIMIT 1")
-            except: init_db()
+        ensure_db()
 
     if request.endpoint in ['static', 'setup', 'save_settings', 'test_connection']:
         return
     
-    if not is_configured():
+    settings = load_settings()
+    if not is_configured(settings):
         return redirect(url_for('setup'))
 
     if request.endpoint == 'login':
         return
 
-    settings = load_settings()
     web_password = settings.get('web_password')
     
     if web_password and not session.get('logged_in'):
@@ -1052,12 +3381,406 @@ def clean_subject(subject):
         if not changed: break
     return clean
 
+# Sökmotor: frågan tolkas till fält-operatorer och kompileras till en SQL-sats (FTS5 + vanliga villkor)
+SEARCH_COUNT_LIMIT = 1000   # Räkna högst så här många träffar; fler visas som "1000+"
+SEARCH_OPERATORS = ('from', 'to', 'subject', 'has', 'filename', 'larger', 'smaller', 'before', 'after', 'in', 'is', 'sort')
+SEARCH_TOKEN_RE = re.compile(r'(-?)(?:(\w+):"([^"]*)"?|(\w+):(\S+)|"([^"]*)"?|(\S+))')
+
+def _like_escape(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _fts_string(text):
+    # Citera som FTS5-sträng så att användarens tecken (-, :, *, AND, NEAR ...) aldrig tolkas som syntax
+    return '"' + text.replace('"', '""') + '"'
+
+def _parse_search_date(value):
+    for fmt in ('%Y-%m-%d', '%Y/%m/%d', '%Y%m%d', '%Y-%m'):
+        try: return datetime.strptime(value, fmt).date()
+        except ValueError: pass
+    return None
+
+def day_start_ts(day):
+    """ emails.ts för midnatt (svensk tid) den dagen """
+    return int((datetime(day.year, day.month, day.day, tzinfo=SWE_TZ) - UTC_EPOCH).total_seconds())
+
+def _parse_search_size(value):
+    # 10M, 500k, 2mb, 1048576
+    m = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([kmg]?)b?', value.strip().lower())
+    if not m: return None
+    return int(float(m.group(1)) * {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}[m.group(2)])
+
+def parse_search_query(query):
+    """ Dela upp en sökfråga i fritext och operatorer (from:, to:, subject:, has:attachment, filename:,
+        larger:/smaller:, before:/after:, in:, is:unread/read/starred, sort:relevance). Okända operatorer söks som text. """
+    parsed = {'terms': [], 'exclude': [], 'from': [], 'to': [], 'subject': [], 'filename': [],
+              'has_attachment': False, 'larger': None, 'smaller': None, 'before': None, 'after': None, 'in': None, 'is': set(), 'sort': 'date'}
+    for m in SEARCH_TOKEN_RE.finditer(query or ''):
+        negate = m.group(1) == '-'
+        op = (m.group(2) or m.group(4) or '').lower()
+        value = m.group(3) if m.group(2) else m.group(5)
+        if op and op not in SEARCH_OPERATORS:
+            op, value = '', m.group(0).lstrip('-')
+        if not op:
+            text = m.group(6) if m.group(6) is not None else (value if value is not None else m.group(7))
+            text = (text or '').strip()
+            if not text: continue
+            if text.startswith('*.') and len(text) > 2:
+                # Gammal syntax för bilagesökning (*.pdf)
+                parsed['filename'].append(text[1:])
+            else:
+                parsed['exclude' if negate else 'terms'].append(text)
+            continue
+
+        value = (value or '').strip()
+        if not value: continue
+        if op in ('from', 'to', 'subject', 'filename'):
+            parsed[op].append(value)
+        elif op == 'has':
+            if value.lower() in ('attachment', 'attachments', 'bilaga', 'bilagor'): parsed['has_attachment'] = True
+        elif op in ('larger', 'smaller'):
+            size = _parse_search_size(value)
+            if size is not None: parsed[op] = size
+            else: parsed['terms'].append(f"{op}:{value}")
+        elif op in ('before', 'after'):
+            d = _parse_search_date(value)
+            if d: parsed[op] = d
+            else: parsed['terms'].append(f"{op}:{value}")
+        elif op == 'in':
+            parsed['in'] = value
+        elif op == 'is':
+            parsed['is'].add(value.lower())
+        elif op == 'sort':
+            parsed['sort'] = 'relevance' if value.lower() in ('relevance', 'rank', 'relevans') else 'date'
+    return parsed
+
+def build_search_sql(parsed, columns="emails.*"):
+    """ Returnerar (from_where_sql, params, order_sql). Fritext och subject:/from: går via FTS5, resten som villkor på emails. """
+    fts_parts = [_fts_string(t) + '*' for t in parsed['terms']]
+    fts_parts += ['subject : ' + _fts_string(t) + '*' for t in parsed['subject']]
+    fts_parts += ['sender : ' + _fts_string(t) + '*' for t in parsed['from']]
+    fts_query = ' AND '.join(fts_parts)
+    if fts_query and parsed['exclude']:
+        fts_query += ''.join(' NOT ' + _fts_string(t) for t in parsed['exclude'])
+
+    where, params = [], []
+    if fts_query:
+        sql = f"SELECT {columns} FROM emails_fts JOIN emails ON emails.rowid = emails_fts.rowid"
+        where.append("emails_fts MATCH ?")
+        params.append(fts_query)
+    else:
+        sql = f"SELECT {columns} FROM emails"
+        for t in parsed['exclude']:
+            where.append("NOT (emails.subject LIKE ? ESCAPE '\\' OR emails.sender LIKE ? ESCAPE '\\')")
+            params += [f"%{_like_escape(t)}%"] * 2
+
+    for t in parsed['to']:
+        where.append("emails.recipients LIKE ? ESCAPE '\\'")
+        params.append(f"%{_like_escape(t)}%")
+    # Bilagevillkor går via tabellen attachments och dess index (ext, filename, size)
+    if parsed['has_attachment']:
+        where.append("emails.rowid IN (SELECT email_rowid FROM attachments WHERE is_inline = 0)")
+    for name in parsed['filename']:
+        if name.startswith('.') and '*' not in name:
+            where.append("emails.rowid IN (SELECT email_rowid FROM attachments WHERE ext = ?)")
+            params.append(name[1:].lower())
+        else:
+            # report* blir ett prefix (indexerat via NOCASE-kolumnen), annars delsträng
+            pattern = _like_escape(name).replace('*', '%') if '*' in name else f"%{_like_escape(name)}%"
+            where.append("emails.rowid IN (SELECT email_rowid FROM attachments WHERE filename LIKE ? ESCAPE '\\')")
+            params.append(pattern)
+    if parsed['larger'] is not None:
+        where.append("emails.rowid IN (SELECT email_rowid FROM attachments WHERE size >= ?)")
+        params.append(parsed['larger'])
+    if parsed['smaller'] is not None:
+        where.append("emails.rowid IN (SELECT email_rowid FROM attachments WHERE size < ? AND is_inline = 0)")
+        params.append(parsed['smaller'])
+    # after:/before: avser dagar i svensk tid
+    if parsed['after']:
+        where.append("emails.ts >= ?")
+        params.append(day_start_ts(parsed['after']))
+    if parsed['before']:
+        where.append("emails.ts < ?")
+        params.append(day_start_ts(parsed['before']))
+    if parsed['in']:
+        if parsed['in'].upper() == 'STARRED':
+            where.append("emails.flagged = 1")
+        elif parsed['in'].lower() not in ('anywhere', 'all', 'alla'):
+            where.append("emails.folder = ? COLLATE NOCASE")
+            params.append(parsed['in'])
+    for flag in parsed['is']:
+        if flag in ('unread', 'oläst'): where.append("emails.seen = 0")
+        elif flag in ('read', 'läst'): where.append("emails.seen = 1")
+        elif flag in ('starred', 'flagged', 'stjärnmärkt'): where.append("emails.flagged = 1")
+        elif flag in ('draft', 'utkast'): where.append("emails.is_draft = 1")
+    where.append("emails.uid IS NOT NULL AND emails.uid != 0")
+
+    sql += " WHERE " + " AND ".join(where)
+    if fts_query and parsed['sort'] == 'relevance':
+        order = " ORDER BY bm25(emails_fts, 10.0, 5.0, 1.0), emails.ts DESC"
+    else:
+        order = " ORDER BY emails.ts DESC, emails.uid DESC"
+    return sql, params, order
+
+def run_search(conn, query, limit, offset=0, columns=None):
+    """ Kör en sökning. Returnerar (rader, antal, antal_är_tak). Antalet räknas högst till SEARCH_COUNT_LIMIT. """
+    parsed = parse_search_query(query)
+    columns = columns or LISTING_COLUMNS
+    sql, params, order = build_search_sql(parsed, columns)
+    count_sql, count_params, _ = build_search_sql(parsed, "1")
+    try:
+        rows = conn.execute(sql + order + " LIMIT ? OFFSET ?", params + [limit, offset]).fetchall()
+        total = conn.execute(f"SELECT COUNT(*) FROM ({count_sql} LIMIT ?)", count_params + [SEARCH_COUNT_LIMIT + 1]).fetchone()[0]
+    except sqlite3.OperationalError as e:
+        # Ska inte hända eftersom all fritext citeras, men en trasig fråga får aldrig krascha vyn
+        log_event(f"Sökfel för '{query}': {e}")
+        return [], 0, False
+    capped = total > SEARCH_COUNT_LIMIT
+    return rows, min(total, SEARCH_COUNT_LIMIT), capped
+
+# /api/threads pagineras med markör (keyset) i ordningen ts DESC, uid DESC, rowid i stället för OFFSET:
+# djupa sidor blir lika snabba som första sidan och nya mail förskjuter inte nästa sida. rowid skiljer mail från
+# olika mappar med samma ts och uid (STARRED, LABEL:); stigande eftersom det är så rowid ligger sist i indexen,
+# så ingen extra sortering behövs. Mail utan datum kommer sist (uid DESC, rowid). Relevanssorterad sökning har ingen stabil nyckel och använder offset.
+THREADS_PAGE_SIZE = 50
+THREADS_PAGE_MAX = 200
+
+def encode_cursor(data):
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """ Markör från encode_cursor -> {'t': ts|None, 'u': uid, 'r': rowid} eller {'o': offset}. Ogiltig markör ger ValueError. """
+    if not cursor: return None
+    data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+    if not isinstance(data, dict): raise ValueError(cursor)
+    if 'o' in data: return {'o': max(0, int(data['o']))}
+    # Markörer från före ts ('d': date_iso) saknar 't' och de från före rowid-nyckeln saknar 'r'; båda avvisas
+    if 't' not in data or 'r' not in data or (data['t'] is not None and type(data['t']) is not int): raise ValueError(cursor)
+    return {'t': data['t'], 'u': int(data['u']), 'r': int(data['r'])}
+
+def keyset_fetch(conn, base_sql, params, cursor, limit):
+    """ Hämta limit rader efter markören. base_sql är 'SELECT ... FROM ... WHERE ...' utan ORDER BY.
+        Daterade rader hämtas via radvärdesjämförelsen (indexsökning), datumlösa i ett andra steg. """
+    rows = []
+    if cursor is None or cursor['t'] is not None:
+        cond, cond_params = ("", []) if cursor is None else (
+            " AND (emails.ts, emails.uid) <= (?, ?) AND NOT ((emails.ts, emails.uid) = (?, ?) AND emails.rowid <= ?)",
+            [cursor['t'], cursor['u'], cursor['t'], cursor['u'], cursor['r']])
+        rows = conn.execute(base_sql + " AND emails.ts IS NOT NULL" + cond + " ORDER BY emails.ts DESC, emails.uid DESC, emails.rowid LIMIT ?",
+                            params + cond_params + [limit + 1]).fetchall()
+    if len(rows) <= limit:
+        cond, cond_params = (" AND emails.uid <= ? AND NOT (emails.uid = ? AND emails.rowid <= ?)", [cursor['u'], cursor['u'], cursor['r']]) \
+            if cursor and cursor['t'] is None else ("", [])
+        rows += conn.execute(base_sql + " AND emails.ts IS NULL" + cond + " ORDER BY emails.uid DESC, emails.rowid LIMIT ?",
+                             params + cond_params + [limit + 1 - len(rows)]).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor({'t': rows[-1]['ts'], 'u': rows[-1]['uid'], 'r': rows[-1]['rowid']})
+    return rows, next_cursor
+
+def list_page(conn, folder, query='', cursor=None, limit=THREADS_PAGE_SIZE, columns=None):
+    """ En sida listrader för mapp, LABEL:<id>, STARRED eller sökning. Returnerar (rader, nästa markör eller None). """
+    columns = columns or LISTING_COLUMNS
+    if query:
+        parsed = parse_search_query(query)
+        sql, params, order = build_search_sql(parsed, columns)
+        if 'bm25(' in order:
+            offset = cursor['o'] if cursor and 'o' in cursor else 0
+            rows = conn.execute(sql + order + " LIMIT ? OFFSET ?", params + [limit + 1, offset]).fetchall()
+            next_cursor = encode_cursor({'o': offset + limit}) if len(rows) > limit else None
+            return rows[:limit], next_cursor
+        if cursor and 'o' in cursor: raise ValueError("offset cursor for keyset listing")
+        return keyset_fetch(conn, sql, params, cursor, limit)
+    if cursor and 'o' in cursor: raise ValueError("offset cursor for keyset listing")
+    if folder == 'STARRED':
+        sql, params = f"SELECT {columns} FROM emails WHERE emails.flagged = 1 AND emails.uid IS NOT NULL AND emails.uid != 0", []
+    elif folder.startswith('LABEL:'):
+        sql = f"SELECT {columns} FROM email_labels JOIN emails ON emails.rowid = email_labels.email_rowid WHERE email_labels.label_id = ?"
+        params = [int(folder.split(':', 1)[1])]
+    else:
+        sql, params = f"SELECT {columns} FROM emails WHERE emails.folder = ? AND emails.uid IS NOT NULL AND emails.uid != 0", [folder]
+    return keyset_fetch(conn, sql, params, cursor, limit)
+
+# Mappvyn i index() pagineras per tråd: trådar med mail i mappen sorteras på mappens senaste mail (idx_emails_folder_thread_ts).
+# Rader som ännu inte trådats (thread_id NULL) räknas som egna trådar med nyckeln -rowid.
+FOLDER_THREADS_SQL = """SELECT emails.thread_id AS tkey, MAX(emails.ts) AS last FROM emails
+        WHERE emails.folder = ? AND emails.thread_id IS NOT NULL AND emails.uid IS NOT NULL AND emails.uid != 0 GROUP BY emails.thread_id
+    UNION ALL
+    SELECT -emails.rowid, emails.ts FROM emails
+        WHERE emails.folder = ? AND emails.thread_id IS NULL AND emails.uid IS NOT NULL AND emails.uid != 0"""
+
+def folder_thread_page(conn, folder, limit, offset=0):
+    """ En sida trådar i mappen. Returnerar (listrader nyast först, antal trådar). """
+    # Antalet räknas i samma genomläsning (fönsterfunktion) i stället för en separat COUNT
+    page = conn.execute(f"""SELECT tkey, COUNT(*) OVER () FROM ({FOLDER_THREADS_SQL})
+                            ORDER BY last DESC, tkey DESC LIMIT ? OFFSET ?""", (folder, folder, limit, offset)).fetchall()
+    keys = [r[0] for r in page]
+    total = page[0][1] if page else (conn.execute(f"SELECT COUNT(*) FROM ({FOLDER_THREADS_SQL})", (folder, folder)).fetchone()[0] if offset else 0)
+    thread_ids = [k for k in keys if k > 0]
+    rowids = [-k for k in keys if k < 0]
+    rows = []
+    if thread_ids:
+        rows += conn.execute(f"""SELECT {LISTING_COLUMNS} FROM emails WHERE emails.folder = ? AND emails.thread_id IN ({','.join('?' * len(thread_ids))})
+                                 AND emails.uid IS NOT NULL AND emails.uid != 0""", [folder] + thread_ids).fetchall()
+    if rowids:
+        rows += conn.execute(f"SELECT {LISTING_COLUMNS} FROM emails WHERE emails.rowid IN ({','.join('?' * len(rowids))})", rowids).fetchall()
+    rows.sort(key=lambda r: (r['ts'] is not None, r['ts'] or 0, r['uid']), reverse=True)
+    return rows, total
+
+# Visning i listan: delas av index() och /api/threads
+MONTHS_SV = ["jan", "feb", "mar", "apr", "maj", "jun", "jul", "aug", "sep", "okt", "nov", "dec"]
+# Svensk tidszon (UTC+1) för att fixa 1 timmes felvisning
+SWE_TZ = timezone(timedelta(hours=1))
+SWE_EPOCH = UTC_EPOCH.astimezone(SWE_TZ)
+GENERIC_SENDER_NAMES = ['info', 'kontakt', 'contact', 'support', 'admin', 'noreply', 'no-reply', 'hello', 'hej', 'order', 'sales', 'salj', 'faktura', 'invoice', 'team', 'nyhetsbrev', 'kundservice', 'kundtjanst']
+
+def is_sent_or_draft_folder(folder):
+    folder = folder.lower()
+    return 'sent' in folder or 'skickat' in folder or 'draft' in folder or 'utkast' in folder
+
+def is_draft_folder_name(folder):
+    return 'draft' in folder.lower() or 'utkast' in folder.lower()
+
+def list_sender(msg, folder):
+    """ (visningsnamn, fullständig avsändare). I skickat/utkast visas mottagaren. """
+    sender = msg.from_ or "Okänd"
+    if is_sent_or_draft_folder(folder):
+        if getattr(msg, 'recipients', None):
+            sender = f"Till: {msg.recipients}"
+        return sender, sender
+
+    full_sender = sender
+    email_address = ""
+    # Extrahera namn och e-post
+    if '<' in sender and '>' in sender:
+        try:
+            parts = sender.split('<')
+            name_part = parts[0].strip().replace('"', '')
+            email_address = parts[1].strip('>').strip()
+            sender = name_part if name_part else email_address
+        except:
+            email_address = sender
+    else:
+        email_address = sender
+
+    # Förbättra namnet om det är generiskt (t.ex. "Info" -> "Företagsnamn")
+    if '@' in email_address:
+        try:
+            local_part, domain = email_address.split('@')
+            current_name_lower = sender.lower().strip()
+            is_generic = (current_name_lower in GENERIC_SENDER_NAMES) or \
+                         (current_name_lower == local_part.lower() and local_part.lower() in GENERIC_SENDER_NAMES) or \
+                         (current_name_lower == email_address.lower() and local_part.lower() in GENERIC_SENDER_NAMES)
+
+            if is_generic:
+                # Använd domänen som namn (t.ex. loopia.se -> Loopia)
+                domain_parts = domain.split('.')
+                if len(domain_parts) >= 2:
+                    company_name = domain_parts[0].title()
+                    # Undvik subdomäner som 'mail', 'smtp'
+                    if company_name.lower() in ['mail', 'smtp', 'webmail'] and len(domain_parts) > 2:
+                        company_name = domain_parts[1].title()
+                    sender = company_name
+            elif sender == email_address:
+                # Snygga till local part om inget namn fanns
+                sender = local_part.replace('.', ' ').replace('_', ' ').title()
+        except: pass
+    return sender, full_sender
+
+def local_datetime(msg):
+    """ Mailets datum i svensk tid, eller None om det saknas (1970 och tidigare räknas som saknat) """
+    ts = getattr(msg, 'ts', None)
+    if ts is not None:
+        local_date = SWE_EPOCH + timedelta(seconds=ts)
+    else:
+        d = msg.date
+        if not d: return None
+        if d.tzinfo is None:
+            d = d.replace(tzinfo=timezone.utc)
+        local_date = d.astimezone(SWE_TZ)
+    return local_date if local_date.year > 1970 else None
+
+def list_date(msg, now=None):
+    """ Datumformatering likt Gmail: klockslag i dag, 'mar 5' i år, annars ÅÅÅÅ-MM-DD """
+    local_date = local_datetime(msg)
+    if local_date is None: return ""
+    now = now or datetime.now(SWE_TZ)
+    if local_date.date() == now.date():
+        return local_date.strftime('%H:%M')
+    if local_date.year == now.year:
+        return f"{MONTHS_SV[local_date.month-1]} {local_date.day}"
+    return local_date.strftime('%Y-%m-%d')
+
+def thread_key(msg, folder):
+    """ Tråd-id för listan: threads.id (se thread_messages). Utkastmappar visar varje utkast för sig;
+        rader som inte hunnit trådas grupperas på rensat ämne som tidigare. """
+    if is_draft_folder_name(folder):
+        return hashlib.md5(f"{msg.uid}_{getattr(msg, 'original_folder', folder)}".encode()).hexdigest()
+    if msg.thread_id:
+        return str(msg.thread_id)
+    if not msg.subject or not msg.subject.strip():
+        return hashlib.md5(f"{msg.uid}_{getattr(msg, 'original_folder', folder)}".encode()).hexdigest()
+    return hashlib.md5(clean_subject(msg.subject).lower().encode()).hexdigest()
+
+def thread_summaries(mails, folder):
+    """ Gruppera en sida MockMsg (nyast först) till trådsammanfattningar i listordning """
+    threads = {}
+    now = datetime.now(SWE_TZ)
+    for msg in mails:
+        tid = thread_key(msg, folder)
+        sender, full_sender = list_sender(msg, folder)
+        msg_folder = getattr(msg, 'original_folder', folder)
+        t = threads.get(tid)
+        if t is None:
+            local_date = local_datetime(msg)
+            t = threads[tid] = {'id': tid, 'subject': clean_subject(msg.subject), 'snippet': msg.snippet, 'from': sender,
+                                'date': list_date(msg, now), 'date_iso': local_date.isoformat() if local_date else None,
+                                'unread': False, 'starred': False, 'has_draft': False, 'labels': [], 'attachments': [], 'messages': []}
+        if not msg.seen: t['unread'] = True
+        if msg.flagged or folder == 'STARRED': t['starred'] = True
+        if msg.is_draft: t['has_draft'] = True
+        for l in msg.labels:
+            if l not in t['labels']: t['labels'].append(l)
+        for att in msg.attachments_data:
+            if not any(a['filename'] == att['filename'] for a in t['attachments']):
+                t['attachments'].append(dict(att, uid=str(msg.uid), folder=msg_folder))
+        t['messages'].append({'uid': str(msg.uid), 'folder': msg_folder, 'from': sender, 'from_full': full_sender,
+                              'date': list_date(msg, now), 'recipients': msg.recipients, 'seen': msg.seen,
+                              'flagged': msg.flagged, 'is_draft': msg.is_draft, 'attachments': msg.attachments_data})
+    return list(threads.values())
+
+@app.route('/api/threads')
+def api_threads():
+    """ Trådsammanfattningar som JSON för oändlig scroll och delvis omritning.
+        ?folder= (mapp, LABEL:<id>, STARRED), ?q= (sökning), ?cursor= (next_cursor från förra svaret), ?limit= (högst THREADS_PAGE_MAX).
+        En tråd kan fortsätta på nästa sida; klienten slår ihop på id. """
+    folder = request.args.get('folder', 'INBOX')
+    query = request.args.get('q', '').strip()
+    try:
+        limit = max(1, min(int(request.args.get('limit', THREADS_PAGE_SIZE)), THREADS_PAGE_MAX))
+        cursor = decode_cursor(request.args.get('cursor'))
+    except (ValueError, KeyError, TypeError):
+        return Response(json.dumps({'error': 'Ogiltig markör eller gräns'}), status=400, mimetype='application/json')
+
+    try:
+        with db_session(readonly=True) as conn:
+            conn.row_factory = sqlite3.Row
+            rows, next_cursor = list_page(conn, folder, query, cursor, limit)
+            mails = [MockMsg(row) for row in rows]
+            load_attachment_chips(conn, mails)
+    except (ValueError, sqlite3.OperationalError) as e:
+        log_event(f"/api/threads: {e}")
+        return Response(json.dumps({'error': str(e)}), status=400, mimetype='application/json')
+
+    return Response(json.dumps({'threads': thread_summaries(mails, folder), 'next_cursor': next_cursor}), mimetype='application/json')
+
 @app.route('/')
 def index():
     folder = request.args.get('folder', 'INBOX')
     query = request.args.get('q', '').strip()
     page = int(request.args.get('page', 1))
     per_page = 50
+    total_capped = False
     settings = load_settings()
     lang = get_language()
     t = get_translations(lang)
@@ -1069,13 +3792,16 @@ def index():
     # Lägg till Stjärnmärkt manuellt
     folders_data.append({'id': 'STARRED', 'name': t['starred'], 'icon': 'star.png', 'is_system': True, 'is_image': True})
 
-    if folder != 'STARRED':
-        threading.Thread(target=sync_worker, args=(folder,), daemon=True).start()
-        # Fix: Om mappen är tom lokalt, vänta en kort stund så vi hinner hämta mail
+    # Bevakade mappar (INBOX, utkast) hålls uppdaterade via IDLE i bakgrunden, så sidladdningen läser bara lokalt
+    ensure_idle_watchers()
+
+    if folder != 'STARRED' and not folder.startswith('LABEL:') and not is_folder_watched(folder):
+        schedule_sync(folder, PRIORITY_USER)
+        # En mapp som aldrig synkats är tom lokalt: vänta (högst FIRST_SYNC_WAIT) på första synken.
+        # Synkade mappar, även tomma, läses direkt
         try:
-            with sqlite3.connect(DB_FILE, timeout=5.0) as conn:
-                if conn.execute("SELECT COUNT(*) FROM emails WHERE folder=?", (folder,)).fetchone()[0] == 0:
-                    time.sleep(1.5)
+            if get_folder_sync_state(folder) is None:
+                sync_scheduler.wait_idle(f"sync:{folder}", FIRST_SYNC_WAIT)
         except: pass
         
         # FIX: Synka även utkast-mappar när vi är i Inkorgen för att garantera att utkast syns/uppdateras direkt
@@ -1083,7 +3809,7 @@ def index():
             draft_folders = ['INBOX.Drafts', 'Drafts', 'Utkast', 'INBOX.Utkast']
             # Hämta kända mappar från DB
             try:
-                with sqlite3.connect(DB_FILE, timeout=5.0) as conn:
+                with db_session(readonly=True) as conn:
                     rows = conn.execute("SELECT name FROM local_folders").fetchall()
                     for r in rows:
                         name = r[0]
@@ -1092,25 +3818,29 @@ def index():
             except: pass
             
             for df in set(draft_folders): # set för att undvika dubbletter
-                threading.Thread(target=sync_worker, args=(df,), daemon=True).start()
+                if not is_folder_watched(df):
+                    schedule_sync(df)
 
-    # Starta mapp-synk i bakgrunden
-    threading.Thread(target=sync_folder_structure, daemon=True).start()
+    # Starta mapp-synk i bakgrunden (annars sköts den av INBOX-bevakaren när den ansluter)
+    if not is_folder_watched('INBOX'):
+        schedule_folder_structure_sync()
 
     # Hämta etikett-definitioner och lista för sidebar
     labels_map = {}
     labels_list = []
-    with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+    with db_session(readonly=True) as conn:
         conn.row_factory = sqlite3.Row
         for r in conn.execute("SELECT * FROM labels ORDER BY name").fetchall():
             labels_list.append(dict(r))
             labels_map[r['id']] = {'name': r['name'], 'color': r['color']}
+        # Olästa/totalt för hela sidofältet i en omgång (triggerunderhållna räknare)
+        counts = get_counts(conn)
 
     try:
         # Hämta mappar från lokal DB istället för IMAP (Mycket snabbare)
         icons_map = get_folder_icons_map()
         all_folders = []
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+        with db_session(readonly=True) as conn:
             try:
                 rows = conn.execute("SELECT name FROM local_folders").fetchall()
                 for r in rows:
@@ -1123,7 +3853,7 @@ def index():
         # Fallback: Om inga mappar finns (första körning), hämta synkront
         if not all_folders:
             sync_folder_structure()
-            with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+            with db_session(readonly=True) as conn:
                 rows = conn.execute("SELECT name FROM local_folders").fetchall()
                 for r in rows:
                     class MockFolder: pass
@@ -1149,156 +3879,58 @@ def index():
                 trash_folder_id = f['id']
                 break
         
-        local_status = get_local_status(folder)
-        star_status = get_star_status(folder)
-        
         if folder == 'STARRED':
-            # Hämta alla stjärnmärkta mail från alla mappar
-            starred_entries = set()
-            if os.path.exists(STAR_STATUS_FILE):
-                try:
-                    with open(STAR_STATUS_FILE) as f:
-                        all_stars = json.load(f)
-                        for fldr, uids in all_stars.items():
-                            for uid, is_starred in uids.items():
-                                if is_starred:
-                                    try: starred_entries.add((fldr, int(uid)))
-                                    except: pass
-                except: pass
-            
-            mails = []
-            if starred_entries:
-                with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-                    conn.row_factory = sqlite3.Row
-                    for fldr, uid in starred_entries:
-                        try:
-                            row = conn.execute("SELECT * FROM emails WHERE folder=? AND uid=?", (fldr, uid)).fetchone()
-                            if row:
-                                mails.append(MockMsg(row))
-                        except: pass
-            
-            mails.sort(key=lambda x: x.date, reverse=True)
-            
-            total = len(mails)
-            mails = mails[(page-1)*per_page : page*per_page]
+            # Stjärnmärkta mail från alla mappar; sortering och paginering via det partiella indexet idx_emails_starred_ts
+            with db_session(readonly=True) as conn:
+                conn.row_factory = sqlite3.Row
+                # +uid: hindra planeraren från att välja primärnyckeln (uid > 0) framför det partiella indexet
+                total = conn.execute("SELECT COUNT(*) FROM emails WHERE flagged=1 AND +uid IS NOT NULL AND +uid != 0").fetchone()[0]
+                rows = conn.execute(f"SELECT {LISTING_COLUMNS} FROM emails WHERE flagged=1 AND uid IS NOT NULL AND uid != 0 ORDER BY ts DESC, uid DESC LIMIT ? OFFSET ?", (per_page, (page-1)*per_page)).fetchall()
+                mails = [MockMsg(row) for row in rows]
+                load_attachment_chips(conn, mails)
 
         elif query:
-            # Sök i lokal databas (Blixtsnabbt)
-            with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+            # Sök i lokal databas; sortering, paginering och (begränsad) räkning sker i SQLite
+            with db_session(readonly=True) as conn:
                 conn.row_factory = sqlite3.Row
-                clean_query = query.replace('"', '').strip()
-                
-                if clean_query.startswith('*.'):
-                    # Sökning på bilagor (t.ex. *.pdf)
-                    ext = clean_query[1:]
-                    rows = conn.execute("SELECT * FROM emails WHERE attachments LIKE ? ORDER BY date_iso DESC, uid DESC", (f'%{ext}"%',)).fetchall()
-                else:
-                    # FTS sökning
-                    fts_query = f'{clean_query}*'
-                    rows = conn.execute("SELECT * FROM emails WHERE rowid IN (SELECT rowid FROM emails_fts WHERE emails_fts MATCH ? ORDER BY rank) ORDER BY date_iso DESC, uid DESC", (fts_query,)).fetchall()
-                
-                mails = []
-                for row in rows:
-                    # Simulera objektstruktur för loopen nedan
-                    m = MockMsg(row)
-                    mails.append(m)
-                
-                total = len(mails)
-                # Paginering för sökresultat
-                mails = mails[(page-1)*per_page : page*per_page]
+                rows, total, total_capped = run_search(conn, query, per_page, (page-1)*per_page)
+                mails = [MockMsg(row) for row in rows]
+                load_attachment_chips(conn, mails)
+                if total_capped and len(rows) == per_page:
+                    # Det finns fler träffar än vi räknat; tillåt alltid nästa sida
+                    total = max(total, page * per_page + 1)
 
         elif folder.startswith('LABEL:'):
             try:
                 label_id = int(folder.split(':')[1])
-                with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+                with db_session(readonly=True) as conn:
                     conn.row_factory = sqlite3.Row
-                    # Hämta alla mail som har etiketter och filtrera i Python
-                    # Optimering: Använd LIKE för att grovsortera i SQL (mycket snabbare än att hämta allt)
-                    # Vi söker på label_id som del av strängen. Python-loopen nedan verifierar exakt matchning.
-                    like_pattern = f'%{label_id}%'
-                    all_labeled = conn.execute("SELECT uid, labels, date_iso FROM emails WHERE labels LIKE ? ORDER BY date_iso DESC", (like_pattern,)).fetchall()
-                    
-                    filtered_uids = []
-                    for r in all_labeled:
-                        try:
-                            if label_id in json.loads(r['labels']):
-                                filtered_uids.append(r['uid'])
-                        except: pass
-                    
-                    total = len(filtered_uids)
-                    page_uids = filtered_uids[(page-1)*per_page : page*per_page]
-                    
-                    if page_uids:
-                        placeholders = ','.join('?' * len(page_uids))
-                        rows = conn.execute(f"SELECT * FROM emails WHERE uid IN ({placeholders})", page_uids).fetchall()
-                        rows.sort(key=lambda x: x['date_iso'] or '', reverse=True)
-                        mails = [MockMsg(row) for row in rows]
-                    else: mails = []
+                    # Medlemskap via idx_email_labels_label; sidan sorteras och pagineras i SQL
+                    row = conn.execute("SELECT total FROM label_counts WHERE label_id=?", (label_id,)).fetchone()
+                    total = row[0] if row else 0
+                    rows = conn.execute(f"""SELECT {LISTING_COLUMNS} FROM email_labels
+                        JOIN emails ON emails.rowid = email_labels.email_rowid
+                        WHERE email_labels.label_id=? ORDER BY emails.ts DESC, emails.uid DESC LIMIT ? OFFSET ?""",
+                        (label_id, per_page, (page-1)*per_page)).fetchall()
+                    mails = [MockMsg(row) for row in rows]
+                    load_attachment_chips(conn, mails)
             except: mails = []
 
         else:
-            # DB fetch for speed (Fix Issue 1 & 3)
-            with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+            # Mappvyn pagineras per tråd i SQL; sidan innehåller trådarnas alla mail i mappen
+            with db_session(readonly=True) as conn:
                 conn.row_factory = sqlite3.Row
-                total = conn.execute("SELECT COUNT(*) FROM emails WHERE folder=? AND uid IS NOT NULL AND uid != 0", (folder,)).fetchone()[0]
-                rows = conn.execute("SELECT * FROM emails WHERE folder=? AND uid IS NOT NULL AND uid != 0 ORDER BY date_iso DESC, uid DESC LIMIT ? OFFSET ?", (folder, per_page, (page-1)*per_page)).fetchall()
+                rows, total = folder_thread_page(conn, folder, per_page, (page-1)*per_page)
                 mails = [MockMsg(row) for row in rows]
+                load_attachment_chips(conn, mails)
 
-        months_sv = ["jan", "feb", "mar", "apr", "maj", "jun", "jul", "aug", "sep", "okt", "nov", "dec"]
-        # Svensk tidszon (UTC+1) för att fixa 1 timmes felvisning
-        swe_tz = timezone(timedelta(hours=1))
-        now = datetime.now(swe_tz)
+        now = datetime.now(SWE_TZ)
 
         threads = {}
         isolated_drafts = []
 
         for msg in mails:
-            sender = msg.from_ or "Okänd"
-            
-            if 'sent' in folder.lower() or 'skickat' in folder.lower() or 'draft' in folder.lower() or 'utkast' in folder.lower():
-                if hasattr(msg, 'recipients') and msg.recipients:
-                    sender = f"Till: {msg.recipients}"
-                full_sender = sender
-            else:
-                full_sender = sender
-                email_address = ""
-                
-                # Extrahera namn och e-post
-                if '<' in sender and '>' in sender:
-                    try:
-                        parts = sender.split('<')
-                        name_part = parts[0].strip().replace('"', '')
-                        email_address = parts[1].strip('>').strip()
-                        sender = name_part if name_part else email_address
-                    except: 
-                        email_address = sender
-                else:
-                    email_address = sender
-
-                # Förbättra namnet om det är generiskt (t.ex. "Info" -> "Företagsnamn")
-                if '@' in email_address:
-                    try:
-                        local_part, domain = email_address.split('@')
-                        generic_names = ['info', 'kontakt', 'contact', 'support', 'admin', 'noreply', 'no-reply', 'hello', 'hej', 'order', 'sales', 'salj', 'faktura', 'invoice', 'team', 'nyhetsbrev', 'kundservice', 'kundtjanst']
-                        
-                        current_name_lower = sender.lower().strip()
-                        is_generic = (current_name_lower in generic_names) or \
-                                     (current_name_lower == local_part.lower() and local_part.lower() in generic_names) or \
-                                     (current_name_lower == email_address.lower() and local_part.lower() in generic_names)
-
-                        if is_generic:
-                            # Använd domänen som namn (t.ex. loopia.se -> Loopia)
-                            domain_parts = domain.split('.')
-                            if len(domain_parts) >= 2:
-                                company_name = domain_parts[0].title()
-                                # Undvik subdomäner som 'mail', 'smtp'
-                                if company_name.lower() in ['mail', 'smtp', 'webmail'] and len(domain_parts) > 2:
-                                    company_name = domain_parts[1].title()
-                                sender = company_name
-                        elif sender == email_address:
-                            # Snygga till local part om inget namn fanns
-                            sender = local_part.replace('.', ' ').replace('_', ' ').title()
-                    except: pass
+            sender, full_sender = list_sender(msg, folder)
 
             # Robust subject cleaning (case-insensitive prefix removal)
             clean_subj = clean_subject(msg.subject)
@@ -1320,75 +3952,19 @@ def index():
                 isolated_drafts.append(msg)
                 continue
 
-            # Logik för trådning (för vanliga mail)
-            is_draft_folder = 'draft' in folder.lower() or 'utkast' in folder.lower()
-            has_no_subject = not msg.subject or not msg.subject.strip()
-            
-            if is_draft_folder or has_no_subject:
-                unique_key = f"{msg.uid}_{getattr(msg, 'original_folder', folder)}"
-                tid = hashlib.md5(unique_key.encode()).hexdigest()
-            else:
-                # FIX: Gruppera endast på ämne (case-insensitive) för att hålla ihop konversationer korrekt
-                tid = hashlib.md5(clean_subj.lower().encode()).hexdigest()
+            # Logik för trådning (för vanliga mail): gruppera på rensat ämne, se thread_key
+            tid = thread_key(msg, folder)
 
             if tid not in threads: threads[tid] = {'subject': clean_subj, 'msgs': [], 'unread': False, 'starred': False, 'thread_attachments': [], 'labels': set()}
 
-            # Hantera MockMsg (från DB) vs IMAP Message
-            if hasattr(msg, 'attachments_data'):
-                body_html = msg.html
-                if not body_html and msg.text:
-                    body_html = f"<pre>{msg.text}</pre>"
-                atts = msg.attachments_data
-            else:
-                # Fallback för direkta IMAP-objekt (om det skulle användas)
-                body_html = msg.html or f"<pre>{msg.text}</pre>"
-                for att in msg.attachments:
-                    if att.content_id:
-                        try:
-                            b64_data = base64.b64encode(att.payload).decode('utf-8')
-                            body_html = body_html.replace(f"cid:{att.content_id.strip('<>')}", f"data:{att.content_type};base64,{b64_data}")
-                        except: pass
-                atts = [{'filename': a.filename or "noname", 'size': a.size, 'content_type': a.content_type} for a in msg.attachments]
-
-            # Filtrera bort bilder från visning (för befintliga mail i DB)
-            atts = [a for a in atts if not (a.get('content_type') or '').lower().startswith('image/')]
-
-            # Använd body_html för safe_body för att behålla formatering i Svara/Vidarebefordra
-            # Vi rensar script för säkerhet i editorn
-            safe_html = body_html
-            if safe_html:
-                safe_html = re.sub(r'<script[^>]*>.*?</script>', '', safe_html, flags=re.DOTALL|re.IGNORECASE)
-            else:
-                # Fallback till text med radbrytningar om ingen HTML finns
-                safe_html = (msg.text or "").replace('\n', '<br>')
-
-            safe_body = base64.b64encode((safe_html or "").encode('utf-8', 'ignore')).decode('utf-8')
+            # Bara bilagesammanfattningen följer med i listan; kroppen hämtas när tråden öppnas
+            atts = msg.attachments_data
 
             # Datumformatering likt Gmail
-            date_str = ""
-            if msg.date and msg.date.year > 1970:
-                # Säkerställ tidszon och konvertera till svensk tid
-                d = msg.date
-                if d.tzinfo is None:
-                    d = d.replace(tzinfo=timezone.utc)
-                local_date = d.astimezone(swe_tz)
-
-                if local_date.date() == now.date():
-                    date_str = local_date.strftime('%H:%M')
-                elif local_date.year == now.year:
-                    date_str = f"{months_sv[local_date.month-1]} {local_date.day}"
-                else:
-                    date_str = local_date.strftime('%Y-%m-%d')
+            date_str = list_date(msg, now)
 
-            # Kolla lokal status. Om den inte finns, anta att mailet är oläst (första gången).
-            # För STARRED måste vi kolla status i originalmappen
-            check_folder = getattr(msg, 'original_folder', folder)
-            check_status = get_local_status(check_folder)
-            
-            if str(msg.uid) in check_status:
-                is_read = check_status[str(msg.uid)]
-            else:
-                is_read = False
+            # Läst-status kommer med raden från databasen (okända mail räknas som olästa)
+            is_read = getattr(msg, 'seen', False)
 
             if not is_read: threads[tid]['unread'] = True
 
@@ -1397,10 +3973,8 @@ def index():
             if hasattr(msg, 'flags') and '\\Flagged' in msg.flags: is_starred = True
             
             # För STARRED är allt per definition stjärnmärkt, annars kolla status
-            if folder == 'STARRED':
+            if folder == 'STARRED' or getattr(msg, 'flagged', False):
                 is_starred = True
-            elif str(msg.uid) in star_status: 
-                is_starred = star_status[str(msg.uid)]
             
             if is_starred: threads[tid]['starred'] = True
 
@@ -1410,12 +3984,11 @@ def index():
                 'from': sender,
                 'from_full': full_sender,
                 'date': date_str,
-                'body_html': body_html,
-                'body_safe': safe_body,
-                'has_body': bool(body_html or safe_body),
                 'attachments': atts,
                 'recipients': getattr(msg, 'recipients', '')
             })
+            # Förhandsvisning i listan från det senaste mailet i tråden (listan är sorterad nyast först)
+            if not threads[tid].get('snippet'): threads[tid]['snippet'] = getattr(msg, 'snippet', '')
 
             for l in msg.labels:
                 threads[tid]['labels'].add(l)
@@ -1438,50 +4011,36 @@ def index():
         
         # Hantera isolerade utkast (matcha mot trådar eller skapa nya)
         # Optimering: Öppna DB-anslutning en gång utanför loopen för att snabba upp utkast-mappen
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+        with db_session(readonly=True) as conn:
             conn.row_factory = sqlite3.Row
             for msg in isolated_drafts:
-                # Rensa ämne för matchning
                 clean_subj = clean_subject(msg.subject)
-                target_tid = hashlib.md5(clean_subj.lower().encode()).hexdigest()
+                # Utkastets tråd (thread_id från In-Reply-To/References eller svarsämnet); otrådade rader matchas på ämne
+                target_tid = str(msg.thread_id) if msg.thread_id else hashlib.md5(clean_subj.lower().encode()).hexdigest()
                 
                 # Försök hitta matchande tråd
                 matched_tid = None
                 if target_tid in threads:
                     matched_tid = target_tid
-                else:
-                    # Om tråden inte finns (t.ex. originalet är på nästa sida), försök hämta den från DB
+                elif msg.thread_id:
+                    # Om tråden inte finns på sidan (t.ex. originalet ligger i en annan mapp), hämta senaste mailet i tråden
                     try:
-                        # Sök efter mail med samma ämne (grovsökning med LIKE)
-                        rows = conn.execute("SELECT * FROM emails WHERE subject LIKE ? AND folder != ? AND is_draft=0 ORDER BY date_iso DESC LIMIT 50", (f'%{clean_subj}%', folder)).fetchall()
-                        
-                        parent_row = None
-                        for r in rows:
-                            if clean_subject(r['subject']).lower() == clean_subj.lower():
-                                parent_row = r
-                                break
+                        parent_row = conn.execute(f"""SELECT {LISTING_COLUMNS} FROM emails WHERE thread_id=? AND folder != ? AND is_draft=0
+                                                      AND uid IS NOT NULL AND uid != 0 ORDER BY ts DESC LIMIT 1""", (msg.thread_id, folder)).fetchone()
                         
                         if parent_row:
                             # Vi hittade föräldern! Skapa tråden manuellt.
                             p_msg = MockMsg(parent_row)
+                            load_attachment_chips(conn, [p_msg])
                             
                             # Skapa tråd-strukturen
                             threads[target_tid] = {'subject': clean_subj, 'msgs': [], 'unread': False, 'starred': False, 'thread_attachments': [], 'labels': set()}
                             
                             # Lägg till föräldra-meddelandet
-                            body_html = p_msg.html or f"<pre>{p_msg.text}</pre>"
-                            safe_html = re.sub(r'<script[^>]*>.*?</script>', '', body_html, flags=re.DOTALL|re.IGNORECASE)
-                            safe_body = base64.b64encode((safe_html or "").encode('utf-8', 'ignore')).decode('utf-8')
-                            
-                            atts = p_msg.attachments_data if hasattr(p_msg, 'attachments_data') else []
-                            atts = [a for a in atts if not (a.get('content_type') or '').lower().startswith('image/')]
+                            atts = p_msg.attachments_data
 
-                            date_str = ""
-                            if p_msg.date and p_msg.date.year > 1970:
-                                d = p_msg.date
-                                if d.tzinfo is None: d = d.replace(tzinfo=timezone.utc)
-                                local_date = d.astimezone(swe_tz)
-                                date_str = local_date.strftime('%Y-%m-%d')
+                            local_date = local_datetime(p_msg)
+                            date_str = local_date.strftime('%Y-%m-%d') if local_date else ""
 
                             threads[target_tid]['msgs'].append({
                                 'uid': str(p_msg.uid),
@@ -1489,43 +4048,27 @@ def index():
                                 'from': p_msg.from_,
                                 'from_full': p_msg.from_,
                                 'date': date_str,
-                                'body_html': body_html,
-                                'body_safe': safe_body,
-                                'has_body': True,
                                 'attachments': atts,
                                 'recipients': getattr(p_msg, 'recipients', '')
                             })
                             matched_tid = target_tid
                     except: pass
                 
-                # Förbered utkast-data
-                body_html = msg.html or f"<pre>{msg.text}</pre>"
-                safe_html = re.sub(r'<script[^>]*>.*?</script>', '', body_html, flags=re.DOTALL|re.IGNORECASE)
-                safe_body = base64.b64encode((safe_html or "").encode('utf-8', 'ignore')).decode('utf-8')
-                
-                atts = []
-                if hasattr(msg, 'attachments_data'):
-                    atts = msg.attachments_data
-                else:
-                    atts = [{'filename': a.filename or "noname", 'size': a.size, 'content_type': a.content_type} for a in msg.attachments]
-                atts = [a for a in atts if not (a.get('content_type') or '').lower().startswith('image/')]
+                # Förbered utkast-data (kroppen hämtas av klienten när utkastet öppnas)
+                atts = [a for a in msg.attachments_data if not (a.get('content_type') or '').lower().startswith('image/')]
 
                 draft_obj = {
                     'uid': str(msg.uid),
                     'folder': getattr(msg, 'original_folder', folder),
                     'to': getattr(msg, 'recipients', ""),
                     'subject': msg.subject,
-                    'body_safe': safe_body,
+                    'has_content': bool(msg.snippet),
                     'attachments': atts
                 }
                 
                 # Datum
-                date_str = ""
-                if msg.date and msg.date.year > 1970:
-                    d = msg.date
-                    if d.tzinfo is None: d = d.replace(tzinfo=timezone.utc)
-                    local_date = d.astimezone(swe_tz)
-                    date_str = local_date.strftime('%Y-%m-%d')
+                local_date = local_datetime(msg)
+                date_str = local_date.strftime('%Y-%m-%d') if local_date else ""
                 
                 # Avsändare (Visa "Till: ..." i utkast-mapp)
                 draft_sender = msg.from_ or "Utkast"
@@ -1539,9 +4082,6 @@ def index():
                     'from': draft_sender,
                     'from_full': msg.from_ or "Utkast",
                     'date': date_str,
-                    'body_html': body_html,
-                    'body_safe': safe_body,
-                    'has_body': True,
                     'attachments': atts,
                     'recipients': getattr(msg, 'recipients', '')
                 }
@@ -1571,9 +4111,9 @@ def index():
         # Leta efter utkast som hör till trådarna (om vi inte redan är i utkast/papperskorg)
         is_draft_folder = 'draft' in folder.lower() or 'utkast' in folder.lower()
         if not is_draft_folder and not is_trash and folder != 'STARRED':
-            visible_subjects = {tdata['subject'] for tdata in threads.values()}
-            if visible_subjects:
-                with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+            visible_threads = [int(tid) for tid in threads if tid.isdigit()]
+            if visible_threads:
+                with db_session(readonly=True) as conn:
                     conn.row_factory = sqlite3.Row
                     # Hitta utkast-mappar
                     draft_folders = ['INBOX.Drafts', 'Drafts', 'Utkast', 'INBOX.Utkast']
@@ -1593,31 +4133,20 @@ def index():
                                 draft_folders.append(name)
                     except: pass
 
-                    placeholders = ','.join('?' * len(draft_folders))
+                    # Utkast i de synliga trådarna (idx_emails_thread)
                     # Sortera på UID ASC så att det senaste utkastet alltid skrivs över sist i loopen nedan
-                    draft_rows = conn.execute(f"SELECT * FROM emails WHERE folder IN ({placeholders}) AND uid IS NOT NULL AND uid != 0 ORDER BY uid ASC", draft_folders).fetchall()
+                    draft_rows = conn.execute(f"""SELECT {LISTING_COLUMNS}, {HAS_CONTENT_COLUMN} FROM emails
+                        WHERE thread_id IN ({','.join('?' * len(visible_threads))}) AND folder IN ({','.join('?' * len(draft_folders))})
+                        AND uid IS NOT NULL AND uid != 0 ORDER BY uid ASC""", visible_threads + draft_folders).fetchall()
                     
                     for r in draft_rows:
-                        # Robustare matchning av ämne (hantera olika prefix och case)
-                        d_subj_clean = clean_subject(r['subject']).lower()
-                        target_tid = hashlib.md5(d_subj_clean.encode()).hexdigest()
-                        
-                        tdata = threads.get(target_tid)
-                        
-                        # Fallback: Sök via strängmatchning om hash misslyckas (säkrare)
-                        if not tdata:
-                            for tid, data in threads.items():
-                                if clean_subject(data['subject']).lower() == d_subj_clean:
-                                    tdata = data
-                                    break
+                        tdata = threads.get(str(r['thread_id']))
                         
                         if tdata:
                                 # Logik för att välja BÄSTA utkastet (prioritera innehåll över tomt)
                                 current_draft = tdata.get('draft')
-                                new_has_content = bool(r['body'] or r['html'])
-                                current_has_content = False
-                                if current_draft and current_draft.get('body_safe'):
-                                    current_has_content = True
+                                new_has_content = bool(r['has_content'])
+                                current_has_content = bool(current_draft and current_draft.get('has_content'))
                                 
                                 # Uppdatera om: Inget utkast finns, ELLER nytt har innehåll men inte gamla, ELLER nytt är nyare (och båda har/saknar innehåll)
                                 should_update = not current_draft or (new_has_content and not current_has_content) or (new_has_content == current_has_content)
@@ -1626,18 +4155,14 @@ def index():
                                     tdata['has_draft'] = True
                                     # Förbered utkast-data för frontend
                                     d_msg = MockMsg(r)
-                                    body_html = d_msg.html or ""
-                                    if not body_html and d_msg.text: body_html = f"<pre>{d_msg.text}</pre>"
-                                    safe_html = body_html
-                                    if safe_html: safe_html = re.sub(r'<script[^>]*>.*?</script>', '', safe_html, flags=re.DOTALL|re.IGNORECASE)
-                                    safe_body = base64.b64encode((safe_html or "").encode('utf-8', 'ignore')).decode('utf-8')
+                                    load_attachment_chips(conn, [d_msg])
                                     
                                     tdata['draft'] = {
                                         'uid': str(d_msg.uid),
                                         'folder': r['folder'],
                                         'to': r['recipients'] or "",
                                         'subject': r['subject'],
-                                        'body_safe': safe_body,
+                                        'has_content': new_has_content,
                                         'attachments': d_msg.attachments_data,
                                         'date': d_msg.date_str
                                     }
@@ -1671,7 +4196,7 @@ def index():
                             'folder': last_msg['folder'],
                             'to': last_msg['recipients'],
                             'subject': data['subject'],
-                            'body_safe': last_msg['body_safe'],
+                            'has_content': True,
                             'attachments': last_msg['attachments']
                         }
                         
@@ -1683,6 +4208,10 @@ def index():
                             if hasattr(last_msg, 'recipients') and last_msg['recipients']:
                                 last_msg['from'] = f"Till: {last_msg['recipients']}"
 
+        # Förhämtning av kroppar (hovring, lediga olästa, nästa tråd) tar de nyaste meddelandena först
+        for data in threads.values():
+            data['prefetch'] = [[m['uid'], m['folder']] for m in data['msgs']]
+
         total_pages = max(1, (total + per_page - 1) // per_page)
         
         start_idx = (page - 1) * per_page + 1 if total > 0 else 0
@@ -1691,7 +4220,8 @@ def index():
         base_url = url_for("index", folder=folder, q=query)
         
         pagination_html = '<div class="flex items-center justify-end gap-2 text-sm text-gray-600 my-2">'
-        pagination_html += f'<span class="mr-2">{start_idx}-{end_idx} av {total}</span>'
+        total_display = f"{SEARCH_COUNT_LIMIT}+" if total_capped else total
+        pagination_html += f'<span class="mr-2">{start_idx}-{end_idx} av {total_display}</span>'
         
         if page > 1:
             prev_url = url_for("index", folder=folder, page=page-1, q=query)
@@ -1717,34 +4247,22 @@ def index():
         
         pagination_html += '</div>'
         
-        return render_template('index.html', threads=threads, folders=folders_data, current_folder=folder, current_page=page, total_pages=total_pages, pagination_html=pagination_html, settings=settings, query=query, is_trash=is_trash, trash_folder_id=trash_folder_id, labels_map=labels_map, labels_list=labels_list, t=t, lang=lang)
+        return render_template('index.html', threads=threads, folders=folders_data, current_folder=folder, current_page=page, total_pages=total_pages, pagination_html=pagination_html, settings=settings, query=query, is_trash=is_trash, trash_folder_id=trash_folder_id, labels_map=labels_map, labels_list=labels_list, counts=counts, t=t, lang=lang)
     except Exception as e:
-        return render_template('index.html', threads={}, folders=folders_data, current_folder=folder, error=str(e), settings=settings, query=query, trash_folder_id=None, labels_map={}, labels_list=labels_list, t=t, lang=lang)
+        return render_template('index.html', threads={}, folders=folders_data, current_folder=folder, error=str(e), settings=settings, query=query, trash_folder_id=None, labels_map={}, labels_list=labels_list, counts=counts, t=t, lang=lang)
 
 @app.route('/api/get_message/<uid>')
 def get_message_api(uid):
     folder = request.args.get('folder', 'INBOX')
     
-    def process_msg_data(html_content, text_content, attachments_json=None, attachments_list=None):
-        if not html_content and text_content:
-            html_content = f"<pre>{text_content}</pre>"
-        
+    def process_msg_data(safe_html, attachments_list=None):
         atts = []
-        if attachments_json:
-            try: 
-                atts = json.loads(attachments_json)
-                atts = [a for a in atts if not (a.get('content_type') or '').lower().startswith('image/')]
-            except: pass
+        if attachments_list and isinstance(attachments_list[0], dict):
+            atts = attachments_list
         elif attachments_list:
             atts = [{'filename': a.filename or "noname", 'size': a.size, 'content_type': a.content_type} for a in attachments_list]
             atts = [a for a in atts if not (a.get('content_type') or '').lower().startswith('image/')]
 
-        safe_html = html_content
-        if safe_html:
-            safe_html = re.sub(r'<script[^>]*>.*?</script>', '', safe_html, flags=re.DOTALL|re.IGNORECASE)
-        else:
-            safe_html = (text_content or "").replace('\n', '<br>')
-
         safe_body = base64.b64encode((safe_html or "").encode('utf-8', 'ignore')).decode('utf-8')
         
         return {
@@ -1755,88 +4273,144 @@ def get_message_api(uid):
 
     try:
         # 1. Försök hämta från DB först
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+        with db_session(readonly=True) as conn:
             conn.row_factory = sqlite3.Row
-            row = conn.execute("SELECT * FROM emails WHERE uid=? AND folder=?", (uid, folder)).fetchone()
+            row = conn.execute("SELECT rowid AS rowid, * FROM emails WHERE uid=? AND folder=?", (uid, folder)).fetchone()
             if row and (row['html'] or row['body']):
-                data = process_msg_data(row['html'], row['body'], attachments_json=row['attachments'])
+                m = MockMsg(row)
+                load_attachment_chips(conn, [m])
+                data = process_msg_data(m.sanitized(), attachments_list=m.attachments_data)
                 data['subject'] = row['subject']
                 data['from'] = row['sender']
                 return json.dumps(data)
 
         # 2. Fallback till IMAP om DB är tom
-        with get_mailbox() as mb:
-            mb.folder.set(folder)
-            msgs = list(mb.fetch(A(uid=uid)))
-            if msgs:
-                msg = msgs[0]
-                body_html = msg.html or ""
-                body_text = msg.text or ""
-                
-                # Uppdatera DB så vi slipper hämta nästa gång
-                atts_data = []
-                for a in msg.attachments:
-                     if not a.content_id and not (a.content_disposition == 'inline'):
-                        atts_data.append({'filename': a.filename or "noname", 'size': a.size, 'content_type': a.content_type})
-                
-                with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-                    conn.execute("UPDATE emails SET body=?, html=?, attachments=? WHERE uid=? AND folder=?", 
-                                (body_text, body_html, json.dumps(atts_data), uid, folder))
-                
-                data = process_msg_data(body_html, body_text, attachments_list=msg.attachments)
-                data['subject'] = msg.subject
-                data['from'] = msg.from_
-                return json.dumps(data)
+        with imap_session(folder) as mb:
+            msgs = list(mb.fetch(A(uid=uid), mark_seen=False))
+        if msgs:
+            msg = msgs[0]
+            fetched = [full_body_result(msg)]
+            _, body_text, body_html, records = fetched[0]
+            # Uppdatera DB så vi slipper hämta nästa gång
+            db_write(save_fetched_bodies, folder, fetched, priority=PRIORITY_USER)
+            data = process_msg_data(sanitize_message(body_text, body_html)[0], attachments_list=attachment_summary(records))
+            data['subject'] = msg.subject
+            data['from'] = msg.from_
+            return json.dumps(data)
     except Exception as e:
         log_event(f"Fel vid hämtning av meddelande {uid}: {e}")
         return json.dumps({'error': str(e)})
     except Exception as e: return json.dumps({'error': str(e)})
     return json.dumps({'error': 'Not found'})
 
+@app.route('/api/inline/<content_hash>')
+def inline_image(content_hash):
+    # Innehållsadresserat: samma URL har alltid samma innehåll, så webbläsaren får cacha den för alltid
+    if not re.fullmatch(r'[0-9a-f]{64}', content_hash): return "Ogiltig bild", 404
+    try:
+        with db_session(readonly=True) as conn:
+            conn.row_factory = sqlite3.Row
+            path = blob_store_get(conn, content_hash)
+            blob = conn.execute("SELECT content_type FROM attachment_blobs WHERE content_hash=?", (content_hash,)).fetchone()
+            source = conn.execute("""SELECT emails.uid, emails.folder, attachments.part_id, attachments.encoding, attachments.content_type
+                                     FROM attachments JOIN emails ON emails.rowid = attachments.email_rowid
+                                     WHERE attachments.content_hash=? LIMIT 1""", (content_hash,)).fetchone()
+        content_type = (blob and blob['content_type']) or (source and source['content_type'])
+        if not path and source and not source['part_id'].startswith('?'):
+            # Rensad ur lagret: hämta delen igen från mailet den kom ifrån
+            with imap_session(source['folder']) as mb:
+                payload = imap_fetch_part(mb, source['uid'], source['part_id'], source['encoding'])
+            if payload is not None and hashlib.sha256(payload).hexdigest() == content_hash:
+                db_write(lambda conn: blob_store_put(conn, payload, content_hash, content_type=content_type), priority=PRIORITY_USER)
+                path = blob_path(content_hash)
+        if not path: return "Bilden hittades inte", 404
+        resp = send_file(path, mimetype=content_type or 'application/octet-stream', conditional=True, etag=content_hash, max_age=31536000)
+        resp.cache_control.public = False # send_file sätter public när max_age anges
+        resp.cache_control.private = True
+        resp.cache_control.immutable = True
+        return resp
+    except Exception as e: return f"Fel: {str(e)}", 500
+
 @app.route('/api/attachment/<uid>')
 def download_attachment(uid):
     filename = request.args.get('filename')
     disposition = request.args.get('disposition', 'attachment')
-    if not filename: return "Filnamn saknas"
+    part_id = request.args.get('part')
+    if not filename and not part_id: return "Filnamn saknas"
     folder = request.args.get('folder', 'INBOX')
     if folder == 'STARRED':
         try:
-            with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+            with db_session(readonly=True) as conn:
                 row = conn.execute("SELECT folder FROM emails WHERE uid=?", (uid,)).fetchone()
                 if row: folder = row[0]
         except: pass
 
-    try:
-        with get_mailbox() as mb:
-            mb.folder.set(folder)
-            msgs = list(mb.fetch(A(uid=uid)))
-            if not msgs:
-                return "Mailet hittades inte på servern."
-            
-            msg = msgs[0]
-            
-            def make_resp(att):
-                safe_filename = (att.filename or "noname").replace('\r', '').replace('\n', '').replace('"', "'")
-                # Skapa ASCII-säker version för legacy headers (förhindrar krasch med specialtecken)
-                ascii_filename = safe_filename.encode('ascii', 'ignore').decode('ascii').strip()
-                if not ascii_filename: ascii_filename = "attachment"
-                
-                # Skapa UTF-8 version för moderna webbläsare (RFC 5987)
-                encoded_filename = urllib.parse.quote(safe_filename)
-                
-                return Response(att.payload, mimetype=att.content_type, 
-                              headers={"Content-Disposition": f"{disposition}; filename=\"{ascii_filename}\"; filename*=UTF-8''{encoded_filename}"})
+    def clean(name):
+        return (name or "noname").replace('\r', '').replace('\n', '').lower().strip()
 
-            for att in msg.attachments:
-                if (att.filename or "noname") == filename:
-                    return make_resp(att)
-            
-            # Fallback: Försök matcha utan att bry sig om gemener/versaler
-            for att in msg.attachments:
-                if (att.filename or "noname").replace('\r', '').replace('\n', '').lower().strip() == filename.replace('\r', '').replace('\n', '').lower().strip():
-                    return make_resp(att)
-            
-            return "Bilagan hittades inte."
+    def find_attachment(conn):
+        rows = conn.execute("""SELECT attachments.* FROM attachments JOIN emails ON emails.rowid = attachments.email_rowid
+                               WHERE emails.uid=? AND emails.folder=? ORDER BY part_id""", (uid, folder)).fetchall()
+        for match in (lambda r: part_id and r['part_id'] == part_id,
+                      lambda r: r['filename'] == filename,
+                      # Fallback: Försök matcha utan att bry sig om gemener/versaler
+                      lambda r: filename and clean(r['filename']) == clean(filename)):
+            for r in rows:
+                if match(r): return r
+        return None
+
+    def make_resp(path, name, content_type, content_hash):
+        safe_filename = (name or "noname").replace('\r', '').replace('\n', '').replace('"', "'")
+        # send_file strömmar från disk och hanterar ETag/If-None-Match och Range (206) via conditional=True
+        resp = send_file(path, mimetype=content_type or 'application/octet-stream', as_attachment=disposition != 'inline',
+                         download_name=safe_filename, conditional=True, etag=content_hash, max_age=3600)
+        resp.cache_control.public = False # send_file sätter public när max_age anges
+        resp.cache_control.private = True
+        return resp
+
+    try:
+        # 1. Lokalt lager
+        with db_session(readonly=True) as conn:
+            conn.row_factory = sqlite3.Row
+            att = find_attachment(conn)
+            path = blob_store_get(conn, att['content_hash']) if att else None
+        if path:
+            return make_resp(path, att['filename'], att['content_type'], att['content_hash'])
+
+        with imap_session(folder) as mb:
+            if att and not att['part_id'].startswith('?'):
+                # 2. Känd MIME-del: hämta bara den
+                payload = imap_fetch_part(mb, uid, att['part_id'], att['encoding'])
+                if payload is None: return "Bilagan hittades inte."
+                name, content_type = att['filename'], att['content_type']
+            else:
+                # 3. Okänd del (mail från före attachments-tabellen): hämta hela mailet en gång och registrera delarna
+                msgs = list(mb.fetch(A(uid=uid), mark_seen=False))
+                if not msgs: return "Mailet hittades inte på servern."
+                records = attachment_records(msgs[0], with_payload=True)
+                db_write(store_attachments, msgs[0].uid, folder, records, priority=PRIORITY_USER)
+                found = next((r for r in records if part_id and r['part_id'] == part_id), None) or \
+                        next((r for r in records if r['filename'] == filename), None) or \
+                        next((r for r in records if filename and clean(r['filename']) == clean(filename)), None)
+                if not found: return "Bilagan hittades inte."
+                payload, name, content_type = found['payload'], found['filename'], found['content_type']
+
+        content_hash = hashlib.sha256(payload).hexdigest()
+        def store(conn):
+            stored = blob_store_put(conn, payload, content_hash)
+            if att:
+                conn.execute("UPDATE attachments SET content_hash=?, size=? WHERE email_rowid=? AND part_id=?",
+                             (content_hash, len(payload), att['email_rowid'], att['part_id']))
+                if stored and att['content_id']:
+                    rewrite_inline_part(conn, att['email_rowid'], uid, folder, att['part_id'], stored)
+            return stored
+        stored = db_write(store, priority=PRIORITY_USER)
+        if stored:
+            return make_resp(blob_path(stored), name, content_type, stored)
+        # För stor för lagret: skicka från minnet
+        resp = send_file(io.BytesIO(payload), mimetype=content_type or 'application/octet-stream', as_attachment=disposition != 'inline',
+                         download_name=(name or "noname").replace('\r', '').replace('\n', '').replace('"', "'"), conditional=True, etag=content_hash)
+        return resp
     except Exception as e: return f"Fel: {str(e)}"
 
 @app.route('/api/mark_read/<path:uids>')
@@ -1846,8 +4420,7 @@ def mark_read(uids):
     # Spara status lokalt
     update_local_status(folder, uid_list, True)
     try:
-        with get_mailbox() as mb:
-            mb.folder.set(folder)
+        with imap_session(folder) as mb:
             mb.flag(uid_list, '\\Seen', True)
             return "OK"
     except Exception as e:
@@ -1858,23 +4431,18 @@ def mark_read(uids):
 def toggle_star(uid):
     folder = request.args.get('folder', 'INBOX')
     
-    # Om vi är i STARRED-mappen, försök hitta den riktiga mappen för att uppdatera IMAP
+    # Om vi är i STARRED-mappen, försök hitta den riktiga mappen för att uppdatera IMAP (uid leder primärnyckeln)
     if folder == 'STARRED':
-        if os.path.exists(STAR_STATUS_FILE):
-            try:
-                with open(STAR_STATUS_FILE) as f:
-                    data = json.load(f)
-                    for fldr, uids in data.items():
-                        if str(uid) in uids and uids[str(uid)]:
-                            folder = fldr
-                            break
-            except: pass
+        try:
+            with db_session(readonly=True) as conn:
+                row = conn.execute("SELECT folder FROM emails WHERE uid=? AND flagged=1 ORDER BY ts DESC LIMIT 1", (uid,)).fetchone()
+                if row: folder = row[0]
+        except: pass
 
     starred = request.args.get('starred') == 'true'
     update_star_status(folder, uid, starred)
     try:
-        with get_mailbox() as mb:
-            mb.folder.set(folder)
+        with imap_session(folder) as mb:
             if starred:
                 mb.flag([uid], '\\Flagged', True)
             else:
@@ -1892,7 +4460,7 @@ def create_folder():
     final_name = name
     try:
         log_event(f"Skapar mapp: {name}")
-        with get_mailbox() as mb:
+        with imap_session() as mb:
             # Detektera avgränsare och prefix
             delimiter = '.'
             has_inbox_prefix = False
@@ -1935,8 +4503,8 @@ def create_folder():
         time.sleep(1.0) # Ge servern tid att registrera mappen
         
         # Kör en full prenumerations-synk i bakgrunden för säkerhets skull
-        threading.Thread(target=sync_folder_structure, daemon=True).start()
-        threading.Thread(target=subscribe_worker, daemon=True).start()
+        schedule_folder_structure_sync(force=True)
+        schedule_job("subscribe", subscribe_worker)
         return "OK"
     except Exception as e:
         log_event(f"Error creating folder: {e}")
@@ -1991,8 +4559,7 @@ def save_ngrok_token():
     token = request.form.get('token', '').strip()
     settings = load_settings()
     settings['ngrok_token'] = token
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump(settings, f, indent=4)
+    write_settings(settings)
     return "OK"
 
 @app.route('/api/delete_folder', methods=['POST'])
@@ -2001,7 +4568,7 @@ def delete_folder():
     if not name: return "No name"
     try:
         log_event(f"Raderar mapp: {name}")
-        with get_mailbox() as mb:
+        with imap_session() as mb:
             mb.folder.delete(name)
         
         # Ta bort ikon-mappning om den finns
@@ -2010,7 +4577,7 @@ def delete_folder():
             del icons[name]
             with open(FOLDER_ICONS_FILE, 'w') as f: json.dump(icons, f)
         
-        threading.Thread(target=sync_folder_structure, daemon=True).start()
+        schedule_folder_structure_sync(force=True)
             
         return "OK"
     except Exception as e:
@@ -2019,9 +4586,49 @@ def delete_folder():
 
 @app.route('/api/sync_folders', methods=['POST'])
 def sync_folders_api():
-    threading.Thread(target=subscribe_worker, daemon=True).start()
+    schedule_job("subscribe", subscribe_worker)
     return "OK"
 
+@app.route('/api/counts')
+def api_counts():
+    with db_session(readonly=True) as conn:
+        return Response(json.dumps(get_counts(conn)), mimetype='application/json')
+
+@app.route('/api/db_pool_stats')
+def db_pool_stats():
+    return json.dumps(db_pool.get_stats())
+
+@app.route('/api/db_writer_stats')
+def db_writer_stats():
+    return json.dumps(db_writer.get_stats())
+
+@app.route('/api/migration_status')
+def migration_status():
+    with db_session(readonly=True) as conn:
+        # Omsanering och trådning styrs av radernas egna värden i stället för en markör; visa vad som återstår
+        pending = {'resanitize': conn.execute("SELECT COUNT(*) FROM emails WHERE sanitizer_version < ? AND html IS NOT NULL AND html != ''",
+                                              (SANITIZER_VERSION,)).fetchone()[0],
+                   'threader': conn.execute("SELECT COUNT(*) FROM emails WHERE thread_id IS NULL").fetchone()[0]}
+        return json.dumps({'schema_version': schema_version(conn), 'latest': SCHEMA_VERSION,
+                           'steps': background_step_progress(conn), 'pending': pending})
+
+@app.route('/api/imap_pool_stats')
+def imap_pool_stats():
+    return json.dumps(imap_pool.get_stats())
+
+@app.route('/api/idle_status')
+def idle_status():
+    return json.dumps({f: {'connected': w.connected, 'mode': w.mode, 'last_event': w.last_event, 'reconnects': w.reconnects}
+                       for f, w in list(idle_watchers.items())})
+
+@app.route('/api/jobs')
+def bulk_jobs_status():
+    return json.dumps(get_bulk_jobs())
+
+@app.route('/api/sync_status')
+def sync_status():
+    return json.dumps(sync_scheduler.get_status())
+
 @app.route('/api/mark_unread/<path:uids>')
 def mark_unread(uids):
     folder = request.args.get('folder', 'INBOX')
@@ -2029,8 +4636,7 @@ def mark_unread(uids):
     # Spara status lokalt
     update_local_status(folder, uid_list, False)
     try:
-        with get_mailbox() as mb:
-            mb.folder.set(folder)
+        with imap_session(folder) as mb:
             mb.flag(uid_list, '\\Seen', False)
             return "OK"
     except Exception as e:
@@ -2050,28 +4656,13 @@ def move_mail():
 
     log_event(f"Flyttar {len(uid_list)} mail från {folder} till {dest}")
     try:
-        with get_mailbox() as mb:
-            mb.folder.set(folder)
-            try:
-                mb.move(uid_list, dest)
-            except:
-                # Fallback: Om MOVE misslyckas, kör COPY + DELETE (säkrare på vissa servrar)
-                mb.copy(uid_list, dest)
-                mb.delete(uid_list)
-                try: mb.expunge()
-                except: pass
-            
-        # Uppdatera lokal databas: Flytta mailen till nya mappen direkt (visuellt direkt)
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-            placeholders = ','.join('?' * len(uid_list))
-            # Uppdatera mappen för mailen. Om UID krockar i destinationen, ignorera (tas bort nedan)
-            conn.execute(f"UPDATE OR IGNORE emails SET folder=? WHERE folder=? AND uid IN ({placeholders})", [dest, folder] + uid_list)
-            # Städa bort från gamla mappen (om de inte flyttades pga krock eller annat)
-            conn.execute(f"DELETE FROM emails WHERE folder=? AND uid IN ({placeholders})", [folder] + uid_list)
-            
-        # Starta synk av destinationen för att korrigera UIDs
-        threading.Thread(target=sync_worker, args=(dest,), daemon=True).start()
-            
+        # Samma väg som avsändarflytten: med COPYUID flyttas raderna till sina nya UIDs, annars tas de bort
+        # och destinationen synkas. Väntar på commit så att nästa sidladdning redan ser flytten
+        uid_list = [int(u) for u in uid_list]
+        with imap_session(folder) as mb:
+            uidvalidity, mapping = imap_move_batch(mb, uid_list, dest)
+        if not _apply_move_locally(folder, dest, uid_list, uidvalidity, mapping):
+            schedule_sync(dest, PRIORITY_CHANGE, force=True)
         return "OK"
     except Exception as e: return str(e)
 
@@ -2091,7 +4682,7 @@ def delete_mails():
     uids_by_folder = {}
     
     try:
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+        with db_session(readonly=True) as conn:
             placeholders = ','.join('?' * len(uids))
             # Hämta mapp för dessa UIDs
             rows = conn.execute(f"SELECT uid, folder, is_draft FROM emails WHERE uid IN ({placeholders})", uids).fetchall()
@@ -2129,7 +4720,7 @@ def delete_mails():
 
     # Utför radering
     try:
-        with get_mailbox() as mb:
+        with imap_session() as mb:
             # Hitta papperskorg
             trash_folder = None
             try:
@@ -2189,23 +4780,24 @@ def delete_mails():
     except Exception as e: log_event(f"IMAP connection error: {e}")
     
     # Rensa DB
+    def delete_local(conn):
+        for folder, data in ops.items():
+            placeholders = ','.join('?' * len(data['uids']))
+            conn.execute(f"DELETE FROM emails WHERE folder=? AND uid IN ({placeholders})", [folder] + data['uids'])
+        # Specialstädning
+        conn.execute("DELETE FROM emails WHERE uid=0 OR uid IS NULL")
+
     try:
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-            for folder, data in ops.items():
-                placeholders = ','.join('?' * len(data['uids']))
-                conn.execute(f"DELETE FROM emails WHERE folder=? AND uid IN ({placeholders})", [folder] + data['uids'])
-            
-            # Specialstädning
-            conn.execute("DELETE FROM emails WHERE uid=0 OR uid IS NULL")
+        db_write(delete_local, priority=PRIORITY_USER)
             
         # Synka papperskorgen om vi flyttade något
         if trash_folder:
-            threading.Thread(target=sync_worker, args=(trash_folder,), daemon=True).start()
+            schedule_sync(trash_folder, PRIORITY_CHANGE, force=True)
             
         # FIX: Synka även källmapparna för att säkerställa att servern och klienten är överens
         for folder in ops.keys():
             if folder != trash_folder:
-                threading.Thread(target=sync_worker, args=(folder,), daemon=True).start()
+                schedule_sync(folder, PRIORITY_CHANGE, force=True)
             
         return "OK"
     except Exception as e: return str(e)
@@ -2217,8 +4809,7 @@ def empty_trash():
     
     log_event(f"Tömmer papperskorgen: {folder}")
     try:
-        with get_mailbox() as mb:
-            mb.folder.set(folder)
+        with imap_session(folder) as mb:
             # Radera alla mail i mappen
             uids = mb.uids()
             if uids:
@@ -2227,8 +4818,7 @@ def empty_trash():
                 except: pass
         
         # Rensa databasen
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-            conn.execute("DELETE FROM emails WHERE folder=?", (folder,))
+        db_write(lambda conn: conn.execute("DELETE FROM emails WHERE folder=?", (folder,)), priority=PRIORITY_USER)
             
         return "OK"
     except Exception as e: return str(e)
@@ -2244,7 +4834,9 @@ def block_sender():
         except: pass
     log_event(f"Blockerar avsändare: {sender}")
     add_spam_sender(sender.strip())
-    threading.Thread(target=move_existing_spam, args=(sender.strip(),), daemon=True).start()
+    folders = [f for f in request.form.get('folders', '').split(',') if f.strip()] or None
+    _update_bulk_job(f"spam:{sender.strip()}", sender=sender.strip(), status='queued')
+    schedule_job(f"spam:{sender.strip()}", move_existing_spam, (sender.strip(), folders))
     return "OK"
 
 @app.route('/api/mark_as_ad', methods=['POST'])
@@ -2258,7 +4850,9 @@ def mark_as_ad():
         except: pass
     log_event(f"Markerar som reklam: {sender}")
     add_ad_sender(sender.strip())
-    threading.Thread(target=move_existing_ads, args=(sender.strip(),), daemon=True).start()
+    folders = [f for f in request.form.get('folders', '').split(',') if f.strip()] or None
+    _update_bulk_job(f"ads:{sender.strip()}", sender=sender.strip(), status='queued')
+    schedule_job(f"ads:{sender.strip()}", move_existing_ads, (sender.strip(), folders))
     return "OK"
 
 @app.route('/api/whitelist_sender', methods=['POST'])
@@ -2287,16 +4881,13 @@ def search_suggestions():
     folder = request.args.get('folder', 'INBOX')
     if not query or len(query) < 2: return json.dumps([])
     
-    # Starta synk om det inte redan körs
-    threading.Thread(target=sync_worker, args=(folder,), daemon=True).start()
+    # Starta synk om mappen inte redan synkas eller nyss har synkats
+    schedule_sync(folder, PRIORITY_USER)
     
     try:
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+        with db_session(readonly=True) as conn:
             conn.row_factory = sqlite3.Row
-            clean_query = query.replace('"', '').strip()
-            if not clean_query: return json.dumps([])
-            fts_query = f'{clean_query}*'
-            rows = conn.execute("SELECT subject, sender, date_str FROM emails WHERE rowid IN (SELECT rowid FROM emails_fts WHERE emails_fts MATCH ? ORDER BY rank) ORDER BY date_iso DESC LIMIT 5", (fts_query,)).fetchall()
+            rows, _, _ = run_search(conn, query, 5, columns="emails.subject, emails.sender, emails.date_str")
             suggestions = []
             for row in rows:
                 suggestions.append({'subject': row['subject'], 'from': row['sender'], 'date': row['date_str']})
@@ -2311,7 +4902,7 @@ def contact_suggestions():
     
     suggestions = []
     try:
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+        with db_session(readonly=True) as conn:
             conn.row_factory = sqlite3.Row
             
             # 1. Sök i Kontaktboken (Prioriterat)
@@ -2336,11 +4927,10 @@ def handle_contacts():
         name = request.form.get('name', '').strip()
         email = request.form.get('email', '').strip()
         if not email: return "Email required"
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-            conn.execute("INSERT OR REPLACE INTO contacts (name, email) VALUES (?, ?)", (name, email))
+        db_write(lambda conn: conn.execute("INSERT OR REPLACE INTO contacts (name, email) VALUES (?, ?)", (name, email)), priority=PRIORITY_USER)
         return "OK"
     else:
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+        with db_session(readonly=True) as conn:
             conn.row_factory = sqlite3.Row
             rows = conn.execute("SELECT * FROM contacts ORDER BY name").fetchall()
             return json.dumps([dict(r) for r in rows])
@@ -2348,8 +4938,7 @@ def handle_contacts():
 @app.route('/api/contacts/delete', methods=['POST'])
 def delete_contact():
     id = request.form.get('id')
-    with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-        conn.execute("DELETE FROM contacts WHERE id=?", (id,))
+    db_write(lambda conn: conn.execute("DELETE FROM contacts WHERE id=?", (id,)), priority=PRIORITY_USER)
     return "OK"
 
 @app.route('/api/rules', methods=['GET', 'POST'])
@@ -2359,11 +4948,12 @@ def handle_rules():
         folder = request.form.get('folder', '').strip()
         field = request.form.get('field', 'subject').strip()
         if not keyword or not folder: return "Missing args"
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-            conn.execute("INSERT INTO rules (keyword, target_folder, check_field) VALUES (?, ?, ?)", (keyword, folder, field))
+        db_write(lambda conn: conn.execute("INSERT INTO rules (keyword, target_folder, check_field) VALUES (?, ?, ?)", (keyword, folder, field)),
+                 priority=PRIORITY_USER)
+        invalidate_classifier()
         return "OK"
     else:
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+        with db_session(readonly=True) as conn:
             conn.row_factory = sqlite3.Row
             rows = conn.execute("SELECT * FROM rules").fetchall()
             return json.dumps([dict(r) for r in rows])
@@ -2371,8 +4961,8 @@ def handle_rules():
 @app.route('/api/rules/delete', methods=['POST'])
 def delete_rule():
     id = request.form.get('id')
-    with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-        conn.execute("DELETE FROM rules WHERE id=?", (id,))
+    db_write(lambda conn: conn.execute("DELETE FROM rules WHERE id=?", (id,)), priority=PRIORITY_USER)
+    invalidate_classifier()
     return "OK"
 
 @app.route('/api/labels', methods=['GET', 'POST'])
@@ -2383,23 +4973,33 @@ def handle_labels():
         keyword = request.form.get('keyword', '').strip()
         field = request.form.get('field', 'subject').strip()
         if not name or not keyword: return "Missing args"
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-            conn.execute("INSERT INTO labels (name, color, keyword, check_field) VALUES (?, ?, ?, ?)", (name, color, keyword, field))
-        threading.Thread(target=apply_labels_to_all, daemon=True).start()
+        label_id = db_write(lambda conn: conn.execute("INSERT INTO labels (name, color, keyword, check_field) VALUES (?, ?, ?, ?)",
+                                                      (name, color, keyword, field)).lastrowid, priority=PRIORITY_USER)
+        invalidate_classifier()
+        start_label_backfill(label_id)
         return "OK"
     else:
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+        with db_session(readonly=True) as conn:
             conn.row_factory = sqlite3.Row
             rows = conn.execute("SELECT * FROM labels").fetchall()
-            return json.dumps([dict(r) for r in rows])
+            counts = get_label_counts(conn)
+            return json.dumps([dict(r, count=counts.get(r['id'], 0)) for r in rows])
 
 @app.route('/api/labels/delete', methods=['POST'])
 def delete_label():
     id = request.form.get('id')
-    with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+    def delete(conn):
+        # Kopplingarna i email_labels (och räknarna) tas bort av triggern labels_ad; ett pågående backfill-jobb avbryts
         conn.execute("DELETE FROM labels WHERE id=?", (id,))
+        conn.execute("DELETE FROM label_backfill WHERE label_id=?", (id,))
+    db_write(delete, priority=PRIORITY_USER)
+    invalidate_classifier()
     return "OK"
 
+@app.route('/api/labels/backfill')
+def label_backfill_status():
+    return json.dumps(get_label_backfill_status())
+
 @app.route('/api/assign_label', methods=['POST'])
 def assign_label():
     try:
@@ -2407,24 +5007,12 @@ def assign_label():
         uids_str = request.form.get('uids')
         if not uids_str: return "No UIDs"
         uids = [u.strip() for u in uids_str.split(',') if u.strip()]
+        # Virtuella mappar (STARRED, LABEL:x) har ingen egen folder-kolumn; matcha då på UID i alla mappar
+        folder = request.form.get('folder')
+        if folder == 'STARRED' or (folder or '').startswith('LABEL:'): folder = None
+        assigned = request.form.get('remove') != '1'
         
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-            placeholders = ','.join('?' * len(uids))
-            rows = conn.execute(f"SELECT uid, folder, labels FROM emails WHERE uid IN ({placeholders})", uids).fetchall()
-            
-            updates = []
-            for r in rows:
-                uid, folder, lbls_json = r
-                try:
-                    lbls = json.loads(lbls_json) if lbls_json else []
-                except: lbls = []
-                
-                if label_id not in lbls:
-                    lbls.append(label_id)
-                    updates.append((json.dumps(lbls), uid, folder))
-            
-            if updates:
-                conn.executemany("UPDATE emails SET labels=? WHERE uid=? AND folder=?", updates)
+        db_write(set_email_labels, label_id, uids, folder, assigned, priority=PRIORITY_USER)
         return "OK"
     except Exception as e: return str(e)
 
@@ -2454,8 +5042,7 @@ def save_draft():
 
         if forward_uid and folder:
             try:
-                with get_mailbox() as mb:
-                    mb.folder.set(folder)
+                with imap_session(folder) as mb:
                     msgs = list(mb.fetch(A(uid=str(forward_uid))))
                     if msgs:
                         orig_msg = msgs[0]
@@ -2501,7 +5088,7 @@ def save_draft():
                     part.add_header('Content-Disposition', f'attachment; filename="{f.filename}"')
                     msg.attach(part)
 
-        with get_mailbox() as mb:
+        with imap_session() as mb:
             draft_folder = None
             for f in mb.folder.list():
                 if f.name in ['Drafts', 'Utkast', 'INBOX.Drafts', 'INBOX.Utkast']:
@@ -2621,21 +5208,29 @@ def save_draft():
                         # Extrahera ren text för sökbarhet och preview (body-kolumnen)
                         plain_text = re.sub('<[^<]+?>', '', body)
                         
-                        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-                            d_iso = datetime.now().isoformat()
-                            d_str = datetime.now().strftime('%Y-%m-%d %H:%M')
-                            sender_name = cfg['email']
-                            recipients = request.form.get('to') or ""
-                            # Vi sparar en tom lista för attachments just nu för enkelhetens skull, 
-                            # sync_worker kommer fixa detaljerna senare. Det viktiga är body.
-                            conn.execute("""INSERT OR REPLACE INTO emails 
-                                (uid, folder, subject, sender, body, html, date_iso, date_str, attachments, recipients, labels, is_draft) 
-                                VALUES (?,?,?,?,?,?,?,?,?,?,?,1)""", 
-                                (new_uid, draft_folder, request.form.get('subject'), sender_name, plain_text, body, d_iso, d_str, "[]", recipients, "[]"))
+                        d_iso = datetime.now(timezone.utc).isoformat()
+                        d_str = datetime.now().strftime('%Y-%m-%d %H:%M')
+                        sender_name = cfg['email']
+                        recipients = request.form.get('to') or ""
+                        # Vi sparar en tom lista för attachments just nu för enkelhetens skull, 
+                        # sync_worker kommer fixa detaljerna senare. Det viktiga är body.
+                        html_safe, snippet = sanitize_message(plain_text, body)
+                        row = (new_uid, draft_folder, request.form.get('subject'), sender_name, get_clean_email(sender_name), plain_text, body, html_safe, snippet, SANITIZER_VERSION, d_iso, date_ts(d_iso), d_str, "[]", recipients)
+
+                        def save_local_draft(conn):
+                            conn.execute("""INSERT INTO emails 
+                                (uid, folder, subject, sender, sender_email, body, html, html_safe, snippet, sanitizer_version, date_iso, ts, date_str, attachments, recipients, is_draft, seen) 
+                                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,1,1)
+                                ON CONFLICT(uid, folder) DO UPDATE SET subject=excluded.subject, sender=excluded.sender, sender_email=excluded.sender_email, body=excluded.body, html=excluded.html,
+                                    html_safe=excluded.html_safe, snippet=excluded.snippet, sanitizer_version=excluded.sanitizer_version,
+                                    date_iso=excluded.date_iso, ts=excluded.ts, date_str=excluded.date_str, attachments=excluded.attachments, recipients=excluded.recipients,
+                                    is_draft=1, seen=1""", row)
+                            thread_messages(conn)
+                        db_write(save_local_draft, priority=PRIORITY_USER)
                     except Exception as e:
                         log_event(f"Kunde inte snabbuppdatera DB för utkast: {e}")
 
-                threading.Thread(target=sync_worker, args=(draft_folder,), daemon=True).start()
+                schedule_sync(draft_folder, PRIORITY_CHANGE, force=True)
                 return json.dumps({'status': 'Saved', 'new_uid': str(new_uid) if new_uid else None, 'folder': draft_folder})
             except: return json.dumps({'status': 'Error', 'message': 'Kunde inte spara utkast'})
     except Exception as e: return json.dumps({'status': 'Error', 'message': str(e)})
@@ -2654,8 +5249,10 @@ def save_settings():
         'layout': request.form.get('layout', 'normal'),
         'language': request.form.get('language', 'sv')
     }
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump(settings, f, indent=4)
+    write_settings(settings)
+    # Nya kontouppgifter: stäng gamla sessioner direkt istället för att vänta på att de löper ut
+    stop_idle_watchers()
+    imap_pool.close_all()
     return redirect(url_for('index'))
 
 @app.route('/send', methods=['POST'])
@@ -2678,8 +5275,7 @@ def send():
 
         if forward_uid and folder:
             try:
-                with get_mailbox() as mb:
-                    mb.folder.set(folder)
+                with imap_session(folder) as mb:
                     # Hämta mailet med specifikt UID
                     msgs = list(mb.fetch(A(uid=str(forward_uid))))
                     if msgs:
@@ -2770,7 +5366,7 @@ def send():
         log_event("Mail skickat")
 
         # Spara i Skickat-mappen
-        with get_mailbox() as mb:
+        with imap_session() as mb:
             sent_folder = None
             folders = mb.folder.list()
             # Prioritera exakta matchningar
@@ -2891,6 +5487,12 @@ def test_connection():
 
 if __name__ == '__main__':
     init_db()
+    refresh_idle_watchers()
+    resume_label_backfills()
+    schedule_job('background-steps', run_background_steps)
+    schedule_job('resanitize', resanitize_emails)
+    schedule_job('threader', thread_pending)
+    schedule_job('counts', reconcile_folder_counts)
     
     is_frozen = getattr(sys, 'frozen', False)
     host = '0.0.0.0'
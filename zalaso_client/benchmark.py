@@ -0,0 +1,317 @@
+""" Prestandamätningar för Zalaso. Körs fristående: python benchmark.py [namn ...]
+
+    matcher   Regler/etiketter/spamfilter: 1 000 regler över 100 000 rubriker,
+              gamla linjära loopen jämfört med den kompilerade MessageClassifier.
+    bodyfetch Synkens Fas 2 mot det konfigurerade kontot: hela mail (RFC822) jämfört med
+              BODYSTRUCTURE + textdelar. Mäter överförda byte och tid. Mapp och antal mail
+              styrs med ZALASO_BENCH_FOLDER (standard INBOX) och ZALASO_BENCH_COUNT (standard 200).
+              Inget skrivs till databasen.
+    listing   Listningens svarstid på sida 1 och sida 2 000 (50 rader/sida): LIMIT/OFFSET som i index()
+              jämfört med markören i /api/threads. Körs mot en tillfällig databas med ZALASO_BENCH_ROWS
+              (standard 110 000) mail i en mapp.
+    requests  Overhead per anrop till /api/mark_read (utan IMAP): require_login som läser settings.json och frågar
+              databasen vid varje anrop, jämfört med inställningscachen och schemakontrollen per databasfil.
+"""
+import argparse, json, os, random, string, sys, tempfile, time
+
+import app
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+def _word(rng, n=None):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(n or rng.randint(4, 9)))
+
+def _naive_classify(subject, sender, rules, labels, filters):
+    # Samma logik som sync_worker hade före MessageClassifier (referens för korrekthet och tid)
+    subj_lower = (subject or "").lower()
+    sender_lower = (sender or "").lower()
+
+    applied_labels = []
+    for l_id, l_key, l_field in labels:
+        l_field = (l_field or 'subject').lower()
+        keywords = [k.strip().lower() for k in (l_key or "").split(',') if k.strip()]
+        is_match = False
+        for k in keywords:
+            if l_field == 'sender':
+                if k in sender_lower: is_match = True
+            elif l_field == 'both':
+                if k in subj_lower or k in sender_lower: is_match = True
+            else:
+                if k in subj_lower: is_match = True
+            if is_match: break
+        if is_match: applied_labels.append(l_id)
+
+    rule_target = None
+    for r_key, r_folder, r_field in rules:
+        r_field = (r_field or 'subject').lower()
+        is_match = False
+        if r_field == 'sender':
+            if r_key.lower() in sender_lower: is_match = True
+        elif r_field == 'both':
+            if r_key.lower() in subj_lower or r_key.lower() in sender_lower: is_match = True
+        else:
+            if r_key.lower() in subj_lower: is_match = True
+        if is_match:
+            rule_target = r_folder
+            break
+
+    whitelisted = any(w.lower() in sender_lower for w in filters.get('whitelist', []))
+    is_spam = not whitelisted and (any(s.lower() in sender_lower for s in filters.get('senders', [])) or
+                                   any(s.lower() in subj_lower for s in filters.get('subjects', [])))
+    is_ad = not whitelisted and (any(s.lower() in sender_lower for s in filters.get('ads_senders', [])) or
+                                 any(s.lower() in subj_lower for s in filters.get('ads_subjects', [])))
+    return {'labels': sorted(applied_labels), 'rule_target': rule_target, 'is_spam': is_spam, 'is_ad': is_ad}
+
+def bench_matcher(n_rules=1000, n_labels=100, n_headers=100000, seed=1):
+    rng = random.Random(seed)
+    vocab = [_word(rng) for _ in range(5000)]
+    fields = ['subject', 'sender', 'both']
+    rules = [(rng.choice(vocab), f"INBOX.R{i}", rng.choice(fields)) for i in range(n_rules)]
+    labels = [(i + 1, ', '.join(rng.choice(vocab) for _ in range(rng.randint(1, 4))), rng.choice(fields)) for i in range(n_labels)]
+    filters = app.get_spam_filters()
+    filters = dict(filters, senders=[f"{_word(rng)}.com" for _ in range(200)], ads_senders=[f"news@{_word(rng)}.se" for _ in range(200)],
+                   whitelist=[f"{_word(rng)}.org" for _ in range(50)])
+    headers = []
+    for _ in range(n_headers):
+        subject = ' '.join(rng.choice(vocab) for _ in range(rng.randint(3, 8))).capitalize()
+        sender = f"{rng.choice(vocab)}@{rng.choice(vocab)}.{rng.choice(['com', 'se', 'org'])}"
+        headers.append((subject, sender))
+
+    t0 = time.perf_counter()
+    classifier = app.MessageClassifier(rules, labels, filters)
+    build = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    fast = classifier.classify_batch(headers)
+    fast_time = time.perf_counter() - t0
+
+    # Referensen är långsam; mät på ett stickprov och räkna upp
+    sample = headers[:max(1, n_headers // 10)]
+    t0 = time.perf_counter()
+    slow = [_naive_classify(s, f, rules, labels, filters) for s, f in sample]
+    slow_time = (time.perf_counter() - t0) * n_headers / len(sample)
+
+    mismatches = sum(1 for a, b in zip(fast, slow) if a != b)
+    print(f"matcher: {n_rules} regler, {n_labels} etiketter, {n_headers} rubriker")
+    print(f"  bygga automat:        {build * 1000:8.1f} ms")
+    print(f"  MessageClassifier:    {fast_time:8.2f} s  ({n_headers / fast_time:,.0f} rubriker/s)")
+    print(f"  linjär loop (uppsk.): {slow_time:8.2f} s  ({n_headers / slow_time:,.0f} rubriker/s)")
+    print(f"  skillnader mot referens i stickprov: {mismatches} av {len(sample)}")
+    return mismatches == 0
+
+def _count_bytes(client):
+    # Räkna byte som imaplib läser från servern (read/readline anropas via instansen)
+    counter = {'bytes': 0}
+    read, readline = client.read, client.readline
+    def counted_read(size):
+        data = read(size)
+        counter['bytes'] += len(data)
+        return data
+    def counted_readline():
+        line = readline()
+        counter['bytes'] += len(line)
+        return line
+    client.read, client.readline = counted_read, counted_readline
+    return counter
+
+def bench_bodyfetch(folder=None, count=None):
+    folder = folder or os.environ.get('ZALASO_BENCH_FOLDER', 'INBOX')
+    count = int(count or os.environ.get('ZALASO_BENCH_COUNT', 200))
+    if not app.is_configured():
+        print("bodyfetch: inget konto konfigurerat (settings.json), hoppar över")
+        return None
+    mb = app.get_mailbox()
+    try:
+        mb.folder.set(folder)
+        uids = sorted((int(u) for u in mb.uids()), reverse=True)[:count]
+        if not uids:
+            print(f"bodyfetch: {folder} är tom")
+            return None
+        counter = _count_bytes(mb.client)
+        results = {}
+        for name, fetch in (('full', lambda chunk: app.fetch_bodies_full(mb, chunk)),
+                            ('structure', lambda chunk: app.fetch_bodies_structured(mb, folder, chunk))):
+            counter['bytes'] = 0
+            t0 = time.perf_counter()
+            rows = []
+            for i in range(0, len(uids), 100):
+                rows.extend(fetch(uids[i:i+100]))
+            results[name] = (time.perf_counter() - t0, counter['bytes'], {int(r[0]): r for r in rows})
+    finally:
+        try: mb.logout()
+        except Exception: pass
+
+    full, structured = results['full'], results['structure']
+    same_text = sum(1 for uid, r in structured[2].items() if uid in full[2] and full[2][uid][1].strip() == r[1].strip())
+    print(f"bodyfetch: {len(uids)} mail i {folder}")
+    for name, (elapsed, nbytes, rows) in results.items():
+        print(f"  {name:10s} {elapsed:8.2f} s  {nbytes / 1024 / 1024:10.2f} MB  ({len(rows)} mail)")
+    print(f"  överfört: {structured[1] / max(full[1], 1):.1%} av full hämtning")
+    # Skillnader i text är väntade för vidarebefordrade mail: den fulla vägen tar med texten i bifogade message/rfc822
+    print(f"  samma text/plain: {same_text} av {len(structured[2])}")
+    return True
+
+def _median_ms(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    return sorted(times)[len(times) // 2]
+
+def bench_listing(n_rows=None, page=2000, per_page=50, repeat=15, seed=1):
+    n_rows = int(n_rows or os.environ.get('ZALASO_BENCH_ROWS', 110000))
+    rng = random.Random(seed)
+    tmp = tempfile.mkdtemp(prefix='zalaso-bench-')
+    old_db, old_log = app.DB_FILE, app.LOG_FILE
+    app.DB_FILE = os.path.join(tmp, 'bench.db')
+    # Loggen hamnar i tempkatalogen, inte i användarens zalaso.log
+    app.LOG_FILE = os.path.join(tmp, 'bench.log')
+    try:
+        app.init_db()
+        start = datetime(2015, 1, 1)
+        rows = []
+        for uid in range(1, n_rows + 1):
+            # Några mail utan datum (de hamnar sist i listan)
+            date_iso = None if rng.random() < 0.001 else (start + timedelta(minutes=rng.randint(0, 5_000_000))).isoformat()
+            rows.append((uid, 'INBOX', f"{_word(rng).capitalize()} {_word(rng)}", f"{_word(rng)} <{_word(rng)}@{_word(rng)}.se>",
+                         date_iso, app.date_ts(date_iso), rng.random() < 0.5, rng.random() < 0.01, _word(rng, 30)))
+        with app.sqlite3.connect(app.DB_FILE) as conn:
+            conn.executemany("INSERT INTO emails(uid, folder, subject, sender, date_iso, ts, seen, flagged, snippet) VALUES (?,?,?,?,?,?,?,?,?)", rows)
+        page = min(page, n_rows // per_page)
+
+        with app.sqlite3.connect(app.DB_FILE) as conn:
+            conn.row_factory = app.sqlite3.Row
+            offset_sql = f"SELECT {app.LISTING_COLUMNS} FROM emails WHERE folder=? AND uid IS NOT NULL AND uid != 0 ORDER BY ts DESC, uid DESC LIMIT ? OFFSET ?"
+            def offset_page(p):
+                return conn.execute(offset_sql, ('INBOX', per_page, (p - 1) * per_page)).fetchall()
+            # Markören för sida N är sista raden på sida N-1 (klienten får den som next_cursor)
+            prev = offset_page(page - 1)[-1]
+            cursor = app.decode_cursor(app.encode_cursor({'t': prev['ts'], 'u': prev['uid']}))
+            def keyset_page(c):
+                return app.list_page(conn, 'INBOX', '', c, per_page)[0]
+            def api_page(c):
+                mails = [app.MockMsg(r) for r in keyset_page(c)]
+                app.load_attachment_chips(conn, mails)
+                return app.thread_summaries(mails, 'INBOX')
+
+            same = [r['uid'] for r in offset_page(page)] == [r['uid'] for r in keyset_page(cursor)]
+            results = [
+                ('OFFSET, sida 1', _median_ms(lambda: offset_page(1), repeat)),
+                (f'OFFSET, sida {page}', _median_ms(lambda: offset_page(page), repeat)),
+                ('markör, sida 1', _median_ms(lambda: keyset_page(None), repeat)),
+                (f'markör, sida {page}', _median_ms(lambda: keyset_page(cursor), repeat)),
+                (f'/api/threads, sida {page}', _median_ms(lambda: api_page(cursor), repeat)),
+            ]
+    finally:
+        app.DB_FILE, app.LOG_FILE = old_db, old_log
+        app.db_pool.close_all()
+        for name in os.listdir(tmp): os.remove(os.path.join(tmp, name))
+        os.rmdir(tmp)
+
+    print(f"listing: {n_rows} mail i en mapp, {per_page} per sida (median av {repeat})")
+    for name, ms in results:
+        print(f"  {name:26s} {ms:8.2f} ms")
+    print(f"  samma rader på sida {page}: {'ja' if same else 'NEJ'}")
+    return same
+
+def _legacy_load_settings():
+    # load_settings före inställningscachen: läser och tolkar filen vid varje anrop
+    if not os.path.exists(app.SETTINGS_FILE): return {}
+    try:
+        with open(app.SETTINGS_FILE, 'r') as f:
+            content = f.read().strip()
+            if not content: return {}
+            return json.loads(content)
+    except: return {}
+
+def _legacy_require_login():
+    # require_login före ensure_db: ny anslutning och schemafråga vid varje anrop
+    if app.request.endpoint != 'static':
+        if not os.path.exists(app.DB_FILE):
+            app.init_db()
+        else:
+            try:
+                with app.sqlite3.connect(app.DB_FILE, timeout=30.0) as conn:
+                    conn.execute("SELECT 1 FROM emails LIMIT 1")
+            except: app.init_db()
+    if app.request.endpoint in ['static', 'setup', 'save_settings', 'test_connection']:
+        return
+    if not app.is_configured():
+        return app.redirect(app.url_for('setup'))
+    if app.request.endpoint == 'login':
+        return
+    settings = app.load_settings()
+    if settings.get('web_password') and not app.session.get('logged_in'):
+        return app.redirect(app.url_for('login'))
+
+class _NoImap:
+    def flag(self, *args, **kwargs): pass
+
+def bench_requests(n_requests=2000, repeat=5):
+    tmp = tempfile.mkdtemp(prefix='zalaso-bench-')
+    saved = (app.DB_FILE, app.SETTINGS_FILE, app.LOG_FILE, app.imap_session, app.load_settings)
+    hooks = app.app.before_request_funcs.setdefault(None, [])
+    hook_index = hooks.index(app.require_login)
+    @contextmanager
+    def no_imap(folder=None):
+        yield _NoImap()
+    try:
+        app.DB_FILE = os.path.join(tmp, 'bench.db')
+        app.SETTINGS_FILE = os.path.join(tmp, 'settings.json')
+        app.LOG_FILE = os.path.join(tmp, 'bench.log')
+        with open(app.SETTINGS_FILE, 'w') as f:
+            json.dump({'email': 'a@b.se', 'password': 'x', 'imap_server': 'imap.b.se', 'imap_port': '993',
+                       'smtp_server': 'smtp.b.se', 'smtp_port': '587', 'web_password': 'hemligt', 'language': 'sv'}, f, indent=4)
+        app.init_db()
+        with app.sqlite3.connect(app.DB_FILE) as conn:
+            conn.executemany("INSERT INTO emails(uid, folder, subject, seen) VALUES (?, 'INBOX', 's', 0)", [(u,) for u in range(1, 101)])
+        # IMAP-delen av anropet mäts inte; bara det som körs lokalt per anrop
+        app.imap_session = no_imap
+        client = app.app.test_client()
+        with client.session_transaction() as s:
+            s['logged_in'] = True
+
+        def run():
+            for i in range(n_requests):
+                client.get(f'/api/mark_read/{i % 100 + 1}?folder=INBOX')
+
+        results = []
+        for name, hook, loader in (('före (fil + DB per anrop)', _legacy_require_login, _legacy_load_settings),
+                                   ('efter (cache)', app.require_login, saved[3])):
+            hooks[hook_index] = hook
+            app.load_settings = loader
+            run()
+            results.append((name, _median_ms(run, repeat) * 1000 / n_requests))
+    finally:
+        hooks[hook_index] = app.require_login
+        app.DB_FILE, app.SETTINGS_FILE, app.LOG_FILE, app.imap_session, app.load_settings = saved
+        app.db_pool.close_all()
+        app.db_checked['key'] = None
+        app.settings_cache['key'] = None
+        for name in os.listdir(tmp): os.remove(os.path.join(tmp, name))
+        os.rmdir(tmp)
+
+    print(f"requests: /api/mark_read utan IMAP, {n_requests} anrop (median av {repeat})")
+    for name, us in results:
+        print(f"  {name:26s} {us:8.1f} µs/anrop")
+    print(f"  skillnad: {results[0][1] - results[1][1]:.1f} µs/anrop")
+    return True
+
+BENCHMARKS = {
+    'matcher': bench_matcher,
+    'bodyfetch': bench_bodyfetch,
+    'listing': bench_listing,
+    'requests': bench_requests,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Zalaso prestandamätningar")
+    parser.add_argument('names', nargs='*', help=f"vilka mätningar som ska köras: {', '.join(sorted(BENCHMARKS))} (standard: alla)")
+    args = parser.parse_args()
+    unknown = [n for n in args.names if n not in BENCHMARKS]
+    if unknown: parser.error(f"okänd mätning: {', '.join(unknown)}")
+    ok = True
+    for name in args.names or sorted(BENCHMARKS):
+        ok = BENCHMARKS[name]() is not False and ok
+    sys.exit(0 if ok else 1)
@@ -1,6 +1,14 @@
 // Stabil logik för Zalaso Mail
 window.Zalaso = {
     markedUids: new Set(),
+    // Listan innehåller bara kuvertdata; mailkroppar hämtas från /api/get_message när en tråd öppnas.
+    // Svaren (promises) cachas per mapp/uid så att förhämtning och öppning delar samma anrop.
+    bodyCache: new Map(),
+    bodyCacheMax: 100,
+    prefetchPerThread: 3,
+    prefetchUnread: 3,
+    prefetchDelay: 150,
+    prefetchTimer: null,
 
     async openMail(app, tid, uid, isUnread, folder) {
         app.activeThread = tid;
@@ -15,5 +23,62 @@ window.Zalaso = {
             const h = obj.contentWindow.document.body.scrollHeight;
             if(h > 20) obj.style.height = h + 'px';
         } catch(e) {}
+    },
+
+    getMessage(uid, folder, fresh = false) {
+        const key = `${folder}\n${uid}`;
+        if (fresh || !this.bodyCache.has(key)) {
+            const p = fetch(`/api/get_message/${uid}?folder=${encodeURIComponent(folder)}`)
+                .then(r => r.json())
+                .then(d => {
+                    // Fel cachas inte, nästa öppning försöker igen
+                    if (d.error) this.bodyCache.delete(key);
+                    return d;
+                })
+                .catch(e => { this.bodyCache.delete(key); throw e; });
+            this.bodyCache.delete(key);
+            this.bodyCache.set(key, p);
+            while (this.bodyCache.size > this.bodyCacheMax) {
+                this.bodyCache.delete(this.bodyCache.keys().next().value);
+            }
+        }
+        return this.bodyCache.get(key);
+    },
+
+    prefetchRow(row) {
+        // data-prefetch: [[uid, mapp], ...] nyast först
+        if (!row || !row.dataset.prefetch) return;
+        try {
+            JSON.parse(row.dataset.prefetch).slice(0, this.prefetchPerThread)
+                .forEach(([uid, folder]) => this.getMessage(uid, folder).catch(() => {}));
+        } catch(e) {}
+    },
+
+    prefetchSoon(row) {
+        // Hovring: vänta en kort stund så att musen som bara passerar listan inte hämtar allt
+        this.cancelPrefetch();
+        this.prefetchTimer = setTimeout(() => this.prefetchRow(row), this.prefetchDelay);
+    },
+
+    cancelPrefetch() {
+        if (this.prefetchTimer) clearTimeout(this.prefetchTimer);
+        this.prefetchTimer = null;
+    },
+
+    prefetchNext(threadIds, id) {
+        // Nästa tråd i listan är den troligaste att öppnas efter den aktuella
+        const i = threadIds.indexOf(id);
+        if (i >= 0 && i + 1 < threadIds.length) this.prefetchRow(document.getElementById('thread-' + threadIds[i + 1]));
+    },
+
+    prefetchOnIdle() {
+        // De översta olästa trådarna hämtas när webbläsaren är ledig
+        const run = () => document.querySelectorAll('[data-prefetch][data-unread="true"]')
+            .forEach((row, i) => { if (i < this.prefetchUnread) this.prefetchRow(row); });
+        if (window.requestIdleCallback) requestIdleCallback(run, { timeout: 2000 });
+        else setTimeout(run, 500);
     }
 };
+
+if (document.readyState === 'loading') document.addEventListener('DOMContentLoaded', () => window.Zalaso.prefetchOnIdle());
+else window.Zalaso.prefetchOnIdle();